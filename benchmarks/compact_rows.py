@@ -0,0 +1,77 @@
+import json
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+import typing as tp
+
+import click
+
+from compgraph.graph import Graph
+from compgraph.operations.join import GroupBuffer
+
+
+# Rows of the scenarios of tests/memory
+SCENARIOS: dict[str, tp.Callable[[int], dict[str, tp.Any]]] = {
+    'map': lambda i: {'data': 'HE.LLO', 'n': 2},
+    'reduce': lambda i: {'key': 'abc'[i % 3], 'value': i},
+    'yandex_times': lambda i: {'leave_time': '20171020T112238.723000', 'enter_time': '20171020T112237.427000',
+                               'edge_id': 8414926848168493057 + i % 1000},
+    'yandex_lengths': lambda i: {'start': [37.84870228730142, 55.73853974696249],
+                                 'end': [37.8490418381989, 55.73832445777953], 'edge_id': 8414926848168493057 + i},
+}
+
+
+def write_rows(make_row: tp.Callable[[int], dict[str, tp.Any]], n_rows: int) -> str:
+    with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+        for i in range(n_rows):
+            f.write(json.dumps(make_row(i)) + '\n')
+    return f.name
+
+
+def held_rows_memory(filename: str, schema: tp.Sequence[str] | None) -> tuple[int, int, float]:
+    """Bytes taken by all rows of a file held in memory, as by a sort run or by a join group,
+    bytes of the rows pickled in batches as sent to a sort worker, and seconds of reading"""
+    graph = Graph.graph_from_file(filename, json.loads, schema)
+    start = time.perf_counter()
+    tracemalloc.start()
+    rows = list(graph.run())
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    elapsed = time.perf_counter() - start
+    pickled = sum(len(pickle.dumps(rows[i:i + 1024], protocol=pickle.HIGHEST_PROTOCOL))
+                  for i in range(0, len(rows), 1024))
+    return held, pickled, elapsed
+
+
+def join_group_memory(filename: str, schema: tp.Sequence[str] | None) -> int:
+    """Bytes taken by all rows of a file buffered as one join key group"""
+    rows = Graph.graph_from_file(filename, json.loads, schema).run()
+    tracemalloc.start()
+    group = GroupBuffer(rows, max_rows=10 ** 9)
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    group.close()
+    return held
+
+
+@click.command()
+@click.option('--rows', 'n_rows', default=300000, help='number of rows of every scenario')
+def main(n_rows: int) -> None:
+    for name, make_row in SCENARIOS.items():
+        filename = write_rows(make_row, n_rows)
+        schema = tuple(make_row(0))
+        dict_held, dict_pickled, dict_time = held_rows_memory(filename, None)
+        compact_held, compact_pickled, compact_time = held_rows_memory(filename, schema)
+        dict_group = join_group_memory(filename, None)
+        compact_group = join_group_memory(filename, schema)
+        click.echo(f'{name}: rows {dict_held / 2 ** 20:.1f} -> {compact_held / 2 ** 20:.1f} MiB, '
+                   f'join group {dict_group / 2 ** 20:.1f} -> {compact_group / 2 ** 20:.1f} MiB, '
+                   f'pickled {dict_pickled / 2 ** 20:.1f} -> {compact_pickled / 2 ** 20:.1f} MiB, '
+                   f'read {dict_time:.2f} -> {compact_time:.2f} sec')
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import random
+import time
+
+import click
+
+from compgraph import operations as ops
+from compgraph.graph import Graph
+
+
+def make_rows(n_rows: int) -> list[dict[str, object]]:
+    rnd = random.Random(0)
+    return [{'enter_time': f'201710{rnd.randint(10, 28)}T{rnd.randint(10, 23)}{rnd.randint(10, 59)}00.000000',
+             'start': [37.0 + rnd.random(), 55.0 + rnd.random()],
+             'end': [37.0 + rnd.random(), 55.0 + rnd.random()]} for _ in range(n_rows)]
+
+
+def rows_per_second(rows: list[dict[str, object]], parallel: int, ordered: bool) -> float:
+    graph = Graph.graph_from_iter('input') \
+        .map(ops.WeekHour('enter_time', '%Y%m%dT%H%M%S.%f', 'weekday', 'hour'), parallel=parallel, ordered=ordered) \
+        .map(ops.HaversineDistance('start', 'end', 'distance'), parallel=parallel, ordered=ordered)
+    start = time.perf_counter()
+    for _ in graph.run(input=lambda: iter(rows)):
+        pass
+    return len(rows) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--rows', 'n_rows', default=300000, help='number of rows to map')
+@click.option('--workers', default=4, help='maximum number of worker processes')
+def main(n_rows: int, workers: int) -> None:
+    rows = make_rows(n_rows)
+    click.echo(f'in process: {rows_per_second(rows, 1, True):,.0f} rows/sec')
+    for parallel in range(2, workers + 1):
+        for ordered in (True, False):
+            click.echo(f'parallel={parallel} ordered={ordered}: '
+                       f'{rows_per_second(rows, parallel, ordered):,.0f} rows/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import random
+import string
+import time
+import tracemalloc
+import typing as tp
+
+import click
+
+from compgraph import algorithms
+from compgraph import operations as ops
+from compgraph.fanout import FanOut
+from compgraph.graph import Graph
+
+
+def make_docs(n_docs: int) -> list[dict[str, object]]:
+    rnd = random.Random(0)
+    words = [''.join(rnd.choices(string.ascii_letters, k=rnd.randint(2, 10))) for _ in range(5000)]
+    return [{'doc_id': i, 'text': ' '.join(rnd.choices(words, k=50)) + '!',
+             'weight': rnd.randint(1, 5), 'scale': rnd.random(),
+             'point': [rnd.random(), rnd.random()]} for i in range(n_docs)]
+
+
+def map_graph(input_stream_name: str) -> Graph:
+    """Products and words of documents, one row per word"""
+    return Graph.graph_from_iter(input_stream_name) \
+        .map(ops.Product(['weight', 'scale'], 'product')) \
+        .map(ops.Split('text'))
+
+
+def fan_out_graph(input_stream_name: str) -> Graph:
+    """Words of a node shared by three consumers, two of which lag behind the first one"""
+    words = map_graph(input_stream_name)
+    by_doc = words.sort(['doc_id', 'text'])
+    counts = words.sort(['doc_id', 'text']).reduce(ops.Count('count'), ['doc_id', 'text'])
+    weights = words.sort(['doc_id', 'text']).reduce(ops.Sum('product'), ['doc_id', 'text'])
+    return by_doc.join(ops.InnerJoiner(), counts, ['doc_id', 'text']) \
+        .join(ops.InnerJoiner(), weights, ['doc_id', 'text'])
+
+
+GRAPHS: dict[str, tp.Callable[[str], Graph]] = {
+    'map': map_graph,
+    'fan_out': fan_out_graph,
+    'word_count': lambda name: algorithms.word_count_graph(name),
+    'inverted_index': lambda name: algorithms.inverted_index_graph(name),
+    'pmi': lambda name: algorithms.pmi_graph(name),
+}
+
+
+def run(graph: Graph, docs: list[dict[str, object]]) -> float:
+    """Seconds of one run"""
+    start = time.perf_counter()
+    for _ in graph.run(input=lambda: iter(docs)):
+        pass
+    return time.perf_counter() - start
+
+
+def peak_memory(graph: Graph, docs: list[dict[str, object]]) -> int:
+    """Peak memory in bytes allocated during one run"""
+    tracemalloc.start()
+    for _ in graph.run(input=lambda: iter(docs)):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def fan_out_buffer_memory(rows: list[ops.TRow]) -> int:
+    """Peak memory in bytes of rows buffered in memory for two consumers lagging behind the whole stream"""
+    tracemalloc.start()
+    fanout = FanOut(iter(rows), consumers=3, buffer_size=len(rows) + 1)
+    consumers = [fanout.consumer() for _ in range(3)]
+    for consumer in consumers:
+        for _ in consumer:
+            pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def copied_buffer_memory(rows: list[ops.TRow]) -> int:
+    """Peak memory in bytes of the same rows buffered as a copy for every lagging consumer,
+    as fan-out did before rows were copied on write"""
+    tracemalloc.start()
+    buffers = [[row.copy() for row in rows] for _ in range(2)]
+    for buffer in buffers:
+        buffer.clear()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+@click.command()
+@click.option('--docs', 'n_docs', default=2000, help='number of documents of 50 words')
+@click.option('--repeat', default=3, help='number of runs, the best one is reported')
+def main(n_docs: int, repeat: int) -> None:
+    docs = make_docs(n_docs)
+    for name, make_graph in GRAPHS.items():
+        graph = make_graph('input')
+        elapsed = min(run(graph, docs) for _ in range(repeat))
+        peak = peak_memory(graph, docs)
+        click.echo(f'{name}: {elapsed:.2f} sec, peak {peak / 2 ** 20:.1f} MiB')
+    words = list(map_graph('input').run(input=lambda: iter(docs)))
+    row_type = ops.compact_row_type(words[0])
+    for kind, rows in [('dict', words), ('compact', [row_type.from_row(row) for row in words])]:
+        click.echo(f'fan_out buffers of {kind} rows: peak {copied_buffer_memory(rows) / 2 ** 20:.1f} MiB '
+                   f'copied per consumer -> {fan_out_buffer_memory(rows) / 2 ** 20:.1f} MiB copied on write')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import random
+import string
+import time
+
+import click
+
+from compgraph.external_sort import ExternalSort, PIPE_BATCH_SIZE
+
+
+def make_rows(n_rows: int) -> list[dict[str, object]]:
+    rnd = random.Random(0)
+    words = [''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(2, 10))) for _ in range(10000)]
+    return [{'doc_id': i // 100, 'text': rnd.choice(words)} for i in range(n_rows)]
+
+
+def rows_per_second(rows: list[dict[str, object]], batch_size: int, workers: int = 1) -> float:
+    start = time.perf_counter()
+    for _ in ExternalSort(['text'], batch_size=batch_size, workers=workers)(iter(rows)):
+        pass
+    return len(rows) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--rows', 'n_rows', default=1000000, help='number of word rows to sort')
+@click.option('--workers', default=1, help='maximum number of workers for sample sort')
+def main(n_rows: int, workers: int) -> None:
+    rows = make_rows(n_rows)
+    for batch_size in (1, PIPE_BATCH_SIZE):
+        click.echo(f'batch_size={batch_size}: {rows_per_second(rows, batch_size):,.0f} rows/sec')
+    for n_workers in range(2, workers + 1):
+        click.echo(f'workers={n_workers}: {rows_per_second(rows, PIPE_BATCH_SIZE, n_workers):,.0f} rows/sec')
+
+
+if __name__ == '__main__':
+    main()
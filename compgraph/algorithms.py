@@ -12,16 +12,14 @@ def word_count_graph(input_stream_name: str, text_column: str = 'text',
             .map(operations.FilterPunctuation(text_column)) \
             .map(operations.LowerCase(text_column)) \
             .map(operations.Split(text_column)) \
-            .sort([text_column]) \
-            .reduce(operations.Count(count_column), [text_column]) \
+            .reduce(operations.Count(count_column), [text_column], strategy='hash') \
             .sort([count_column, text_column])
     else:
         graph = Graph.graph_from_iter(input_stream_name) \
             .map(operations.FilterPunctuation(text_column)) \
             .map(operations.LowerCase(text_column)) \
             .map(operations.Split(text_column)) \
-            .sort([text_column]) \
-            .reduce(operations.Count(count_column), [text_column]) \
+            .reduce(operations.Count(count_column), [text_column], strategy='hash') \
             .sort([count_column, text_column])
     return graph
 
@@ -32,32 +30,27 @@ def inverted_index_graph(input_stream_name: str, doc_column: str = 'doc_id',
                          read_from_file: bool = False) -> Graph:
     """Constructs graph which calculates td-idf for every word/document pair"""
     if read_from_file:
-        split_word = Graph.graph_from_file(input_stream_name, json.loads) \
-            .map(operations.LowerCase(text_column)) \
-            .map(operations.FilterPunctuation(text_column)) \
-            .map(operations.Split(text_column))
-
-        count_docs = Graph.graph_from_file(input_stream_name, json.loads) \
-            .map(operations.Project([doc_column])) \
-            .reduce(operations.CountUnique(doc_column, 'n_docs'), [])
+        source = Graph.graph_from_file(input_stream_name, json.loads)
     else:
-        split_word = Graph.graph_from_iter(input_stream_name) \
-            .map(operations.LowerCase(text_column)) \
-            .map(operations.FilterPunctuation(text_column)) \
-            .map(operations.Split(text_column))
+        source = Graph.graph_from_iter(input_stream_name)
+
+    split_word = source \
+        .map(operations.LowerCase(text_column)) \
+        .map(operations.FilterPunctuation(text_column)) \
+        .map(operations.Split(text_column))
 
-        count_docs = Graph.graph_from_iter(input_stream_name) \
-            .map(operations.Project([doc_column])) \
-            .reduce(operations.CountUnique(doc_column, 'n_docs'), [])
+    count_docs = source \
+        .map(operations.Project([doc_column])) \
+        .reduce(operations.CountUnique(doc_column, 'n_docs'), [])
 
     uniques = split_word.sort([text_column]) \
-        .reduce(operations.CountUnique(doc_column, 'uniques'), [text_column]) \
+        .reduce(operations.CountUnique(doc_column, 'uniques'), [text_column], combine=True) \
         .sort([text_column])
     tf = split_word.sort([doc_column]) \
-        .reduce(operations.TermFrequency(text_column, 'tf'), [doc_column]) \
+        .reduce(operations.TermFrequency(text_column, 'tf'), [doc_column], combine=True) \
         .sort([text_column])
 
-    graph = count_docs.join(operations.InnerJoiner(), tf, []) \
+    graph = tf.join(operations.InnerJoiner(), count_docs, []) \
         .join(operations.InnerJoiner(), uniques, [text_column]) \
         .map(operations.Divide(nominator='n_docs', denominator='uniques',
                                result='fraction')) \
@@ -79,19 +72,19 @@ def pmi_graph(input_stream_name: str, doc_column: str = 'doc_id',
             .map(operations.FilterPunctuation(text_column)) \
             .map(operations.LowerCase(text_column)) \
             .map(operations.Split(text_column)) \
-            .map(operations.Filter(lambda row: len(row[text_column]) > 4)) \
+            .map(operations.Filter(operations.length(operations.col(text_column)) > 4)) \
             .sort([doc_column, text_column])
     else:
         words = Graph.graph_from_iter(input_stream_name) \
             .map(operations.FilterPunctuation(text_column)) \
             .map(operations.LowerCase(text_column)) \
             .map(operations.Split(text_column)) \
-            .map(operations.Filter(lambda row: len(row[text_column]) > 4)) \
+            .map(operations.Filter(operations.length(operations.col(text_column)) > 4)) \
             .sort([doc_column, text_column])
 
     filtered = words.sort([doc_column, text_column]) \
-        .reduce(operations.Count('count'), [doc_column, text_column]) \
-        .map(operations.Filter(lambda row: row['count'] >= 2)) \
+        .reduce(operations.Count('count'), [doc_column, text_column], combine=True) \
+        .map(operations.Filter(operations.col('count') >= 2)) \
         .map(operations.Project([doc_column, text_column])) \
         .join(operations.InnerJoiner(), words, [doc_column, text_column])
 
@@ -129,27 +122,23 @@ def yandex_maps_graph(input_stream_name_time: str,
     if read_from_file:
         time = Graph.graph_from_file(input_stream_name_time, json.loads) \
             .map(operations.WeekHour(enter_time_column, time_format,
-                                     weekday_result_column, hour_result_column)) \
-            .sort([edge_id_column])
+                                     weekday_result_column, hour_result_column))
 
         distance = Graph.graph_from_file(input_stream_name_length, json.loads) \
-            .map(operations.HaversineDistance(start_coord_column, end_coord_column, 'haversine_distance')) \
-            .sort([edge_id_column])
+            .map(operations.HaversineDistance(start_coord_column, end_coord_column, 'haversine_distance'))
     else:
         time = Graph.graph_from_iter(input_stream_name_time) \
             .map(operations.WeekHour(enter_time_column, time_format,
-                                     weekday_result_column, hour_result_column)) \
-            .sort([edge_id_column])
+                                     weekday_result_column, hour_result_column))
 
         distance = Graph.graph_from_iter(input_stream_name_length) \
-            .map(operations.HaversineDistance(start_coord_column, end_coord_column, 'haversine_distance')) \
-            .sort([edge_id_column])
+            .map(operations.HaversineDistance(start_coord_column, end_coord_column, 'haversine_distance'))
 
-    graph = time.join(operations.InnerJoiner(), distance, [edge_id_column]) \
+    graph = time.join(operations.InnerJoiner(), distance, [edge_id_column], strategy='hash') \
         .sort([weekday_result_column, hour_result_column]) \
         .reduce(
         operations.Speed('haversine_distance', enter_time_column, leave_time_column,
                          time_format, speed_result_column),
-        [weekday_result_column, hour_result_column])
+        [weekday_result_column, hour_result_column], combine=True)
 
     return graph
@@ -1,49 +1,234 @@
+import contextlib
+import heapq
+import pickle
+import random
 import typing as tp
-from multiprocessing import Pipe, Process, connection
+from bisect import bisect_right
+from itertools import chain, groupby, islice
+from multiprocessing import connection
 from operator import itemgetter
 
 from . import operations as ops
+from .operations.utils import SpillFile
+from .pool import WorkerPool, default_pool, recv_message
 
+MEMORY_LIMIT = 64 * 1024 * 1024
+MAX_FAN_IN = 64
+RUN_BATCH_SIZE = 1024
+PIPE_BATCH_SIZE = 1024
+IN_PROCESS_ROWS = 1000
+SAMPLE_SIZE = 10000
 
-def do_sort(endpoint: connection.Connection, keys: tuple[str, ...]) -> None:
-    rows = []
+
+def _write_run(rows: tp.Iterable[ops.TRow], directory: str | None) -> SpillFile:
+    run = SpillFile(directory)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == RUN_BATCH_SIZE:
+            run.write(batch)
+            batch = []
+    if batch:
+        run.write(batch)
+    return run
+
+
+def _merge_runs(runs: list[SpillFile], key: tp.Callable[[ops.TRow], tp.Any],
+                max_fan_in: int, directory: str | None) -> tp.Iterator[ops.TRow]:
+    # Consecutive runs are merged together, so rows with equal keys keep their input order
+    while len(runs) > max_fan_in:
+        merged = []
+        for i in range(0, len(runs), max_fan_in):
+            group = runs[i:i + max_fan_in]
+            merged.append(_write_run(heapq.merge(*group, key=key), directory))
+            for run in group:
+                run.close()
+        runs = merged
+    try:
+        yield from heapq.merge(*runs, key=key)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _send_batches(endpoint: connection.Connection, rows: tp.Iterable[ops.TRow], batch_size: int) -> int:
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            endpoint.send_bytes(pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL))
+            count += len(batch)
+            batch = []
+    if batch:
+        endpoint.send_bytes(pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL))
+        count += len(batch)
+    endpoint.send_bytes(pickle.dumps(None))
+    return count
+
+
+def _recv_batches(endpoint: connection.Connection) -> tp.Iterator[tuple[list[ops.TRow], int]]:
     while True:
-        row = endpoint.recv()
-        if row is None:
+        batch, size = recv_message(endpoint)
+        if batch is None:
             break
-        rows.append(row)
-    rows.sort(key=itemgetter(*keys))
+        yield batch, size
+
+
+def do_sort(endpoint: connection.Connection, keys: tuple[str, ...], memory_limit: int,
+            max_fan_in: int, directory: str | None, batch_size: int) -> None:
+    key = itemgetter(*keys)
+    runs = []
+    rows: list[ops.TRow] = []
+    size = 0
+    for batch, batch_bytes in _recv_batches(endpoint):
+        rows.extend(batch)
+        size += batch_bytes
+        if size >= memory_limit:
+            rows.sort(key=key)
+            runs.append(_write_run(rows, directory))
+            rows = []
+            size = 0
+    rows.sort(key=key)
+    if runs:
+        if rows:
+            runs.append(_write_run(rows, directory))
+        rows = []
+        sorted_rows: tp.Iterable[ops.TRow] = _merge_runs(runs, key, max_fan_in, directory)
+    else:
+        sorted_rows = rows
+    _send_batches(endpoint, sorted_rows, batch_size)
+
+
+def _send_ranges(endpoints: list[connection.Connection], rows: tp.Iterable[ops.TRow],
+                 key: tp.Callable[[ops.TRow], tp.Any], boundaries: list[tp.Any], batch_size: int) -> int:
+    count = 0
+    batches: list[list[ops.TRow]] = [[] for _ in endpoints]
     for row in rows:
-        endpoint.send(row)
-    endpoint.send(None)
+        index = bisect_right(boundaries, key(row))
+        batches[index].append(row)
+        if len(batches[index]) == batch_size:
+            endpoints[index].send_bytes(pickle.dumps(batches[index], protocol=pickle.HIGHEST_PROTOCOL))
+            count += batch_size
+            batches[index] = []
+    for endpoint, batch in zip(endpoints, batches):
+        if batch:
+            endpoint.send_bytes(pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL))
+            count += len(batch)
+        endpoint.send_bytes(pickle.dumps(None))
+    return count
 
 
 class ExternalSort(ops.Operation):
     """
     In order to not account materialization during sorting in main process memory consumption, we delegate
-    sorting to a separate process.
+    sorting to a worker process taken from a persistent pool.
+    The worker buffers rows up to memory_limit bytes (measured by their serialized size), spills every sorted
+    buffer to a temporary file as a run and streams the k-way merge of the runs back.
+    Rows cross the pipe in both directions as pickled batches of batch_size rows, one message per batch.
+    Inputs of at most in_process_rows rows are sorted right in the main process.
+    With several workers the input is first stored to disk while a uniform sample of its keys is taken;
+    quantiles of the sample split the key range between workers, each worker sorts its range and
+    the sorted ranges are concatenated, so no single process merges the whole output.
     This class illustrates cross-process streaming.
     """
 
-    def __init__(self, keys: tp.Sequence[str]):
+    def __init__(self, keys: tp.Sequence[str], memory_limit: int = MEMORY_LIMIT,
+                 max_fan_in: int = MAX_FAN_IN, tmp_dir: str | None = None,
+                 batch_size: int = PIPE_BATCH_SIZE, in_process_rows: int = IN_PROCESS_ROWS,
+                 pool: WorkerPool | None = None, workers: int = 1):
+        """
+        :param keys: sorting keys
+        :param memory_limit: approximate number of bytes of rows to sort in memory before spilling a run
+        :param max_fan_in: maximum number of runs merged at once, more runs are merged in several passes
+        :param tmp_dir: directory for spilled runs, system default if None
+        :param batch_size: number of rows sent through the pipe in one message
+        :param in_process_rows: maximum number of rows sorted without a worker
+        :param pool: worker pool to use, process-wide default pool if None
+        :param workers: number of workers sorting key ranges in parallel
+        """
+        assert max_fan_in >= 2 and workers >= 1
         self.keys = keys
+        self.memory_limit = memory_limit
+        self.max_fan_in = max_fan_in
+        self.tmp_dir = tmp_dir
+        self.batch_size = batch_size
+        self.in_process_rows = in_process_rows
+        self.pool = pool
+        self.workers = workers
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any,
+                 **kwargs: tp.Any) -> ops.TRowsGenerator:
+        rows = iter(rows)
+        head = list(islice(rows, self.in_process_rows + 1))
+        if len(head) <= self.in_process_rows:
+            head.sort(key=itemgetter(*self.keys))
+            yield from head
+            return
+
+        pool = self.pool if self.pool is not None else default_pool()
+        if self.workers > 1:
+            yield from self._sample_sort(chain(head, rows), pool)
+            return
+        with pool.task(do_sort, tuple(self.keys), self.memory_limit, self.max_fan_in, self.tmp_dir,
+                       self.batch_size) as endpoint:
+            row_count_before = _send_batches(endpoint, chain(head, rows), self.batch_size)
+            head = []
+            row_count_after = 0
+            for batch, _ in _recv_batches(endpoint):
+                yield from batch
+                row_count_after += len(batch)
+            assert row_count_before == row_count_after
+
+    def _sample_sort(self, rows: tp.Iterable[ops.TRow], pool: WorkerPool) -> ops.TRowsGenerator:
+        key = itemgetter(*self.keys)
+        rnd = random.Random(0)
+        sample: list[tp.Any] = []
+        stored = _write_run(rows, self.tmp_dir)
+        try:
+            # Reservoir sampling over the stored input
+            for seen, row in enumerate(stored):
+                if seen < SAMPLE_SIZE:
+                    sample.append(key(row))
+                else:
+                    index = rnd.randint(0, seen)
+                    if index < SAMPLE_SIZE:
+                        sample[index] = key(row)
+            sample.sort()
+            boundaries = [sample[len(sample) * i // self.workers] for i in range(1, self.workers)]
+
+            with contextlib.ExitStack() as stack:
+                endpoints = [stack.enter_context(pool.task(do_sort, tuple(self.keys), self.memory_limit,
+                                                           self.max_fan_in, self.tmp_dir, self.batch_size))
+                             for _ in range(self.workers)]
+                row_count_before = _send_ranges(endpoints, stored, key, boundaries, self.batch_size)
+                row_count_after = 0
+                for endpoint in endpoints:
+                    for batch, _ in _recv_batches(endpoint):
+                        yield from batch
+                        row_count_after += len(batch)
+                assert row_count_before == row_count_after
+        finally:
+            stored.close()
+
+
+class GroupSort(ops.Operation):
+    """
+    Sort of rows already ordered by a prefix of the sorting keys: every group of rows equal on the prefix
+    is sorted on its own by the wrapped sort, so small groups never leave the main process
+    """
+
+    def __init__(self, sort: ExternalSort, prefix: tp.Sequence[str]) -> None:
+        """
+        :param sort: sort by all keys, applied to every group
+        :param prefix: leading keys the input is already ordered by
+        """
+        assert list(prefix) == list(sort.keys[:len(prefix)])
+        self.sort = sort
+        self.keys = sort.keys
+        self.prefix = prefix
 
     def __call__(self, rows: ops.TRowsIterable, *args: tp.Any,
                  **kwargs: tp.Any) -> ops.TRowsGenerator:
-        local_endpoint, remote_endpoint = Pipe()
-        process = Process(target=do_sort, args=(remote_endpoint, self.keys))
-        process.start()
-        row_count_before = 0
-        for row in rows:
-            local_endpoint.send(row)
-            row_count_before += 1
-        local_endpoint.send(None)
-        row_count_after = 0
-        while True:
-            local_endpoint_row = local_endpoint.recv()
-            if local_endpoint_row is None:
-                break
-            yield local_endpoint_row
-            row_count_after += 1
-        assert row_count_before == row_count_after
-        process.join()
+        for _, group in groupby(rows, key=itemgetter(*self.prefix)):
+            yield from self.sort(group)
@@ -0,0 +1,233 @@
+import threading
+import typing as tp
+from collections import deque
+
+from . import operations as ops
+from .operations.utils import SpillFile
+
+FANOUT_BUFFER_SIZE = 10000
+PREFETCH_BATCH_SIZE = 1024
+
+
+class _Channel:
+    """Rows pulled from the shared stream but not yet read by one particular consumer"""
+
+    def __init__(self, buffer_size: int) -> None:
+        self._buffer_size = buffer_size
+        self._pending: deque[ops.TRow] = deque()
+        self._batch: deque[ops.TRow] = deque()
+        self._spill: SpillFile | None = None
+        self._reader: tp.Iterator[list[ops.TRow]] | None = None
+        self._unread_batches = 0
+        self._size = 0
+        self.closed = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, row: ops.TRow) -> None:
+        self._pending.append(row)
+        self._size += 1
+        if len(self._pending) >= self._buffer_size:
+            if self._spill is None:
+                self._spill = SpillFile()
+            self._spill.write(self._stored(self._pending))
+            self._pending.clear()
+            self._unread_batches += 1
+
+    def pop(self) -> ops.TRow:
+        # Rows on disk are always older than the pending ones
+        if not self._batch and self._unread_batches:
+            assert self._spill is not None
+            if self._reader is None:
+                self._reader = self._spill.read_batches()
+            self._batch.extend(next(self._reader))
+            self._unread_batches -= 1
+            if not self._unread_batches:
+                self._spill.clear()
+                self._reader = None
+        self._size -= 1
+        if self._batch:
+            return self._batch.popleft()
+        return self._taken(self._pending.popleft())
+
+    def _stored(self, items: tp.Iterable[tp.Any]) -> list[ops.TRow]:
+        """Rows to spill for pending items, which are dropped from memory"""
+        return list(items)
+
+    def _taken(self, item: tp.Any) -> ops.TRow:
+        """Row to return for a pending item"""
+        return item
+
+    def _dropped(self, items: tp.Iterable[tp.Any]) -> None:
+        """Called with pending items left unread by a closed channel"""
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+        self._dropped(self._pending)
+        self._pending.clear()
+        self._batch.clear()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+class _Shared:
+    """Row left for several lagging consumers, copied on write: the last one to read it takes the row itself"""
+    __slots__ = ('row', 'holders')
+
+    def __init__(self, row: ops.TRow, holders: int) -> None:
+        self.row = row
+        self.holders = holders
+
+    def take(self) -> ops.TRow:
+        self.holders -= 1
+        return self.row if not self.holders else self.row.copy()
+
+    def release(self) -> None:
+        self.holders -= 1
+
+
+class _SharedChannel(_Channel):
+    """Channel of rows shared with other channels; rows are copied only when read by a consumer"""
+
+    def _stored(self, items: tp.Iterable[_Shared]) -> list[ops.TRow]:
+        # Pickling does not change the row, so it is written as it is and stays shared with other channels
+        rows = []
+        for shared in items:
+            rows.append(shared.row)
+            shared.release()
+        return rows
+
+    def _taken(self, item: _Shared) -> ops.TRow:
+        return item.take()
+
+    def _dropped(self, items: tp.Iterable[_Shared]) -> None:
+        for shared in items:
+            shared.release()
+
+
+class FanOut:
+    """
+    Shares one stream of rows between several consumers, so that the producing subgraph runs once.
+    Whichever consumer is ahead pulls the source and owns every row it pulls, the others share one
+    copy of the row which is copied again only for all of them but the last to read it; rows a lagging
+    consumer has not read yet are spilled to disk in batches of buffer_size rows.
+    """
+
+    def __init__(self, rows: ops.TRowsIterable, consumers: int,
+                 buffer_size: int = FANOUT_BUFFER_SIZE) -> None:
+        """
+        :param rows: shared stream
+        :param consumers: number of consumers that are going to read the stream
+        :param buffer_size: number of rows a consumer may lag behind in memory before spilling
+        """
+        self._rows = iter(rows)
+        self._channels = [_SharedChannel(buffer_size) for _ in range(consumers)]
+        self._claimed = 0
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    def consumer(self) -> ops.TRowsGenerator:
+        """Stream of all rows for the next consumer"""
+        assert self._claimed < len(self._channels)
+        channel = self._channels[self._claimed]
+        self._claimed += 1
+        return self._consume(channel)
+
+    def _consume(self, channel: _Channel) -> ops.TRowsGenerator:
+        try:
+            while True:
+                # Consumers may be pulled from different threads in pipeline mode
+                with self._lock:
+                    if channel:
+                        row = channel.pop()
+                    elif self._exhausted:
+                        return
+                    else:
+                        row = next(self._rows, None)
+                        if row is None:
+                            self._exhausted = True
+                            return
+                        others = [other for other in self._channels if other is not channel and not other.closed]
+                        if others:
+                            shared = _Shared(row.copy(), len(others))
+                            for other in others:
+                                other.push(shared)
+                yield row
+        finally:
+            with self._lock:
+                channel.close()
+
+
+class Prefetch:
+    """
+    Evaluates a stream in a background thread ahead of its consumer, starting as soon as it is created.
+    Rows the consumer has not read yet are kept in a channel which spills to disk in batches of
+    buffer_size rows, so the producer never waits for the consumer.
+    """
+
+    def __init__(self, rows: ops.TRowsIterable, buffer_size: int = FANOUT_BUFFER_SIZE,
+                 batch_size: int = PREFETCH_BATCH_SIZE) -> None:
+        """
+        :param rows: stream to evaluate
+        :param buffer_size: number of unread rows kept in memory before spilling
+        :param batch_size: number of rows handed over to the consumer at once
+        """
+        self._rows = rows
+        self._batch_size = batch_size
+        self._channel = _Channel(buffer_size)
+        self._ready = threading.Condition()
+        self._done = False
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _produce(self) -> None:
+        rows = iter(self._rows)
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == self._batch_size:
+                    if not self._hand_over(batch):
+                        return
+                    batch = []
+            self._hand_over(batch)
+        except BaseException as error:
+            self._error = error
+        finally:
+            close = getattr(rows, 'close', None)
+            if close is not None:
+                close()
+            with self._ready:
+                self._done = True
+                self._ready.notify()
+
+    def _hand_over(self, batch: list[ops.TRow]) -> bool:
+        with self._ready:
+            if self._channel.closed:
+                return False
+            for row in batch:
+                self._channel.push(row)
+            self._ready.notify()
+        return True
+
+    def rows(self) -> ops.TRowsGenerator:
+        """Stream of all rows, evaluated since the prefetch was created"""
+        try:
+            while True:
+                with self._ready:
+                    while not self._channel and not self._done:
+                        self._ready.wait()
+                    batch = [self._channel.pop() for _ in range(min(len(self._channel), self._batch_size))]
+                    if not batch and self._done:
+                        if self._error is not None:
+                            raise self._error
+                        return
+                yield from batch
+        finally:
+            with self._ready:
+                self._channel.close()
+            self._thread.join()
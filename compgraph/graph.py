@@ -1,7 +1,13 @@
+import copy
+import dataclasses
 import typing as tp
 
 from . import operations as ops
 from . import external_sort
+from .parallel import MAP_CHUNK_SIZE, PARTITIONABLE, ParallelMap, Partitioned
+from .fanout import FanOut, Prefetch
+from .optimizer import Plan
+from .pipeline import Pipeline
 
 
 class Graph:
@@ -18,59 +24,221 @@ class Graph:
         graph._parents = graphs
         return graph
 
+    @property
+    def operation(self) -> ops.Operation | None:
+        """Operation of the last node, None for an empty graph"""
+        return self.__operation
+
     @staticmethod
     def graph_from_iter(name: str) -> 'Graph':
         """Construct new graph which reads data from row iterator (in form of sequence of Rows
         from 'kwargs' passed to 'run' method) into graph data-flow
-        Use ops.ReadIterFactory
+        Use ops.ReadIterFactory, which makes a shallow copy of every row, so rows of the caller are left as they
+        are and may be read again by later runs
         :param name: name of kwarg to use as data source
         """
         return Graph._graph_maker(ops.ReadIterFactory(name))
 
     @staticmethod
     def graph_from_file(filename: str,
-                        parser: tp.Callable[[str], ops.TRow]) -> 'Graph':
+                        parser: tp.Callable[[str], ops.TRow],
+                        schema: tp.Sequence[str] | None = None) -> 'Graph':
         """Construct new graph extended with operation for reading rows from file
         Use ops.Read
         :param filename: filename to read from
         :param parser: parser from string to Row
+        :param schema: columns of the rows, which are then kept as ops.CompactRow taking less memory than dicts
         """
-        return Graph._graph_maker(ops.Read(filename, parser))
+        return Graph._graph_maker(ops.Read(filename, parser, schema))
 
-    def map(self, mapper: ops.Mapper) -> 'Graph':
+    def map(self, mapper: ops.Mapper, parallel: int = 1, chunk_size: int = MAP_CHUNK_SIZE,
+            ordered: bool = True) -> 'Graph':
         """Construct new graph extended with map operation with particular mapper
         :param mapper: mapper to use
+        :param parallel: number of worker processes to map rows in, the main process maps them if 1
+        :param chunk_size: number of rows sent to a worker at once
+        :param ordered: keep the input order of rows, otherwise chunks come in order of completion
         """
+        if parallel > 1:
+            return Graph._graph_maker(ParallelMap(mapper, parallel, chunk_size, ordered), [self])
         return Graph._graph_maker(ops.Map(mapper), [self])
 
-    def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str]) -> 'Graph':
+    def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str],
+               strategy: str = 'sort', combine: bool = False) -> 'Graph':
         """Construct new graph extended with reduce operation with particular reducer
         :param reducer: reducer to use
         :param keys: keys for grouping
+        :param strategy: 'sort' expects rows sorted by keys and emits groups in that order,
+            'hash' accepts unsorted rows and emits groups unsorted
+        :param combine: pre-aggregate rows with algebraic reducer before the sort this graph ends with
+            (or right before reduce if it does not end with a sort)
+        """
+        assert strategy in ('sort', 'hash')
+        source = self
+        if combine:
+            if isinstance(self.__operation, external_sort.ExternalSort):
+                source = Graph._graph_maker(self.__operation, [self._parents[0].combine(reducer, keys)])
+            else:
+                source = self.combine(reducer, keys)
+        if strategy == 'hash':
+            return Graph._graph_maker(ops.HashReduce(reducer, keys), [source])
+        return Graph._graph_maker(ops.Reduce(reducer, keys), [source])
+
+    def combine(self, reducer: ops.Reducer, keys: tp.Sequence[str],
+                max_groups: int = ops.reduce.COMBINE_MAX_GROUPS) -> 'Graph':
+        """Construct new graph extended with partial aggregation of rows, which reduce with
+        the same reducer and keys finishes
+        :param reducer: algebraic reducer to use
+        :param keys: keys for grouping
+        :param max_groups: maximum number of groups aggregated in memory at once
         """
-        return Graph._graph_maker(ops.Reduce(reducer, keys), [self])
+        assert isinstance(reducer, ops.AlgebraicReducer)
+        return Graph._graph_maker(ops.Combine(reducer, keys, max_groups), [self])
 
-    def sort(self, keys: tp.Sequence[str]) -> 'Graph':
+    def sort(self, keys: tp.Sequence[str],
+             memory_limit: int = external_sort.MEMORY_LIMIT,
+             in_process_rows: int = external_sort.IN_PROCESS_ROWS, workers: int = 1) -> 'Graph':
         """Construct new graph extended with sort operation
         :param keys: sorting keys (typical is tuple of strings)
+        :param memory_limit: approximate size in bytes of rows sorted in memory before spilling to disk
+        :param in_process_rows: inputs of at most this many rows are sorted without a worker process
+        :param workers: number of worker processes sorting key ranges of the input in parallel
         """
-        return Graph._graph_maker(external_sort.ExternalSort(keys), [self])
+        return Graph._graph_maker(external_sort.ExternalSort(keys, memory_limit, in_process_rows=in_process_rows,
+                                                             workers=workers), [self])
 
     def join(self, joiner: ops.Joiner, join_graph: 'Graph',
-             keys: tp.Sequence[str]) -> 'Graph':
+             keys: tp.Sequence[str], strategy: str | None = None) -> 'Graph':
         """Construct new graph extended with join operation with another graph
         :param joiner: join strategy to use
         :param join_graph: other graph to join with
         :param keys: keys for grouping
+        :param strategy: 'sort' expects both graphs sorted by keys and emits rows in that order,
+            'hash' builds a hash table on join_graph, accepts unsorted rows and emits them unsorted,
+            'broadcast' keeps the whole (small) join_graph in memory and attaches it to rows of this graph
+            in their order, a join_graph too large for that is joined as by 'hash';
+            by default joins with empty keys are broadcast and others sort
         """
+        if strategy is None:
+            strategy = 'broadcast' if not keys else 'sort'
+        assert strategy in ('sort', 'hash', 'broadcast')
+        if strategy == 'broadcast':
+            return Graph._graph_maker(ops.BroadcastJoin(joiner, keys), [self, join_graph])
+        if strategy == 'hash':
+            return Graph._graph_maker(ops.HashJoin(joiner, keys), [self, join_graph])
         return Graph._graph_maker(ops.Join(joiner, keys), [self, join_graph])
 
-    def run(self, **kwargs: tp.Any) -> ops.TRowsIterable:
-        """Single method to start execution; data sources passed as kwargs"""
-        if self.__operation is not None:
-            if len(self._parents) == 2:
-                yield from self.__operation(self._parents[0].run(**kwargs), self._parents[1].run(**kwargs))
-            elif len(self._parents) == 1:
-                yield from self.__operation(self._parents[0].run(**kwargs))
-            else:
-                yield from self.__operation(**kwargs)
+    def explain(self) -> str:
+        """Describe the plan run executes: operations from the last one to the sources, the columns rows
+        of each are ordered by and which sorts are dropped or narrowed since their input is already ordered
+        """
+        return Plan(self).explain()
+
+    def run(self, *, workers: int = 1, pipeline: Pipeline | None = None, concurrent: bool = False,
+            **kwargs: tp.Any) -> ops.TRowsIterable:
+        """Single method to start execution; data sources passed as kwargs.
+        Graph is executed as a DAG: nodes shared by several consumers run once and fan out their rows.
+        Sorts of rows which are already ordered are dropped or narrowed first, see explain
+        :param workers: number of processes keyed reduces and joins (with mappers right after them)
+            are partitioned across and sorts split their key ranges between;
+            the result is the same as of a sequential run
+        :param pipeline: run every operation in its own thread connected to the next one by a bounded queue,
+            stats of its stages are collected in pipeline.stats
+        :param concurrent: evaluate inputs of joins concurrently, every input in a background thread started
+            before the join reads any of them, which buffers rows the join has not read yet
+        """
+        assert workers >= 1
+        graph = Plan(self).graph
+        consumers: dict[Graph, int] = {}
+        graph._count_consumers(consumers)
+        if workers > 1:
+            graph = graph._partitioned(workers, consumers, {})
+            consumers = {}
+            graph._count_consumers(consumers)
+        graph = graph._fused(consumers, {})
+        consumers = {}
+        graph._count_consumers(consumers)
+        if pipeline is not None:
+            pipeline.stats = []
+        yield from graph._stream(_Execution(kwargs, consumers, {}, pipeline, concurrent))
+
+    def _partitioned(self, workers: int, consumers: dict['Graph', int],
+                     rewritten: dict['Graph', 'Graph']) -> 'Graph':
+        if self in rewritten:
+            return rewritten[self]
+        parents = [parent._partitioned(workers, consumers, rewritten) for parent in self._parents]
+        operation = self.__operation
+        if (isinstance(operation, PARTITIONABLE) and not isinstance(operation, ops.BroadcastJoin)
+                and operation.keys):
+            graph = Graph._graph_maker(Partitioned(operation, operation.keys, workers), parents)
+        elif (isinstance(operation, ops.Map) and isinstance(parents[0].__operation, Partitioned)
+                and consumers[self._parents[0]] == 1):
+            graph = Graph._graph_maker(parents[0].__operation.then(operation.mapper), parents[0]._parents)
+        elif isinstance(operation, external_sort.ExternalSort) and operation.workers < workers:
+            operation = copy.copy(operation)
+            operation.workers = workers
+            graph = Graph._graph_maker(operation, parents)
+        else:
+            graph = Graph()
+            graph.__operation = operation
+            graph._parents = parents
+        rewritten[self] = graph
+        return graph
+
+    def _fused(self, consumers: dict['Graph', int], rewritten: dict['Graph', 'Graph']) -> 'Graph':
+        # Chains of maps, whose intermediate results nobody else reads, run as one FusedMap
+        if self in rewritten:
+            return rewritten[self]
+        parents = [parent._fused(consumers, rewritten) for parent in self._parents]
+        operation = self.__operation
+        if (isinstance(operation, ops.Map) and isinstance(parents[0].__operation, (ops.Map, ops.FusedMap))
+                and consumers[self._parents[0]] == 1):
+            parent_operation = parents[0].__operation
+            mappers = parent_operation.mappers if isinstance(parent_operation, ops.FusedMap) \
+                else [parent_operation.mapper]
+            operation = ops.FusedMap(mappers + [operation.mapper])
+            parents = parents[0]._parents
+        graph = Graph()
+        graph.__operation = operation
+        graph._parents = parents
+        rewritten[self] = graph
+        return graph
+
+    def _count_consumers(self, consumers: dict['Graph', int]) -> None:
+        for parent in self._parents:
+            visited = parent in consumers
+            consumers[parent] = consumers.get(parent, 0) + 1
+            if not visited:
+                parent._count_consumers(consumers)
+
+    def _stream(self, execution: '_Execution') -> ops.TRowsIterable:
+        if execution.consumers.get(self, 1) == 1:
+            return self._execute(execution)
+        if self not in execution.fanouts:
+            execution.fanouts[self] = FanOut(self._execute(execution), execution.consumers[self])
+        return execution.fanouts[self].consumer()
+
+    def _execute(self, execution: '_Execution') -> ops.TRowsIterable:
+        if self.__operation is None:
+            return iter(())
+        if not self._parents:
+            rows = self.__operation(**execution.kwargs)
+        else:
+            inputs = [parent._stream(execution) for parent in self._parents]
+            if execution.concurrent and len(inputs) > 1:
+                # All threads start here: a join waiting for the first row of one input does not hold back the others
+                inputs = [Prefetch(stream).rows() for stream in inputs]
+            rows = self.__operation(*inputs)
+        if execution.pipeline is not None:
+            return execution.pipeline.stage(self.__operation, rows)
+        return rows
+
+
+@dataclasses.dataclass
+class _Execution:
+    """State of one run of a graph"""
+    kwargs: dict[str, tp.Any]
+    consumers: dict[Graph, int]
+    fanouts: dict[Graph, FanOut]
+    pipeline: Pipeline | None
+    concurrent: bool
@@ -1,16 +1,25 @@
 import typing as tp
-from .abstract import Operation, Read, ReadIterFactory, Mapper, Reducer, Joiner
-from .join import Join, InnerJoiner, OuterJoiner, LeftJoiner, RightJoiner
-from .map import Map, DummyMapper, Divide, Log, FilterPunctuation, LowerCase, Split, Product, \
-                 Filter, Project, WeekHour, HaversineDistance
-from .reduce import Reduce, FirstReducer, Speed, CountUnique, TopN, TermFrequency,  Count, Sum
+from .abstract import Operation, Read, ReadIterFactory, Mapper, Reducer, AlgebraicReducer, Joiner, \
+                      PARTIAL_STATE
+from .batch import RecordBatch, ColumnPredicate
+from .expressions import Expression, col, lit, length
+from .fusion import FusedMap
+from .join import Join, HashJoin, BroadcastJoin, InnerJoiner, OuterJoiner, LeftJoiner, RightJoiner
+from .map import Map, DummyMapper, Divide, Log, FilterPunctuation, LowerCase, Split, Tokenize, Product, \
+                 Filter, Project, Retain, Compute, WeekHour, HaversineDistance
+from .rows import CompactRow, compact_row_type
+from .reduce import Reduce, HashReduce, Combine, FirstReducer, Speed, CountUnique, TopN, TermFrequency, \
+                    Count, Sum
 
 
-__all__ = ['Operation', 'Read', 'ReadIterFactory', 'Mapper', 'Reducer', 'Joiner',
-           'Reduce', 'FirstReducer', 'Speed', 'CountUnique', 'TopN', 'TermFrequency', 'Count', 'Sum',
-           'Map', 'DummyMapper', 'Divide', 'Log', 'FilterPunctuation', 'LowerCase', 'Split', 'Product',
-           'Filter', 'Project',  'WeekHour',  'HaversineDistance',
-           'Join', 'InnerJoiner', 'OuterJoiner', 'LeftJoiner', 'RightJoiner']
+__all__ = ['Operation', 'Read', 'ReadIterFactory', 'Mapper', 'Reducer', 'AlgebraicReducer', 'Joiner',
+           'PARTIAL_STATE', 'RecordBatch', 'ColumnPredicate', 'Expression', 'col', 'lit', 'length',
+           'Reduce', 'HashReduce', 'Combine', 'FirstReducer', 'Speed', 'CountUnique', 'TopN', 'TermFrequency',
+           'Count', 'Sum',
+           'Map', 'DummyMapper', 'Divide', 'Log', 'FilterPunctuation', 'LowerCase', 'Split', 'Tokenize', 'Product',
+           'Filter', 'Project', 'Retain', 'Compute', 'WeekHour',  'HaversineDistance', 'FusedMap',
+           'Join', 'HashJoin', 'BroadcastJoin', 'InnerJoiner', 'OuterJoiner', 'LeftJoiner', 'RightJoiner',
+           'CompactRow', 'compact_row_type']
 
 TRow = dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
@@ -1,12 +1,31 @@
 from abc import abstractmethod, ABC
 import typing as tp
+from itertools import islice, repeat
+from operator import contains
+
+from .rows import compact_row_type
 
 TRow = tp.Dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+# Column holding the state of a partially aggregated group in rows emitted by Combine
+PARTIAL_STATE = '__partial_state__'
+
+JOIN_MAX_GROUP_SIZE = 100000
+REDUCE_BATCH_SIZE = 1024
+
 
 class Operation(ABC):
+    """
+    Base class for operations.
+    Rows are owned by the operation they are passed to: it may change them and emit them again instead of
+    copies. Rows an operation emits are owned by its consumer, so operations copy a row only to emit it
+    more than once (FanOut does it for nodes shared by several consumers). Sources are the exception:
+    ReadIterFactory makes one shallow copy of every row of the caller, whose dicts are thus never changed,
+    while values inside them are shared and must not be changed in place
+    """
+
     @abstractmethod
     def __call__(self, rows: TRowsIterable, *args: tp.Any,
                  **kwargs: tp.Any) -> TRowsGenerator:
@@ -14,7 +33,7 @@ class Operation(ABC):
 
 
 class Mapper(ABC):
-    """Base class for mappers"""
+    """Base class for mappers, which own the rows passed to them as operations do"""
 
     @abstractmethod
     def __call__(self, row: TRow) -> TRowsGenerator:
@@ -23,10 +42,37 @@ class Mapper(ABC):
         """
         pass
 
+    def reads(self) -> tp.Collection[str] | None:
+        """Columns the mapper uses, None if unknown"""
+        return None
+
+    def writes(self) -> tp.Collection[str] | None:
+        """Columns the mapper may set or change, None if unknown"""
+        return None
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        """Map several rows at once, Map uses it when a mapper overrides it
+        :param rows: table rows, may be modified in place
+        :return: rows the mapper yields for all rows of the batch, in order
+        """
+        return [result for row in rows for result in self(row)]
+
+    def map_columns(self, batch: tp.Any) -> tp.Any:
+        """Map a RecordBatch with array operations, keeping its rows
+        :param batch: columnar view of table rows
+        :return: mapped batch or None if the mapper or these columns can not be vectorized
+        """
+        return None
+
 
 class Reducer(ABC):
     """Base class for reducers"""
 
+    def reads(self) -> tp.Collection[str] | None:
+        """Columns of the group rows the reducer uses besides the keys,
+        None if unknown or if it emits the rows themselves"""
+        return None
+
     @abstractmethod
     def __call__(self, group_key: tp.Tuple[str, ...],
                  rows: TRowsIterable) -> TRowsGenerator:
@@ -36,12 +82,112 @@ class Reducer(ABC):
         pass
 
 
+class AlgebraicReducer(Reducer):
+    """
+    Base class for reducers whose result is computed from a mergeable state of the group.
+    State is built row by row with update and states of two parts of a group are combined with merge,
+    so groups can be aggregated partially (in hash tables, combiners or partitions) and finished later
+    """
+
+    @abstractmethod
+    def init(self) -> tp.Any:
+        """State of an empty group"""
+        pass
+
+    @abstractmethod
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        """
+        :param state: state of the group, may be modified in place
+        :param row: next table row of the group
+        :return: state including row
+        """
+        pass
+
+    @abstractmethod
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        """
+        :param state_a: state of one part of the group, may be modified in place
+        :param state_b: state of another part of the group
+        :return: state of both parts
+        """
+        pass
+
+    @abstractmethod
+    def finalize(self, key_row: TRow, state: tp.Any) -> TRowsGenerator:
+        """
+        :param key_row: values of group key columns, owned by the reducer
+        :param state: state of the whole group
+        """
+        pass
+
+    def update_batch(self, state: tp.Any, rows: list[TRow]) -> tp.Any:
+        """
+        :param state: state of the group, may be modified in place
+        :param rows: next table rows of the group
+        :return: state including rows
+        """
+        for row in rows:
+            state = self.update(state, row)
+        return state
+
+    def fold(self, state: tp.Any, row: TRow) -> tp.Any:
+        """Update state with a table row or merge the partial state carried by a row from Combine"""
+        if PARTIAL_STATE in row:
+            return self.merge(state, row[PARTIAL_STATE])
+        return self.update(state, row)
+
+    def fold_batch(self, state: tp.Any, rows: list[TRow]) -> tp.Any:
+        """Fold rows in order, passing runs of table rows to update_batch"""
+        if not any(map(contains, rows, repeat(PARTIAL_STATE))):
+            return self.update_batch(state, rows)
+        start = 0
+        for i, row in enumerate(rows):
+            if PARTIAL_STATE in row:
+                if start < i:
+                    state = self.update_batch(state, rows[start:i])
+                state = self.merge(state, row[PARTIAL_STATE])
+                start = i + 1
+        if start < len(rows):
+            state = self.update_batch(state, rows[start:])
+        return state
+
+    def __call__(self, group_key: tp.Tuple[str, ...],
+                 rows: TRowsIterable) -> TRowsGenerator:
+        rows = iter(rows)
+        batch = list(islice(rows, REDUCE_BATCH_SIZE))
+        if not batch:
+            yield from self.finalize({}, self.init())
+            return
+        key_row = {col: batch[0][col] for col in group_key}
+        if len(batch) == 1:
+            # Batch machinery costs more than it saves on single-row groups
+            yield from self.finalize(key_row, self.fold(self.init(), batch[0]))
+            return
+        state = self.fold_batch(self.init(), batch)
+        while len(batch) == REDUCE_BATCH_SIZE:
+            batch = list(islice(rows, REDUCE_BATCH_SIZE))
+            if batch:
+                state = self.fold_batch(state, batch)
+        yield from self.finalize(key_row, state)
+
+
 class Joiner(ABC):
     """Base class for joiners"""
 
-    def __init__(self, suffix_a: str = '_1', suffix_b: str = '_2') -> None:
+    def __init__(self, suffix_a: str = '_1', suffix_b: str = '_2',
+                 max_group_size: int = JOIN_MAX_GROUP_SIZE) -> None:
+        """
+        :param suffix_a: suffix for left table columns colliding with right table ones
+        :param suffix_b: suffix for right table columns colliding with left table ones
+        :param max_group_size: key groups with more rows are spilled to disk instead of kept in memory
+        """
         self._a_suffix = suffix_a
         self._b_suffix = suffix_b
+        self.max_group_size = max_group_size
+        # Number of key groups spilled to disk because of max_group_size
+        self.spilled_groups = 0
+        # Row merge plans by join keys and schemas of both rows, last used one under None; see join.py
+        self._merge_plans: dict[tp.Any, tp.Any] = {}
 
     @abstractmethod
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable,
@@ -56,18 +202,31 @@ class Joiner(ABC):
 
 class Read(Operation):
     def __init__(self, filename: str,
-                 parser: tp.Any) -> None:
+                 parser: tp.Any, schema: tp.Sequence[str] | None = None) -> None:
+        """
+        :param filename: filename to read from
+        :param parser: parser from string to row or list of rows
+        :param schema: columns of compact rows to make of parsed rows, parsed rows are kept if None
+        """
         self.filename = filename
         self.parser = parser
+        self.schema = schema
 
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
         with open(self.filename) as f:
-            for line in f:
-                row = self.parser(line)
-                if isinstance(row, list):  # mypy думает, что такое не может быть
-                    yield from row
-                else:
-                    yield row
+            rows = self._parse(f)
+            if self.schema is None:
+                yield from rows
+            else:
+                yield from map(compact_row_type(self.schema).from_row, rows)
+
+    def _parse(self, lines: tp.Iterable[str]) -> TRowsGenerator:
+        for line in lines:
+            row = self.parser(line)
+            if isinstance(row, list):  # mypy думает, что такое не может быть
+                yield from row
+            else:
+                yield row
 
 
 class ReadIterFactory(Operation):
@@ -75,5 +234,6 @@ class ReadIterFactory(Operation):
         self.name = name
 
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        # Shallow copies: operations set and delete columns of their rows, not change values in place
         for row in kwargs[self.name]():
-            yield row
+            yield dict(row)
@@ -0,0 +1,128 @@
+import operator
+import typing as tp
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+TRow = tp.Dict[str, tp.Any]
+
+# Batches smaller than this are mapped row by row, array conversions do not pay off on them.
+# Cheap arithmetic does not pay for the conversions either, mappers doing it map single batches row by row
+VECTORIZE_MIN_ROWS = 64
+
+
+def vectorized(rows: list[TRow]) -> bool:
+    """Whether a batch of rows should go through the columnar path"""
+    return np is not None and len(rows) >= VECTORIZE_MIN_ROWS
+
+
+def is_numeric(values: tp.Any) -> bool:
+    """Whether an array holds plain numbers (and not Python objects numpy could not type)"""
+    return values.dtype.kind in 'biuf'
+
+
+class RecordBatch:
+    """
+    Columnar view of a list of rows.
+    A column is extracted to a NumPy array the first time it is used; columns set on the batch stay arrays
+    until to_rows writes them back, so consecutive vectorized operations do not touch the dicts.
+    A batch lives within one map_batch call or one columnar run of mappers of FusedMap: operations pass
+    rows to each other, so reducers and joins get rows (algebraic reducers fold them with update_batch).
+    Without NumPy columns are plain lists
+    """
+
+    def __init__(self, rows: list[TRow]) -> None:
+        """
+        :param rows: rows of the batch, to_rows updates them in place
+        """
+        self._rows = rows
+        self._columns: dict[str, tp.Any] = {}
+        self._computed: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def column(self, name: str) -> tp.Any:
+        """Values of a column of all rows"""
+        values = self._columns.get(name)
+        if values is None:
+            values = [row[name] for row in self._rows]
+            if np is not None:
+                values = np.asarray(values)
+            self._columns[name] = values
+        return values
+
+    def has_column(self, name: str) -> bool | None:
+        """Whether all rows have a column, None if only some of them have it"""
+        if name in self._columns:
+            return True
+        present = sum(name in row for row in self._rows)
+        if present == 0:
+            return False
+        return True if present == len(self._rows) else None
+
+    def set_column(self, name: str, values: tp.Any) -> None:
+        """Set a column of all rows, rows themselves are updated by to_rows"""
+        assert len(values) == len(self._rows)
+        self._columns[name] = values
+        if name not in self._computed:
+            self._computed.append(name)
+
+    def filter(self, mask: tp.Any) -> 'RecordBatch':
+        """Batch of rows for which mask is true"""
+        keep = np.flatnonzero(mask).tolist() if np is not None else [i for i, value in enumerate(mask) if value]
+        if len(keep) == len(self._rows):
+            return self
+        batch = RecordBatch([self._rows[i] for i in keep])
+        for name, values in self._columns.items():
+            batch._columns[name] = values[keep] if np is not None else [values[i] for i in keep]
+        batch._computed = self._computed
+        return batch
+
+    def to_rows(self) -> list[TRow]:
+        """Rows of the batch with all set columns written to them"""
+        for name in self._computed:
+            values = self._columns[name]
+            for row, value in zip(self._rows, values.tolist() if np is not None else values):
+                row[name] = value
+        self._computed = []
+        return self._rows
+
+
+class ColumnPredicate:
+    """
+    Comparison of a column with a constant, usable as Filter condition.
+    Filter evaluates it over whole batches of numeric columns at once
+    """
+    OPERATORS: dict[str, tp.Callable[[tp.Any, tp.Any], tp.Any]] = {
+        '<': operator.lt, '<=': operator.le, '==': operator.eq,
+        '!=': operator.ne, '>': operator.gt, '>=': operator.ge,
+    }
+
+    def __init__(self, column: str, op: str, value: tp.Any) -> None:
+        """
+        :param column: column to compare
+        :param op: one of <, <=, ==, !=, >, >=
+        :param value: constant to compare with
+        """
+        self.column = column
+        self.op = op
+        self.value = value
+        self._compare = self.OPERATORS[op]
+
+    @property
+    def columns(self) -> tuple[str]:
+        """Columns the predicate uses"""
+        return (self.column,)
+
+    def __call__(self, row: TRow) -> bool:
+        return bool(self._compare(row[self.column], self.value))
+
+    def mask(self, batch: RecordBatch) -> tp.Any:
+        """Boolean array of the predicate over all rows of the batch, None if it can not be vectorized"""
+        values = batch.column(self.column)
+        if not is_numeric(values):
+            return None
+        return self._compare(values, self.value)
@@ -0,0 +1,351 @@
+import math
+import operator
+import typing as tp
+from abc import ABC, abstractmethod
+
+from .batch import RecordBatch, np
+
+TRow = tp.Dict[str, tp.Any]
+
+# Integers at most this large in absolute value can be added, subtracted and multiplied as int64 arrays
+# without overflowing, where Python integers would grow
+INT_SAFE_LIMIT = 2 ** 31
+
+
+def _kind(value: tp.Any) -> str:
+    # NumPy kind of an array or of a Python scalar
+    if np is not None and isinstance(value, np.ndarray):
+        return str(value.dtype.kind)
+    if isinstance(value, bool):
+        return 'b'
+    if isinstance(value, int):
+        return 'i'
+    if isinstance(value, float):
+        return 'f'
+    if isinstance(value, str):
+        return 'U'
+    return 'O'
+
+
+def _small_ints(value: tp.Any) -> bool:
+    if _kind(value) != 'i':
+        return True
+    if isinstance(value, int):
+        return abs(value) < INT_SAFE_LIMIT
+    return len(value) == 0 or int(np.abs(value).max()) < INT_SAFE_LIMIT
+
+
+class Expression(ABC):
+    """
+    Expression over columns of a row, built from col, lit and length with arithmetic (+ - * / %),
+    comparisons and boolean operators (& | ~, as and, or, not can not be overloaded).
+    Calling an expression on a row evaluates it with Python code generated once for the whole expression;
+    evaluate computes it over all rows of a RecordBatch at once with NumPy where types allow.
+    Expressions know the columns they use and pickle without the generated code
+    """
+    __hash__ = None  # type: ignore
+
+    def __init__(self) -> None:
+        self._compiled: tp.Callable[[TRow], tp.Any] | None = None
+
+    @property
+    @abstractmethod
+    def columns(self) -> frozenset[str]:
+        """Columns the expression uses"""
+        pass
+
+    @abstractmethod
+    def source(self, namespace: dict[str, tp.Any]) -> str:
+        """
+        Python code of the expression over a dict named row
+        :param namespace: globals of the code, constants are added to it
+        """
+        pass
+
+    @abstractmethod
+    def evaluate(self, batch: RecordBatch) -> tp.Any:
+        """Array of the values of the expression for all rows of the batch (or a scalar for constants),
+        None if it can not be vectorized"""
+        pass
+
+    def __call__(self, row: TRow) -> tp.Any:
+        if self._compiled is None:
+            namespace: dict[str, tp.Any] = {}
+            self._compiled = eval(f'lambda row: {self.source(namespace)}', namespace)
+        return self._compiled(row)
+
+    def mask(self, batch: RecordBatch) -> tp.Any:
+        """Boolean array of the expression as a condition over all rows of the batch, None if it can not be
+        vectorized"""
+        values = self.evaluate(batch)
+        if values is None or _kind(values) != 'b' or np.shape(values) != (len(batch),):
+            return None
+        return values
+
+    def __getstate__(self) -> dict[str, tp.Any]:
+        return {**self.__dict__, '_compiled': None}
+
+    def __bool__(self) -> bool:
+        raise TypeError('Expression has no truth value, combine conditions with &, | and ~')
+
+    def __add__(self, other: tp.Any) -> 'Expression':
+        return Binary('+', self, other)
+
+    def __radd__(self, other: tp.Any) -> 'Expression':
+        return Binary('+', other, self)
+
+    def __sub__(self, other: tp.Any) -> 'Expression':
+        return Binary('-', self, other)
+
+    def __rsub__(self, other: tp.Any) -> 'Expression':
+        return Binary('-', other, self)
+
+    def __mul__(self, other: tp.Any) -> 'Expression':
+        return Binary('*', self, other)
+
+    def __rmul__(self, other: tp.Any) -> 'Expression':
+        return Binary('*', other, self)
+
+    def __truediv__(self, other: tp.Any) -> 'Expression':
+        return Binary('/', self, other)
+
+    def __rtruediv__(self, other: tp.Any) -> 'Expression':
+        return Binary('/', other, self)
+
+    def __mod__(self, other: tp.Any) -> 'Expression':
+        return Binary('%', self, other)
+
+    def __rmod__(self, other: tp.Any) -> 'Expression':
+        return Binary('%', other, self)
+
+    def __neg__(self) -> 'Expression':
+        return Unary('-', self)
+
+    def __lt__(self, other: tp.Any) -> 'Expression':
+        return Binary('<', self, other)
+
+    def __le__(self, other: tp.Any) -> 'Expression':
+        return Binary('<=', self, other)
+
+    def __gt__(self, other: tp.Any) -> 'Expression':
+        return Binary('>', self, other)
+
+    def __ge__(self, other: tp.Any) -> 'Expression':
+        return Binary('>=', self, other)
+
+    def __eq__(self, other: tp.Any) -> 'Expression':  # type: ignore
+        return Binary('==', self, other)
+
+    def __ne__(self, other: tp.Any) -> 'Expression':  # type: ignore
+        return Binary('!=', self, other)
+
+    def __and__(self, other: tp.Any) -> 'Expression':
+        return Binary('&', self, other)
+
+    def __rand__(self, other: tp.Any) -> 'Expression':
+        return Binary('&', other, self)
+
+    def __or__(self, other: tp.Any) -> 'Expression':
+        return Binary('|', self, other)
+
+    def __ror__(self, other: tp.Any) -> 'Expression':
+        return Binary('|', other, self)
+
+    def __invert__(self) -> 'Expression':
+        return Unary('~', self)
+
+
+def _expression(value: tp.Any) -> Expression:
+    return value if isinstance(value, Expression) else Constant(value)
+
+
+class Column(Expression):
+    """Value of a column"""
+
+    def __init__(self, name: str) -> None:
+        """
+        :param name: name of the column
+        """
+        super().__init__()
+        self.name = name
+
+    @property
+    def columns(self) -> frozenset[str]:
+        return frozenset((self.name,))
+
+    def source(self, namespace: dict[str, tp.Any]) -> str:
+        return f'row[{self.name!r}]'
+
+    def evaluate(self, batch: RecordBatch) -> tp.Any:
+        if np is None:
+            return None
+        values = batch.column(self.name)
+        return values if values.ndim == 1 and _kind(values) in 'biufU' else None
+
+    def __repr__(self) -> str:
+        return f'col({self.name!r})'
+
+
+class Constant(Expression):
+    """Constant value"""
+
+    def __init__(self, value: tp.Any) -> None:
+        """
+        :param value: the value
+        """
+        super().__init__()
+        self.value = value
+
+    @property
+    def columns(self) -> frozenset[str]:
+        return frozenset()
+
+    def source(self, namespace: dict[str, tp.Any]) -> str:
+        value = self.value
+        if isinstance(value, (bool, int, str)) or value is None or (isinstance(value, float) and math.isfinite(value)):
+            return repr(value)
+        name = f'_value{len(namespace)}'
+        while name in namespace:
+            name += '_'
+        namespace[name] = self.value
+        return name
+
+    def evaluate(self, batch: RecordBatch) -> tp.Any:
+        return self.value if _kind(self.value) in 'bifU' else None
+
+    def __repr__(self) -> str:
+        return f'lit({self.value!r})'
+
+
+class Length(Expression):
+    """Length of a string"""
+
+    def __init__(self, operand: tp.Any) -> None:
+        """
+        :param operand: expression of the string
+        """
+        super().__init__()
+        self.operand = _expression(operand)
+
+    @property
+    def columns(self) -> frozenset[str]:
+        return self.operand.columns
+
+    def source(self, namespace: dict[str, tp.Any]) -> str:
+        return f'len({self.operand.source(namespace)})'
+
+    def evaluate(self, batch: RecordBatch) -> tp.Any:
+        values = self.operand.evaluate(batch)
+        if values is None or _kind(values) != 'U' or np.ndim(values) != 1:
+            return None
+        return np.char.str_len(values)
+
+    def __repr__(self) -> str:
+        return f'length({self.operand!r})'
+
+
+class Unary(Expression):
+    """Negation of a number (-) or of a condition (~)"""
+    TEMPLATES = {'-': '(-{})', '~': '(not {})'}
+
+    def __init__(self, op: str, operand: tp.Any) -> None:
+        """
+        :param op: - or ~
+        :param operand: expression to negate
+        """
+        assert op in self.TEMPLATES
+        super().__init__()
+        self.op = op
+        self.operand = _expression(operand)
+
+    @property
+    def columns(self) -> frozenset[str]:
+        return self.operand.columns
+
+    def source(self, namespace: dict[str, tp.Any]) -> str:
+        return self.TEMPLATES[self.op].format(self.operand.source(namespace))
+
+    def evaluate(self, batch: RecordBatch) -> tp.Any:
+        values = self.operand.evaluate(batch)
+        if values is None:
+            return None
+        if self.op == '~':
+            return np.logical_not(values) if _kind(values) == 'b' else None
+        if _kind(values) not in 'if' or not _small_ints(values):
+            return None
+        return -values
+
+    def __repr__(self) -> str:
+        return f'{self.op}{self.operand!r}'
+
+
+class Binary(Expression):
+    """Arithmetic, comparison or boolean operation on two expressions"""
+    ARITHMETIC = {'+': operator.add, '-': operator.sub, '*': operator.mul,
+                  '/': operator.truediv, '%': operator.mod}
+    COMPARISONS = {'<': operator.lt, '<=': operator.le, '==': operator.eq,
+                   '!=': operator.ne, '>': operator.gt, '>=': operator.ge}
+    BOOLEAN = {'&': 'and', '|': 'or'}
+
+    def __init__(self, op: str, left: tp.Any, right: tp.Any) -> None:
+        """
+        :param op: one of + - * / %, < <= == != > >=, & |
+        :param left: left operand, expression or constant
+        :param right: right operand, expression or constant
+        """
+        assert op in self.ARITHMETIC or op in self.COMPARISONS or op in self.BOOLEAN
+        super().__init__()
+        self.op = op
+        self.left = _expression(left)
+        self.right = _expression(right)
+
+    @property
+    def columns(self) -> frozenset[str]:
+        return self.left.columns | self.right.columns
+
+    def source(self, namespace: dict[str, tp.Any]) -> str:
+        left, right = self.left.source(namespace), self.right.source(namespace)
+        if self.op in self.BOOLEAN:
+            return f'(bool({left}) {self.BOOLEAN[self.op]} bool({right}))'
+        return f'({left} {self.op} {right})'
+
+    def evaluate(self, batch: RecordBatch) -> tp.Any:
+        left, right = self.left.evaluate(batch), self.right.evaluate(batch)
+        if left is None or right is None:
+            return None
+        kinds = _kind(left) + _kind(right)
+        if self.op in self.BOOLEAN:
+            if kinds != 'bb':
+                return None
+            return (np.logical_and if self.op == '&' else np.logical_or)(left, right)
+        if self.op in self.ARITHMETIC:
+            # Python semantics: no overflow, division by zero raises, strings and booleans are not numbers
+            if not set(kinds) <= set('if') or not (_small_ints(left) and _small_ints(right)):
+                return None
+            if self.op in '/%' and np.any(np.asarray(right) == 0):
+                return None
+            return self.ARITHMETIC[self.op](left, right)
+        if not (set(kinds) <= set('bif') or kinds == 'UU'):
+            return None
+        if 'i' in kinds and 'f' in kinds and not (_small_ints(left) and _small_ints(right)):
+            # Large integers would lose precision converted to floats
+            return None
+        return self.COMPARISONS[self.op](left, right)
+
+    def __repr__(self) -> str:
+        return f'({self.left!r} {self.op} {self.right!r})'
+
+
+def col(name: str) -> Expression:
+    """Expression of the value of a column"""
+    return Column(name)
+
+
+def lit(value: tp.Any) -> Expression:
+    """Expression of a constant"""
+    return Constant(value)
+
+
+def length(operand: tp.Any) -> Expression:
+    """Expression of the length of a string"""
+    return Length(operand)
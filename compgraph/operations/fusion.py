@@ -0,0 +1,179 @@
+import math
+import typing as tp
+from itertools import groupby, islice
+from operator import itemgetter
+
+from .abstract import Operation, Mapper
+from .batch import RecordBatch, np, vectorized
+from .expressions import Expression
+from .map import MAP_BATCH_SIZE, _splitter, DummyMapper, FilterPunctuation, Filter, Project, Retain, LowerCase, \
+    Split, Tokenize, Compute, Product, Divide, Log, WeekHour, HaversineDistance
+from .rows import CompactRow
+
+TRow = tp.Dict[str, tp.Any]
+TRowsIterable = tp.Iterable[TRow]
+TRowsGenerator = tp.Generator[TRow, None, None]
+
+# Mappers which update rows in place and may share one RecordBatch in a chain
+COLUMNAR_MAPPERS = (Product, Divide, Log, HaversineDistance, Compute, Filter)
+
+
+def compile_mappers(mappers: tp.Sequence[Mapper]) -> tp.Callable[[TRowsIterable], TRowsGenerator]:
+    """
+    Generate one generator function applying all mappers to every row.
+    Built-in mappers (of exactly their classes) are inlined as plain statements, expressions of Filter
+    and Compute included, Split becomes a loop over pieces and any other mapper a loop over what it yields,
+    so a row passes the whole chain without intermediate generators
+    """
+    namespace: dict[str, tp.Any] = {'_log': math.log, '_CompactRow': CompactRow}
+    lines = ['def fused(rows):', '    for row in rows:']
+    depth = 2
+
+    def emit(line: str) -> None:
+        lines.append('    ' * depth + line)
+
+    def emit_pieces(split: str, column: str) -> None:
+        # Loop over rows of the pieces of the column, the row itself takes the last piece
+        nonlocal depth
+        suffix = split.lstrip('_')
+        emit(f'_original_{suffix} = row')
+        emit(f'_pieces_{suffix} = {split}(row[{column!r}])')
+        emit(f'_last_{suffix} = len(_pieces_{suffix}) - 1')
+        emit(f'for _index_{suffix}, _piece_{suffix} in enumerate(_pieces_{suffix}):')
+        depth += 1
+        emit(f'row = _original_{suffix} if _index_{suffix} == _last_{suffix} else _original_{suffix}.copy()')
+        emit(f'row[{column!r}] = _piece_{suffix}')
+
+    for i, mapper in enumerate(mappers):
+        kind = type(mapper)
+        if kind is DummyMapper:
+            continue
+        elif kind is FilterPunctuation:
+            assert isinstance(mapper, FilterPunctuation)
+            namespace[f'_table{i}'] = mapper.table
+            emit(f'row[{mapper.column!r}] = row[{mapper.column!r}].translate(_table{i})')
+        elif kind is LowerCase:
+            assert isinstance(mapper, LowerCase)
+            emit(f'row[{mapper.column!r}] = row[{mapper.column!r}].lower()')
+        elif kind is Filter:
+            assert isinstance(mapper, Filter)
+            if isinstance(mapper.condition, Expression):
+                emit(f'if not {mapper.condition.source(namespace)}:')
+            else:
+                namespace[f'_condition{i}'] = mapper.condition
+                emit(f'if not _condition{i}(row):')
+            emit('    continue')
+        elif kind is Compute:
+            assert isinstance(mapper, Compute)
+            emit(f'row[{mapper.column!r}] = {mapper.expression.source(namespace)}')
+        elif kind is Project:
+            assert isinstance(mapper, Project)
+            emit('row = {' + ', '.join(f'{col!r}: row[{col!r}]' for col in mapper.columns) + '}')
+        elif kind is Retain:
+            assert isinstance(mapper, Retain)
+            namespace[f'_columns{i}'] = tuple(mapper.columns)
+            emit(f'row = {{col: row[col] for col in _columns{i} if col in row}} '
+                 f'if row.__class__ is dict or not isinstance(row, _CompactRow) else row.retain(_columns{i})')
+        elif kind is Split:
+            assert isinstance(mapper, Split)
+            namespace[f'_split{i}'] = _splitter(mapper.separator)
+            emit_pieces(f'_split{i}', mapper.column)
+        elif kind is Tokenize:
+            assert isinstance(mapper, Tokenize)
+            namespace[f'_tokens{i}'] = mapper.tokens
+            emit_pieces(f'_tokens{i}', mapper.column)
+        elif kind is Product:
+            assert isinstance(mapper, Product)
+            emit(f'_prod{i} = 1')
+            for col in mapper.columns:
+                emit(f'_prod{i} *= row[{col!r}]')
+            emit(f'row[{mapper.result_column!r}] = _prod{i}')
+        elif kind is Divide:
+            assert isinstance(mapper, Divide)
+            emit(f'assert row[{mapper.denominator!r}] != 0')
+            emit(f'row[{mapper.result!r}] = row[{mapper.nominator!r}] / row[{mapper.denominator!r}]')
+        elif kind is Log:
+            assert isinstance(mapper, Log)
+            emit(f'row[{mapper.result!r}] = _log(row[{mapper.arg!r}])')
+        elif kind is WeekHour:
+            assert isinstance(mapper, WeekHour)
+            namespace[f'_parse{i}'] = mapper._parse
+            emit(f'_dt{i} = _parse{i}(row[{mapper.time!r}])')
+            emit(f'row[{mapper.weekday_result!r}] = _dt{i}.strftime("%A")[:3]')
+            emit(f'row[{mapper.hour_result!r}] = _dt{i}.hour')
+        elif kind is HaversineDistance:
+            assert isinstance(mapper, HaversineDistance)
+            namespace[f'_distance{i}'] = mapper._distance
+            emit(f'if {mapper.result!r} not in row:')
+            emit(f'    row[{mapper.result!r}] = _distance{i}(row[{mapper.start!r}], row[{mapper.end!r}])')
+        else:
+            namespace[f'_mapper{i}'] = mapper
+            emit(f'for row in _mapper{i}(row):')
+            depth += 1
+    emit('yield row')
+
+    exec('\n'.join(lines), namespace)
+    return namespace['fused']
+
+
+def _is_columnar(mapper: Mapper) -> bool:
+    if type(mapper) is Filter:
+        return hasattr(getattr(mapper, 'condition'), 'mask')
+    return type(mapper) in COLUMNAR_MAPPERS
+
+
+class FusedMap(Operation):
+    """
+    Chain of mappers run as one operation, output is the same as of consecutive Map operations.
+    Runs of at least two vectorizable mappers share a RecordBatch per batch of rows (with NumPy),
+    other mappers are compiled into a single generator function
+    """
+
+    def __init__(self, mappers: tp.Sequence[Mapper], batch_size: int = MAP_BATCH_SIZE) -> None:
+        """
+        :param mappers: mappers to apply in order
+        :param batch_size: number of rows in a batch of the columnar runs
+        """
+        self.mappers = list(mappers)
+        self.batch_size = batch_size
+        self._segments: list[tuple[bool, tp.Any]] | None = None
+
+    def __getstate__(self) -> dict[str, tp.Any]:
+        # Compiled functions do not pickle, they are generated again on first use
+        return {**self.__dict__, '_segments': None}
+
+    def _split_segments(self) -> list[tuple[bool, tp.Any]]:
+        columnar = [np is not None and _is_columnar(mapper) for mapper in self.mappers]
+        # A lone vectorizable mapper is cheaper inlined than converted to columns and back
+        columnar = [flag and ((i > 0 and columnar[i - 1]) or (i + 1 < len(columnar) and columnar[i + 1]))
+                    for i, flag in enumerate(columnar)]
+        segments: list[tuple[bool, tp.Any]] = []
+        for flag, group in groupby(zip(columnar, self.mappers), key=itemgetter(0)):
+            mappers = [mapper for _, mapper in group]
+            segments.append((flag, mappers if flag else compile_mappers(mappers)))
+        return segments
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any,
+                 **kwargs: tp.Any) -> TRowsGenerator:
+        if self._segments is None:
+            self._segments = self._split_segments()
+        for columnar, segment in self._segments:
+            rows = self._map_columns(rows, segment) if columnar else segment(rows)
+        yield from rows
+
+    def _map_columns(self, rows: TRowsIterable, mappers: list[Mapper]) -> TRowsGenerator:
+        rows = iter(rows)
+        while batch := list(islice(rows, self.batch_size)):
+            records = RecordBatch(batch) if vectorized(batch) else None
+            for mapper in mappers:
+                if records is not None:
+                    mapped = mapper.map_columns(records)
+                    if mapped is not None:
+                        records = mapped
+                        continue
+                    batch = records.to_rows()
+                    records = None
+                batch = list(mapper.map_batch(batch))
+            if records is not None:
+                batch = records.to_rows()
+            yield from batch
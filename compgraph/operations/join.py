@@ -1,12 +1,20 @@
+import copy
 import typing as tp
+from itertools import chain, islice
 
 from .abstract import Operation, Joiner
-from .utils import keyfunc, groupby_verbose
+from .utils import keyfunc, groupby_verbose, stable_hash, SpillFile, write_partitioned
 
 TRow = tp.Dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+HASH_JOIN_MEMORY_LIMIT = 100000
+HASH_JOIN_PARTITIONS = 16
+HASH_JOIN_MAX_DEPTH = 3
+SPILL_BATCH_SIZE = 1024
+HASH_JOIN_PROBE_BATCH_SIZE = 1024
+
 
 class Join(Operation):
     def __init__(self, joiner: Joiner, keys: tp.Sequence[str]):
@@ -36,23 +44,295 @@ class Join(Operation):
                 r_key, r_rows = next(right, (None, None))
 
 
+class HashJoin(Operation):
+    """
+    Join which builds a hash table on the right table and streams the left one, so neither has to be sorted.
+    Left rows are probed in batches and rows of a batch with equal keys are joined together, so rows are
+    emitted in order of the left table up to grouping within a batch, followed by unmatched right rows
+    for right and outer joins.
+    When the right table has more than memory_limit rows, both tables are hash-partitioned by key
+    to temporary files and every pair of partitions is joined on its own (grace hash join)
+    """
+
+    def __init__(self, joiner: Joiner, keys: tp.Sequence[str],
+                 memory_limit: int = HASH_JOIN_MEMORY_LIMIT,
+                 partitions: int = HASH_JOIN_PARTITIONS) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: keys for joining
+        :param memory_limit: maximum number of right table rows kept in memory
+        :param partitions: number of partitions to spill to when memory_limit is exceeded
+        """
+        self.keys = keys
+        self.joiner = joiner
+        self.memory_limit = memory_limit
+        self.partitions = partitions
+
+    def __call__(self, rows: TRowsIterable, *columns: tp.Any,
+                 **kwcolumns: tp.Any) -> TRowsGenerator:
+        yield from self._join(iter(rows), iter(columns[0]), 0)
+
+    def _join_key(self, row: TRow) -> tuple[tp.Any, ...]:
+        return tuple(row[key] for key in self.keys)
+
+    def _join(self, left: tp.Iterator[TRow], right: tp.Iterator[TRow], depth: int) -> TRowsGenerator:
+        table: dict[tuple[tp.Any, ...], list[TRow]] = {}
+        built = 0
+        for row in right:
+            table.setdefault(self._join_key(row), []).append(row)
+            built += 1
+            if built > self.memory_limit and depth < HASH_JOIN_MAX_DEPTH:
+                right = chain(chain.from_iterable(table.values()), right)
+                yield from self._join_partitioned(left, right, depth)
+                return
+
+        # Right groups are buffered (and spilled if too large) once, not once per joiner call
+        groups = {key: _buffer_group(self.joiner, rows_b) for key, rows_b in table.items()}
+        table.clear()
+        try:
+            matched = set()
+            no_rows: list[TRow] = []
+            for batch in iter(lambda: list(islice(left, HASH_JOIN_PROBE_BATCH_SIZE)), []):
+                # The joiner is called once per key of a batch of left rows
+                probes: dict[tuple[tp.Any, ...], list[TRow]] = {}
+                for row in batch:
+                    probes.setdefault(self._join_key(row), []).append(row)
+                for key, rows_a in probes.items():
+                    group = groups.get(key)
+                    if group is not None:
+                        matched.add(key)
+                    yield from self.joiner(self.keys, rows_a, group if group is not None else no_rows)
+            for key, group in groups.items():
+                if key not in matched:
+                    yield from self.joiner(self.keys, [], group)
+        finally:
+            for group in groups.values():
+                group.close()
+
+    def _join_partitioned(self, left: tp.Iterator[TRow], right: tp.Iterator[TRow], depth: int) -> TRowsGenerator:
+        left_spills = [SpillFile() for _ in range(self.partitions)]
+        right_spills = [SpillFile() for _ in range(self.partitions)]
+        try:
+            def partition(row: TRow) -> int:
+                return stable_hash(self._join_key(row), depth) % self.partitions
+
+            write_partitioned(right, partition, right_spills)
+            write_partitioned(left, partition, left_spills)
+            for left_spill, right_spill in zip(left_spills, right_spills):
+                yield from self._join(iter(left_spill), iter(right_spill), depth + 1)
+        finally:
+            for spill in chain(left_spills, right_spills):
+                spill.close()
+
+
+class BroadcastJoin(HashJoin):
+    """
+    Hash join for a right table small enough to be kept in memory, such as a single row of scalars
+    joined with empty keys.
+    For inner and left joins the columns each right row contributes are prepared once and attached
+    to every matching left row; output keeps the order of the left table.
+    A right table of more than memory_limit rows is joined as by HashJoin, with empty keys as one group
+    which the joiner spills to disk if it is too large
+    """
+
+    def __init__(self, joiner: Joiner, keys: tp.Sequence[str], memory_limit: int = HASH_JOIN_MEMORY_LIMIT,
+                 partitions: int = HASH_JOIN_PARTITIONS) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: keys for joining
+        :param memory_limit: maximum number of right table rows kept in memory
+        :param partitions: number of partitions to spill to when memory_limit is exceeded
+        """
+        super().__init__(joiner, keys, memory_limit, partitions)
+
+    def _join(self, left: tp.Iterator[TRow], right: tp.Iterator[TRow], depth: int) -> TRowsGenerator:
+        if not isinstance(self.joiner, (InnerJoiner, LeftJoiner)):
+            yield from self._join_spilling(left, right, depth)
+            return
+
+        # join key -> list of (right row, its columns, its non-key columns)
+        table: dict[tuple[tp.Any, ...], list[tuple[TRow, tuple[str, ...], TRow]]] = {}
+        built = 0
+        for row_b in right:
+            attached = {col: value for col, value in row_b.items() if col not in self.keys}
+            table.setdefault(self._join_key(row_b), []).append((row_b, tuple(row_b), attached))
+            built += 1
+            if built > self.memory_limit:
+                buffered = (row for rows_b in table.values() for row, _, _ in rows_b)
+                yield from self._join_spilling(left, chain(buffered, right), depth)
+                return
+
+        keys = tuple(self.keys)
+        keep_unmatched = isinstance(self.joiner, LeftJoiner)
+        last_schemas: tuple[tuple[str, ...], ...] = ()
+        plan: MergePlan = ((), ())
+        attach = True
+        for row_a in left:
+            rows_b = table.get(self._join_key(row_a))
+            if not rows_b:
+                if keep_unmatched:
+                    yield row_a
+                continue
+            schema_a = tuple(row_a)
+            last = len(rows_b) - 1
+            for i, (row_b, schema_b, attached) in enumerate(rows_b):
+                schemas = (keys, schema_a, schema_b)
+                if schemas != last_schemas:
+                    plan = cached_merge_plan(self.joiner, schemas)
+                    # No column is suffixed, so the right columns are attached as they are
+                    attach = all(src == dst for src, dst in chain(*plan))
+                    last_schemas = schemas
+                if attach:
+                    # The left row is owned by the join, only rows it is emitted with besides the last are copies
+                    row = row_a if i == last else row_a.copy()
+                    row.update(attached)
+                    yield row
+                else:
+                    yield apply_merge_plan(plan, row_a, row_b)
+
+    def _join_spilling(self, left: tp.Iterator[TRow], right: tp.Iterator[TRow], depth: int) -> TRowsGenerator:
+        if self.keys:
+            yield from super()._join(left, right, depth)
+        else:
+            # Partitions by empty keys do not split anything, all rows are one group as for a sort join
+            yield from self.joiner(self.keys, left, right)
+
+
 # Joiners
+# Pairs (column of the source row, column of the merged row) for both joined rows
+MergePlan = tuple[tuple[tuple[str, str], ...], tuple[tuple[str, str], ...]]
+MAX_MERGE_PLANS = 1024
+
+
+def build_merge_plan(keys: tp.Sequence[str], schema_a: tp.Sequence[str], schema_b: tp.Sequence[str],
+                     a_suffix: str, b_suffix: str) -> MergePlan:
+    """Plan of merging a row with columns schema_a with a row with columns schema_b"""
+    key_set = set(keys)
+    columns_a = set(schema_a)
+    columns_b = set(schema_b)
+    plan_a = [(key, key) for key in keys]
+    for col in schema_a:
+        if col not in key_set:
+            plan_a.append((col, col + a_suffix if col in columns_b else col))
+    plan_b = [(col, col + b_suffix if col in columns_a else col) for col in schema_b if col not in key_set]
+    return tuple(plan_a), tuple(plan_b)
+
+
+def cached_merge_plan(joiner: Joiner, schemas: tuple[tuple[str, ...], ...]) -> MergePlan:
+    """Plan of merging rows of schemas (keys, left columns, right columns) from the joiner's cache"""
+    plans = joiner._merge_plans
+    plan = plans.get(schemas)
+    if plan is None:
+        if len(plans) >= MAX_MERGE_PLANS:
+            plans.clear()
+        plan = plans[schemas] = build_merge_plan(*schemas, joiner._a_suffix, joiner._b_suffix)
+    return plan
+
+
+def apply_merge_plan(plan: MergePlan, row_a: TRow, row_b: TRow) -> TRow:
+    plan_a, plan_b = plan
+    ans = {dst: row_a[src] for src, dst in plan_a}
+    for src, dst in plan_b:
+        ans[dst] = row_b[src]
+    return ans
+
+
 def merge_two_rows(keys: tp.Sequence[str], row_a: TRow,
                    row_b: TRow, a_suffix: str, b_suffix: str) -> TRow:
-    ans = {key: row_a[key] for key in keys}
-    for i in row_a:
-        if i not in keys:
-            if i in row_b:
-                ans[i + a_suffix] = row_a[i]
-            else:
-                ans[i] = row_a[i]
-    for i in row_b:
-        if i not in keys:
-            if i in row_a:
-                ans[i + b_suffix] = row_b[i]
-            else:
-                ans[i] = row_b[i]
-    return ans
+    plan = build_merge_plan(keys, tuple(row_a), tuple(row_b), a_suffix, b_suffix)
+    return apply_merge_plan(plan, row_a, row_b)
+
+
+class GroupBuffer:
+    """
+    Rows of one key group, kept to be iterated several times.
+    Up to max_rows rows are kept in memory; a larger group is written to a temporary file as a whole
+    and read back from it on every iteration, so a hot key does not have to fit in memory
+    """
+
+    def __init__(self, rows: TRowsIterable, max_rows: int) -> None:
+        self._rows: list[TRow] = []
+        self._spill: SpillFile | None = None
+        self._size = 0
+        self._borrowed = False
+        for row in rows:
+            self._rows.append(row)
+            self._size += 1
+            if len(self._rows) > max_rows or (self._spill is not None and len(self._rows) == SPILL_BATCH_SIZE):
+                if self._spill is None:
+                    self._spill = SpillFile()
+                self._spill.write(self._rows)
+                self._rows = []
+        if self._spill is not None and self._rows:
+            self._spill.write(self._rows)
+            self._rows = []
+        # Equal schemas share one tuple, so an in-memory group costs one reference per row
+        distinct_schemas: dict[tuple[str, ...], tuple[str, ...]] = {}
+        self._schemas = [distinct_schemas.setdefault(schema, schema) for schema in map(tuple, self._rows)]
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> tp.Iterator[TRow]:
+        if self._spill is not None:
+            return iter(self._spill)
+        return iter(self._rows)
+
+    def with_schemas(self) -> tp.Iterator[tuple[TRow, tuple[str, ...]]]:
+        """Rows with tuples of their column names"""
+        if self._spill is not None:
+            return ((row, tuple(row)) for row in self._spill)
+        return zip(self._rows, self._schemas)
+
+    def borrow(self) -> 'GroupBuffer':
+        """The same group, which is not closed by closing the borrowed one"""
+        borrowed = copy.copy(self)
+        borrowed._borrowed = True
+        return borrowed
+
+    def close(self) -> None:
+        if self._spill is not None and not self._borrowed:
+            self._spill.close()
+
+
+def _buffer_group(joiner: Joiner, rows: TRowsIterable) -> GroupBuffer:
+    if isinstance(rows, GroupBuffer):
+        # Already buffered by the caller, who closes it
+        return rows.borrow()
+    group = GroupBuffer(rows, joiner.max_group_size)
+    if group.spilled:
+        joiner.spilled_groups += 1
+    return group
+
+
+def _merge_groups(joiner: Joiner, keys: tp.Sequence[str], outer_rows: TRowsIterable,
+                  inner: GroupBuffer, outer_is_a: bool = True) -> TRowsGenerator:
+    """
+    Merge every row of outer_rows with every row of the inner group.
+    Schema of every row is derived once; pairs with the same schemas as the previous pair (also across calls)
+    reuse its plan and other pairs take their plan from the joiner's cache
+    """
+    keys = tuple(keys)
+    plans = joiner._merge_plans
+    last_schemas, (plan_a, plan_b) = plans.get(None, ((), ((), ())))
+    for outer_row in outer_rows:
+        outer_schema = tuple(outer_row)
+        for inner_row, inner_schema in inner.with_schemas():
+            row_a, row_b = (outer_row, inner_row) if outer_is_a else (inner_row, outer_row)
+            schemas = (keys, outer_schema, inner_schema) if outer_is_a else (keys, inner_schema, outer_schema)
+            if schemas != last_schemas:
+                plan = cached_merge_plan(joiner, schemas)
+                plan_a, plan_b = plan
+                plans[None] = (schemas, plan)
+                last_schemas = schemas
+            ans = {dst: row_a[src] for src, dst in plan_a}
+            for src, dst in plan_b:
+                ans[dst] = row_b[src]
+            yield ans
 
 
 class InnerJoiner(Joiner):
@@ -60,11 +340,11 @@ class InnerJoiner(Joiner):
 
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable,
                  rows_b: TRowsIterable) -> TRowsGenerator:
-        rows_b = [row for row in rows_b]
-        for row_a in rows_a:
-            for row_b in rows_b:
-                yield merge_two_rows(keys, row_a, row_b, self._a_suffix,
-                                     self._b_suffix)
+        group_b = _buffer_group(self, rows_b)
+        try:
+            yield from _merge_groups(self, keys, rows_a, group_b)
+        finally:
+            group_b.close()
 
 
 class OuterJoiner(Joiner):
@@ -72,17 +352,18 @@ class OuterJoiner(Joiner):
 
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable,
                  rows_b: TRowsIterable) -> TRowsGenerator:
-        rows_a = [row for row in rows_a]
-        rows_b = [row for row in rows_b]
-        if len(rows_a) == 0:
-            yield from rows_b
-        elif len(rows_b) == 0:
-            yield from rows_a
-        else:
-            for row_a in rows_a:
-                for row_b in rows_b:
-                    yield merge_two_rows(keys, row_a, row_b, self._a_suffix,
-                                         self._b_suffix)
+        group_a = _buffer_group(self, rows_a)
+        group_b = _buffer_group(self, rows_b)
+        try:
+            if len(group_a) == 0:
+                yield from group_b
+            elif len(group_b) == 0:
+                yield from group_a
+            else:
+                yield from _merge_groups(self, keys, group_a, group_b)
+        finally:
+            group_a.close()
+            group_b.close()
 
 
 class LeftJoiner(Joiner):
@@ -90,14 +371,14 @@ class LeftJoiner(Joiner):
 
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable,
                  rows_b: TRowsIterable) -> TRowsGenerator:
-        rows_b = [row for row in rows_b]
-        if len(rows_b) == 0:
-            yield from rows_a
-        else:
-            for row_a in rows_a:
-                for row_b in rows_b:
-                    yield merge_two_rows(keys, row_a, row_b, self._a_suffix,
-                                         self._b_suffix)
+        group_b = _buffer_group(self, rows_b)
+        try:
+            if len(group_b) == 0:
+                yield from rows_a
+            else:
+                yield from _merge_groups(self, keys, rows_a, group_b)
+        finally:
+            group_b.close()
 
 
 class RightJoiner(Joiner):
@@ -105,11 +386,11 @@ class RightJoiner(Joiner):
 
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable,
                  rows_b: TRowsIterable) -> TRowsGenerator:
-        rows_a = [row for row in rows_a]
-        if len(rows_a) == 0:
-            yield from rows_b
-        else:
-            for row_b in rows_b:
-                for row_a in rows_a:
-                    yield merge_two_rows(keys, row_a, row_b, self._a_suffix,
-                                         self._b_suffix)
+        group_a = _buffer_group(self, rows_a)
+        try:
+            if len(group_a) == 0:
+                yield from rows_b
+            else:
+                yield from _merge_groups(self, keys, rows_b, group_a, outer_is_a=False)
+        finally:
+            group_a.close()
@@ -3,33 +3,73 @@ import typing as tp
 import re
 import math
 from datetime import datetime
-from copy import deepcopy
+from itertools import islice
 
 from .abstract import Operation, Mapper
+from .batch import RecordBatch, np, is_numeric, vectorized
+from .expressions import Expression
+from .rows import CompactRow
 
 
 TRow = tp.Dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+MAP_BATCH_SIZE = 1024
+WHITESPACE = r'\s+'
+
+
+def _splitter(separator: str) -> tp.Callable[[str], list[str]]:
+    pattern = re.compile(separator)
+    if not pattern.groups:
+        return pattern.split
+
+    # re.split would also return the groups
+    def split(text: str) -> list[str]:
+        pieces = []
+        start = 0
+        for match in pattern.finditer(text):
+            pieces.append(text[start:match.start()])
+            start = match.end()
+        pieces.append(text[start:])
+        return pieces
+    return split
+
 
 class Map(Operation):
-    def __init__(self, mapper: Mapper) -> None:
+    def __init__(self, mapper: Mapper, batch_size: int = MAP_BATCH_SIZE) -> None:
         self.mapper = mapper
+        self.batch_size = batch_size
 
     def __call__(self, rows: TRowsIterable, *args: tp.Any,
                  **kwargs: tp.Any) -> TRowsGenerator:
-        for row in rows:
-            yield from self.mapper(row)
+        mapper = self.mapper
+        if type(mapper).map_batch is Mapper.map_batch:
+            for row in rows:
+                yield from mapper(row)
+            return
+
+        rows = iter(rows)
+        while batch := list(islice(rows, self.batch_size)):
+            yield from mapper.map_batch(batch)
 
 
 # Dummy mapper
 class DummyMapper(Mapper):
     """Yield exactly the row passed"""
 
+    def reads(self) -> tp.Collection[str]:
+        return ()
+
+    def writes(self) -> tp.Collection[str]:
+        return ()
+
     def __call__(self, row: TRow) -> TRowsGenerator:
         yield row
 
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        return rows
+
 
 # Mappers
 class FilterPunctuation(Mapper):
@@ -42,24 +82,53 @@ class FilterPunctuation(Mapper):
         self.column = column
         self.table = str.maketrans('', '', string.punctuation)
 
+    def reads(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.column,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
-        row[self.column] = row[self.column].translate(self.table)
-        yield row
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        column, table = self.column, self.table
+        for row in rows:
+            row[column] = row[column].translate(table)
+        return rows
 
 
 class Filter(Mapper):
     """Remove records that don't satisfy some condition"""
 
-    def __init__(self, condition: tp.Callable[[TRow], bool]) -> None:
+    def __init__(self, condition: tp.Callable[[TRow], bool], columns: tp.Sequence[str] | None = None) -> None:
         """
         :param condition: if condition is not true - remove record
+        :param columns: all columns condition uses, declaring them lets the filter be moved closer to the source
         """
         self.condition = condition
+        self.columns = columns
+
+    def reads(self) -> tp.Collection[str] | None:
+        if self.columns is None:
+            return getattr(self.condition, 'columns', None)
+        return self.columns
+
+    def writes(self) -> tp.Collection[str]:
+        return ()
 
     def __call__(self, row: TRow) -> TRowsGenerator:
         if self.condition(row):
             yield row
 
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        return list(filter(self.condition, rows))
+
+    def map_columns(self, batch: RecordBatch) -> RecordBatch | None:
+        mask = getattr(self.condition, 'mask', None)
+        values = mask(batch) if mask is not None else None
+        return batch.filter(values) if values is not None else None
+
 
 class Project(Mapper):
     """Leave only mentioned columns"""
@@ -70,9 +139,49 @@ class Project(Mapper):
         """
         self.columns = columns
 
+    def reads(self) -> tp.Collection[str]:
+        return self.columns
+
+    def writes(self) -> tp.Collection[str]:
+        # Columns are only dropped
+        return ()
+
     def __call__(self, row: TRow) -> TRowsGenerator:
         yield {col: row[col] for col in self.columns}
 
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        columns = self.columns
+        return [{col: row[col] for col in columns} for row in rows]
+
+
+class Retain(Mapper):
+    """Leave only mentioned columns a row has, the plan inserts it to drop columns nobody reads"""
+
+    def __init__(self, columns: tp.Collection[str]) -> None:
+        """
+        :param columns: names of columns, missing ones are skipped
+        """
+        self.columns = columns
+
+    def reads(self) -> tp.Collection[str]:
+        return ()
+
+    def writes(self) -> tp.Collection[str]:
+        # Columns are only dropped
+        return ()
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        if row.__class__ is not dict and isinstance(row, CompactRow):
+            yield row.retain(self.columns)
+        else:
+            yield {col: row[col] for col in self.columns if col in row}
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        # Compact rows stay compact
+        columns = self.columns
+        return [row.retain(columns) if row.__class__ is not dict and isinstance(row, CompactRow)
+                else {col: row[col] for col in columns if col in row} for row in rows]
+
 
 class LowerCase(Mapper):
     """Replace column value with value in lower case"""
@@ -87,9 +196,20 @@ class LowerCase(Mapper):
     def _lower_case(txt: str) -> str:
         return txt.lower()
 
+    def reads(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.column,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
-        row[self.column] = self._lower_case(row[self.column])
-        yield row
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        column, lower_case = self.column, self._lower_case
+        for row in rows:
+            row[column] = lower_case(row[column])
+        return rows
 
 
 class Split(Mapper):
@@ -104,19 +224,150 @@ class Split(Mapper):
         self.column = column
         self.separator = separator if separator is not None else r'\s+'
 
+    def reads(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.column,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
-        start = 0
-        original_row = row.copy()
-        for match in re.finditer(self.separator, original_row[self.column]):
-            row = original_row.copy()
-            row[self.column] = row[self.column][start:match.start()]
-            start = match.end()
-            yield row
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsGenerator:
+        # Lazy, one row may split into any number of rows; the last piece is set in the row itself
+        column, separator = self.column, self.separator
+        for original_row in rows:
+            text = original_row[column]
+            start = 0
+            for match in re.finditer(separator, text):
+                row = original_row.copy()
+                row[column] = text[start:match.start()]
+                start = match.end()
+                yield row
+
+            original_row[column] = text[start:]
+            yield original_row
+
+
+class Compute(Mapper):
+    """Set a column to the value of an expression"""
+
+    def __init__(self, column: str, expression: Expression) -> None:
+        """
+        :param column: result column name
+        :param expression: expression to compute, see col
+        """
+        self.column = column
+        self.expression = expression
+
+    def reads(self) -> tp.Collection[str]:
+        return self.expression.columns
 
-        row = original_row.copy()
-        row[self.column] = row[self.column][start:]
+    def writes(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        row[self.column] = self.expression(row)
         yield row
 
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        if vectorized(rows):
+            batch = self.map_columns(RecordBatch(rows))
+            if batch is not None:
+                return batch.to_rows()
+        column, expression = self.column, self.expression
+        for row in rows:
+            row[column] = expression(row)
+        return rows
+
+    def map_columns(self, batch: RecordBatch) -> RecordBatch | None:
+        values = self.expression.evaluate(batch)
+        if values is None or np.shape(values) != (len(batch),):
+            return None
+        batch.set_column(self.column, values)
+        return batch
+
+
+class Tokenize(Mapper):
+    """
+    Split text of a column into rows of tokens, optionally without punctuation and in lower case.
+    Gives the same rows as FilterPunctuation, LowerCase (in either order) and Split of the column,
+    in one pass over the text; whitespace is split with str.split
+    """
+
+    def __init__(self, column: str, separator: str | None = None, filter_punctuation: bool = True,
+                 lower_case: bool = True, lower_case_first: bool = False) -> None:
+        """
+        :param column: name of column to split
+        :param separator: regular expression to separate by, any whitespace if None
+        :param filter_punctuation: remove punctuation symbols as FilterPunctuation
+        :param lower_case: lower case text as LowerCase
+        :param lower_case_first: lower case text before removing punctuation, which differs for text
+            whose lower case depends on the punctuation (final sigma)
+        """
+        self.column = column
+        self.separator = separator if separator is not None else WHITESPACE
+        self.filter_punctuation = filter_punctuation
+        self.lower_case = lower_case
+        self.lower_case_first = lower_case_first
+        self.table = str.maketrans('', '', string.punctuation)
+        self._split = self._make_split()
+
+    def __getstate__(self) -> dict[str, tp.Any]:
+        # Split functions of patterns with groups do not pickle
+        return {key: value for key, value in self.__dict__.items() if key != '_split'}
+
+    def __setstate__(self, state: dict[str, tp.Any]) -> None:
+        self.__dict__.update(state)
+        self._split = self._make_split()
+
+    def _make_split(self) -> tp.Callable[[str], list[str]]:
+        return self._split_whitespace if self.separator == WHITESPACE else _splitter(self.separator)
+
+    @staticmethod
+    def _split_whitespace(text: str) -> list[str]:
+        # Same pieces as re.split(r'\s+'): empty ones at the ends of text starting or ending with whitespace
+        tokens = text.split()
+        if not tokens:
+            return ['', ''] if text else ['']
+        if text[0].isspace():
+            tokens.insert(0, '')
+        if text[-1].isspace():
+            tokens.append('')
+        return tokens
+
+    def tokens(self, text: str) -> list[str]:
+        """Tokens of a text"""
+        if self.lower_case and self.lower_case_first:
+            text = text.lower()
+        if self.filter_punctuation:
+            text = text.translate(self.table)
+        if self.lower_case and not self.lower_case_first:
+            text = text.lower()
+        return self._split(text)
+
+    def reads(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsGenerator:
+        # Lazy as Split; token rows are copies of the input row, which takes the last token
+        column, tokens = self.column, self.tokens
+        for template in rows:
+            pieces = tokens(template[column])
+            last = pieces.pop()
+            for piece in pieces:
+                row = template.copy()
+                row[column] = piece
+                yield row
+            template[column] = last
+            yield template
+
 
 class Product(Mapper):
     """Calculates product of multiple columns"""
@@ -130,13 +381,34 @@ class Product(Mapper):
         self.columns = columns
         self.result_column = result_column
 
+    def reads(self) -> tp.Collection[str]:
+        return self.columns
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.result_column,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
-        prod = 1
-        for col in self.columns:
-            prod *= row[col]
-        row_copy = deepcopy(row)
-        row_copy[self.result_column] = prod
-        yield row_copy
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        columns, result_column = self.columns, self.result_column
+        for row in rows:
+            prod = 1
+            for col in columns:
+                prod *= row[col]
+            row[result_column] = prod
+        return rows
+
+    def map_columns(self, batch: RecordBatch) -> RecordBatch | None:
+        # Only floats: products of integer arrays could silently overflow
+        columns = [batch.column(col) for col in self.columns]
+        if not all(values.dtype.kind == 'f' for values in columns):
+            return None
+        prod = np.ones(len(batch))
+        for values in columns:
+            prod = prod * values
+        batch.set_column(self.result_column, prod)
+        return batch
 
 
 class Divide(Mapper):
@@ -152,10 +424,29 @@ class Divide(Mapper):
         self.denominator = denominator
         self.result = result
 
+    def reads(self) -> tp.Collection[str]:
+        return self.nominator, self.denominator
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.result,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
-        assert row[self.denominator] != 0
-        row[self.result] = row[self.nominator] / row[self.denominator]
-        yield row
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        nominator, denominator, result = self.nominator, self.denominator, self.result
+        for row in rows:
+            assert row[denominator] != 0
+            row[result] = row[nominator] / row[denominator]
+        return rows
+
+    def map_columns(self, batch: RecordBatch) -> RecordBatch | None:
+        nominator, denominator = batch.column(self.nominator), batch.column(self.denominator)
+        if not (is_numeric(nominator) and is_numeric(denominator)):
+            return None
+        assert denominator.all()
+        batch.set_column(self.result, nominator / denominator)
+        return batch
 
 
 class Log(Mapper):
@@ -171,9 +462,32 @@ class Log(Mapper):
         self.arg = arg
         self.result = result
 
+    def reads(self) -> tp.Collection[str]:
+        return (self.arg,)
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.result,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
-        row[self.result] = math.log(row[self.arg])
-        yield row
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        if vectorized(rows):
+            batch = self.map_columns(RecordBatch(rows))
+            if batch is not None:
+                return batch.to_rows()
+        arg, result, log = self.arg, self.result, math.log
+        for row in rows:
+            row[result] = log(row[arg])
+        return rows
+
+    def map_columns(self, batch: RecordBatch) -> RecordBatch | None:
+        # Non-positive values are left to math.log to raise on
+        values = batch.column(self.arg)
+        if not is_numeric(values) or not (values > 0).all():
+            return None
+        batch.set_column(self.result, np.log(values))
+        return batch
 
 
 class WeekHour(Mapper):
@@ -194,15 +508,28 @@ class WeekHour(Mapper):
         self.weekday_result = weekday_result
         self.hour_result = hour_result
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    def _parse(self, time: str) -> datetime:
         try:
-            dt = datetime.strptime(row[self.time], self.time_format)
+            return datetime.strptime(time, self.time_format)
         except ValueError:
-            dt = datetime.strptime(row[self.time], '%Y%m%dT%H%M%S')
+            return datetime.strptime(time, '%Y%m%dT%H%M%S')
 
-        row[self.weekday_result] = dt.strftime("%A")[:3]
-        row[self.hour_result] = dt.hour
-        yield row
+    def reads(self) -> tp.Collection[str]:
+        return (self.time,)
+
+    def writes(self) -> tp.Collection[str]:
+        return self.weekday_result, self.hour_result
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        parse, time, weekday_result, hour_result = self._parse, self.time, self.weekday_result, self.hour_result
+        for row in rows:
+            dt = parse(row[time])
+            row[weekday_result] = dt.strftime("%A")[:3]
+            row[hour_result] = dt.hour
+        return rows
 
 
 class HaversineDistance(Mapper):
@@ -221,13 +548,9 @@ class HaversineDistance(Mapper):
         self.end = end
         self.result = result
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        if self.result in row:
-            yield row
-            return
-
-        lng1, lat1 = row[self.start]
-        lng2, lat2 = row[self.end]
+    def _distance(self, start: tp.Sequence[float], end: tp.Sequence[float]) -> float:
+        lng1, lat1 = start
+        lng2, lat2 = end
 
         lng1, lat1, lng2, lat2 = map(math.radians, [lng1, lat1, lng2, lat2])
 
@@ -237,5 +560,40 @@ class HaversineDistance(Mapper):
         a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlng/2)**2
         c = 2 * math.asin(math.sqrt(a))
 
-        row[self.result] = c * self.EARTH_RADIUS_KM
-        yield row
+        return c * self.EARTH_RADIUS_KM
+
+    def reads(self) -> tp.Collection[str]:
+        return self.start, self.end, self.result
+
+    def writes(self) -> tp.Collection[str]:
+        return (self.result,)
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        yield from self.map_batch([row])
+
+    def map_batch(self, rows: list[TRow]) -> TRowsIterable:
+        if vectorized(rows):
+            batch = self.map_columns(RecordBatch(rows))
+            if batch is not None:
+                return batch.to_rows()
+        start, end, result, distance = self.start, self.end, self.result, self._distance
+        for row in rows:
+            if result not in row:
+                row[result] = distance(row[start], row[end])
+        return rows
+
+    def map_columns(self, batch: RecordBatch) -> RecordBatch | None:
+        start, end = batch.column(self.start), batch.column(self.end)
+        if start.ndim != 2 or end.ndim != 2 or not (is_numeric(start) and is_numeric(end)):
+            return None
+        # Rows which already have a distance keep it
+        present = batch.has_column(self.result)
+        if present is None:
+            return None
+        if present:
+            return batch
+        lng1, lat1 = np.radians(start[:, 0]), np.radians(start[:, 1])
+        lng2, lat2 = np.radians(end[:, 0]), np.radians(end[:, 1])
+        a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1)/2)**2
+        batch.set_column(self.result, 2 * np.arcsin(np.sqrt(a)) * self.EARTH_RADIUS_KM)
+        return batch
@@ -1,16 +1,22 @@
 import typing as tp
-import copy
 import heapq
 from datetime import datetime
 from collections import Counter
+from itertools import chain, islice
+from operator import itemgetter
 
-from .abstract import Operation, Reducer
-from .utils import keyfunc, groupby_verbose
+from .abstract import Operation, Reducer, AlgebraicReducer, PARTIAL_STATE
+from .utils import keyfunc, groupby_verbose, stable_hash, SpillFile, write_partitioned
 
 TRow = tp.Dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+HASH_REDUCE_MEMORY_LIMIT = 100000
+HASH_REDUCE_PARTITIONS = 16
+HASH_REDUCE_MAX_DEPTH = 3
+COMBINE_MAX_GROUPS = 10000
+
 
 class Reduce(Operation):
     def __init__(self, reducer: Reducer, keys: tp.Sequence[str]) -> None:
@@ -27,19 +33,197 @@ class Reduce(Operation):
             yield from self.reducer(tuple(self.keys), group)
 
 
+class HashReduce(Operation):
+    """
+    Reduce which groups rows in a hash table, so its input does not have to be sorted.
+    Groups are emitted in order of their first row. When more than memory_limit rows are buffered,
+    rows are hash-partitioned by key to temporary files and every partition is reduced on its own.
+    Algebraic reducers keep only a state per group and spill partial states instead of rows
+    """
+
+    def __init__(self, reducer: Reducer, keys: tp.Sequence[str],
+                 memory_limit: int = HASH_REDUCE_MEMORY_LIMIT,
+                 partitions: int = HASH_REDUCE_PARTITIONS) -> None:
+        """
+        :param reducer: reducer to use
+        :param keys: keys for grouping
+        :param memory_limit: maximum number of rows (groups for algebraic reducers) kept in memory
+        :param partitions: number of partitions to spill to when memory_limit is exceeded
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.memory_limit = memory_limit
+        self.partitions = partitions
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any,
+                 **kwargs: tp.Any) -> TRowsGenerator:
+        if not self.keys:
+            yield from self.reducer((), rows)
+        elif isinstance(self.reducer, AlgebraicReducer):
+            yield from self._reduce_algebraic(self.reducer, iter(rows))
+        else:
+            yield from self._reduce(iter(rows), 0)
+
+    def _group_key(self, row: TRow) -> tuple[tp.Any, ...]:
+        return tuple(row[key] for key in self.keys)
+
+    def _reduce(self, rows: tp.Iterator[TRow], depth: int) -> TRowsGenerator:
+        groups: dict[tuple[tp.Any, ...], list[TRow]] = {}
+        buffered = 0
+        for row in rows:
+            groups.setdefault(self._group_key(row), []).append(row)
+            buffered += 1
+            if buffered > self.memory_limit and depth < HASH_REDUCE_MAX_DEPTH:
+                buffered_rows = chain.from_iterable(groups.values())
+                yield from self._reduce_partitioned(chain(buffered_rows, rows), depth)
+                return
+
+        for group in groups.values():
+            yield from self.reducer(tuple(self.keys), iter(group))
+
+    def _reduce_partitioned(self, rows: tp.Iterator[TRow], depth: int) -> TRowsGenerator:
+        spills = [SpillFile() for _ in range(self.partitions)]
+        try:
+            write_partitioned(rows, lambda row: stable_hash(self._group_key(row), depth) % self.partitions,
+                              spills)
+            for spill in spills:
+                yield from self._reduce(iter(spill), depth + 1)
+        finally:
+            for spill in spills:
+                spill.close()
+
+    def _reduce_algebraic(self, reducer: AlgebraicReducer, rows: tp.Iterator[TRow]) -> TRowsGenerator:
+        # group key -> [key_row, state]
+        groups: dict[tuple[tp.Any, ...], list[tp.Any]] = {}
+        spills: list[SpillFile] = []
+        try:
+            for row in rows:
+                key = self._group_key(row)
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = [{col: row[col] for col in self.keys}, reducer.init()]
+                group[1] = reducer.fold(group[1], row)
+                if len(groups) > self.memory_limit:
+                    if not spills:
+                        spills = [SpillFile() for _ in range(self.partitions)]
+                    self._spill_states(groups, spills, 0)
+                    groups = {}
+
+            if not spills:
+                for key_row, state in groups.values():
+                    yield from reducer.finalize(key_row, state)
+                return
+
+            self._spill_states(groups, spills, 0)
+            for spill in spills:
+                yield from self._merge_states(reducer, iter(spill), 1)
+        finally:
+            for spill in spills:
+                spill.close()
+
+    def _merge_states(self, reducer: AlgebraicReducer, states: tp.Iterator[tuple[tp.Any, ...]],
+                      depth: int) -> TRowsGenerator:
+        # Partial states of a partition are merged in memory, or partitioned again by another seed
+        # while they hold more than memory_limit groups
+        groups: dict[tuple[tp.Any, ...], list[tp.Any]] = {}
+        spills: list[SpillFile] = []
+        try:
+            for key, key_row, state in states:
+                group = groups.get(key)
+                if group is None:
+                    groups[key] = [key_row, state]
+                else:
+                    group[1] = reducer.merge(group[1], state)
+                if len(groups) > self.memory_limit and depth < HASH_REDUCE_MAX_DEPTH:
+                    if not spills:
+                        spills = [SpillFile() for _ in range(self.partitions)]
+                    self._spill_states(groups, spills, depth)
+                    groups = {}
+
+            if not spills:
+                for key_row, state in groups.values():
+                    yield from reducer.finalize(key_row, state)
+                return
+
+            self._spill_states(groups, spills, depth)
+            for spill in spills:
+                yield from self._merge_states(reducer, iter(spill), depth + 1)
+        finally:
+            for spill in spills:
+                spill.close()
+
+    @staticmethod
+    def _spill_states(groups: dict[tuple[tp.Any, ...], list[tp.Any]], spills: list[SpillFile], depth: int) -> None:
+        write_partitioned(((key, key_row, state) for key, (key_row, state) in groups.items()),
+                          lambda item: stable_hash(item[0], depth) % len(spills), spills)
+
+
+class Combine(Operation):
+    """
+    Map-side pre-aggregation for algebraic reducers, meant to shrink data before a sort.
+    Rows are folded into a bounded hash table of group states; when it holds more than max_groups groups,
+    and when the input ends, every group is emitted as a row of its key columns and its partial state.
+    Reduce with the same reducer and keys merges these rows into the final result
+    """
+
+    def __init__(self, reducer: AlgebraicReducer, keys: tp.Sequence[str],
+                 max_groups: int = COMBINE_MAX_GROUPS) -> None:
+        """
+        :param reducer: reducer which will finish aggregation
+        :param keys: keys for grouping
+        :param max_groups: maximum number of groups kept in memory
+        """
+        assert isinstance(reducer, AlgebraicReducer)
+        self.reducer = reducer
+        self.keys = keys
+        self.max_groups = max_groups
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any,
+                 **kwargs: tp.Any) -> TRowsGenerator:
+        reducer = self.reducer
+        # group key -> [key_row, state]
+        groups: dict[tuple[tp.Any, ...], list[tp.Any]] = {}
+        for row in rows:
+            key = tuple(row[col] for col in self.keys)
+            group = groups.get(key)
+            if group is None:
+                if len(groups) == self.max_groups:
+                    yield from self._flush(groups)
+                    groups = {}
+                group = groups[key] = [{col: row[col] for col in self.keys}, reducer.init()]
+            group[1] = reducer.fold(group[1], row)
+        yield from self._flush(groups)
+
+    @staticmethod
+    def _flush(groups: dict[tuple[tp.Any, ...], list[tp.Any]]) -> TRowsGenerator:
+        for key_row, state in groups.values():
+            key_row[PARTIAL_STATE] = state
+            yield key_row
+
+
 # Dummy reducer
-class FirstReducer(Reducer):
+class FirstReducer(AlgebraicReducer):
     """Yield only first row from passed ones"""
 
-    def __call__(self, group_key: tp.Tuple[str, ...],
-                 rows: TRowsIterable) -> TRowsGenerator:
-        for row in rows:
-            yield row
-            break
+    def init(self) -> TRow | None:
+        return None
+
+    def update(self, state: TRow | None, row: TRow) -> TRow:
+        return state if state is not None else row
+
+    def update_batch(self, state: TRow | None, rows: list[TRow]) -> TRow | None:
+        return state if state is not None or not rows else rows[0]
+
+    def merge(self, state_a: TRow | None, state_b: TRow | None) -> TRow | None:
+        return state_a if state_a is not None else state_b
+
+    def finalize(self, key_row: TRow, state: TRow | None) -> TRowsGenerator:
+        if state is not None:
+            yield state
 
 
 # Reducers
-class Count(Reducer):
+class Count(AlgebraicReducer):
     """
     Counts records by key
     Example for group_key=('a',) and column='d'
@@ -55,20 +239,27 @@ class Count(Reducer):
         """
         self.column = column
 
-    def __call__(self, group_key: tp.Tuple[str, ...],
-                 rows: TRowsIterable) -> TRowsGenerator:
-        cnt = 0
-        res_row: TRow = {}
-        for row in rows:
-            if not res_row:
-                res_row = {col: row[col] for col in group_key}
-            cnt += 1
+    def reads(self) -> tp.Collection[str]:
+        return ()
+
+    def init(self) -> int:
+        return 0
+
+    def update(self, state: int, row: TRow) -> int:
+        return state + 1
+
+    def update_batch(self, state: int, rows: list[TRow]) -> int:
+        return state + len(rows)
+
+    def merge(self, state_a: int, state_b: int) -> int:
+        return state_a + state_b
 
-        res_row[self.column] = cnt
-        yield res_row
+    def finalize(self, key_row: TRow, state: int) -> TRowsGenerator:
+        key_row[self.column] = state
+        yield key_row
 
 
-class CountUnique(Reducer):
+class CountUnique(AlgebraicReducer):
     """Count the number of unique values of specific column"""
 
     def __init__(self, column: str, result_column: str) -> None:
@@ -79,21 +270,35 @@ class CountUnique(Reducer):
         self.column = column
         self.result_column = result_column
 
-    def __call__(self, group_key: tp.Tuple[str, ...],
-                 rows: TRowsIterable) -> TRowsGenerator:
-        values_set = set()
-        res_row: TRow = {}
-        for row in rows:
-            if not res_row and group_key:
-                res_row = {col: row[col] for col in group_key}
-            if row[self.column] not in values_set:
-                values_set.add(row[self.column])
-        res_row[self.result_column] = len(values_set)
-        yield res_row
+    def reads(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def init(self) -> set[tp.Any]:
+        return set()
+
+    def update(self, state: set[tp.Any], row: TRow) -> set[tp.Any]:
+        state.add(row[self.column])
+        return state
+
+    def update_batch(self, state: set[tp.Any], rows: list[TRow]) -> set[tp.Any]:
+        state.update(map(itemgetter(self.column), rows))
+        return state
 
+    def merge(self, state_a: set[tp.Any], state_b: set[tp.Any]) -> set[tp.Any]:
+        state_a |= state_b
+        return state_a
 
-class TopN(Reducer):
-    """Calculate top N by value"""
+    def finalize(self, key_row: TRow, state: set[tp.Any]) -> TRowsGenerator:
+        key_row[self.result_column] = len(state)
+        yield key_row
+
+
+class TopN(AlgebraicReducer):
+    """
+    Calculate top N by value.
+    State is a min-heap of (value, -number of the row, row) of the top rows and the number of rows seen,
+    so of equal values the earlier rows are kept and emitted first, as by heapq.nlargest
+    """
 
     def __init__(self, column: str, n: int) -> None:
         """
@@ -103,12 +308,42 @@ class TopN(Reducer):
         self.column_max = column
         self.n = n
 
-    def __call__(self, group_key: tp.Tuple[str, ...],
-                 rows: TRowsIterable) -> TRowsGenerator:
-        yield from heapq.nlargest(self.n, rows, key=lambda row: row[self.column_max])
+    def init(self) -> list[tp.Any]:
+        return [[], 0]
+
+    def _push(self, heap: list[tuple[tp.Any, int, TRow]], item: tuple[tp.Any, int, TRow]) -> None:
+        # Numbers of rows are unique, so rows themselves are never compared
+        if len(heap) < self.n:
+            heapq.heappush(heap, item)
+        elif heap and item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def update(self, state: list[tp.Any], row: TRow) -> list[tp.Any]:
+        self._push(state[0], (row[self.column_max], -state[1], row))
+        state[1] += 1
+        return state
+
+    def update_batch(self, state: list[tp.Any], rows: list[TRow]) -> list[tp.Any]:
+        heap, seen, column, push = state[0], state[1], self.column_max, self._push
+        for number, row in enumerate(rows, seen):
+            push(heap, (row[column], -number, row))
+        state[1] = seen + len(rows)
+        return state
+
+    def merge(self, state_a: list[tp.Any], state_b: list[tp.Any]) -> list[tp.Any]:
+        # Rows of state_b come after all rows of state_a
+        heap, offset = state_a[0], state_a[1]
+        for value, negative_number, row in state_b[0]:
+            self._push(heap, (value, negative_number - offset, row))
+        state_a[1] += state_b[1]
+        return state_a
+
+    def finalize(self, key_row: TRow, state: list[tp.Any]) -> TRowsGenerator:
+        for _, _, row in sorted(state[0], key=itemgetter(0, 1), reverse=True):
+            yield row
 
 
-class TermFrequency(Reducer):
+class TermFrequency(AlgebraicReducer):
     """Calculate frequency of values in column"""
 
     def __init__(self, words_column: str, result_column: str = 'tf') -> None:
@@ -119,30 +354,31 @@ class TermFrequency(Reducer):
         self.words_column = words_column
         self.result_column = result_column
 
-    def __call__(self, group_key: tp.Tuple[str, ...],
-                 rows: TRowsIterable) -> TRowsGenerator:
-        cnt_words = 0
-        counter: dict[tp.Any, int] = Counter()
-        res_row: TRow = {}
+    def reads(self) -> tp.Collection[str]:
+        return (self.words_column,)
 
-        for row in rows:
-            if not res_row:
-                res_row = {col: row[col] for col in group_key}
-            if row[self.words_column] not in counter:
-                counter[row[self.words_column]] = 1
-            else:
-                counter[row[self.words_column]] += 1
-            cnt_words += 1
-
-        for key, val in counter.items():
-            tf = val / cnt_words
-            row = copy.copy(res_row)
-            row[self.words_column] = key
-            row[self.result_column] = tf
-            yield row
+    def init(self) -> Counter[tp.Any]:
+        return Counter()
+
+    def update(self, state: Counter[tp.Any], row: TRow) -> Counter[tp.Any]:
+        state[row[self.words_column]] += 1
+        return state
 
+    def update_batch(self, state: Counter[tp.Any], rows: list[TRow]) -> Counter[tp.Any]:
+        state.update(map(itemgetter(self.words_column), rows))
+        return state
 
-class Sum(Reducer):
+    def merge(self, state_a: Counter[tp.Any], state_b: Counter[tp.Any]) -> Counter[tp.Any]:
+        state_a.update(state_b)
+        return state_a
+
+    def finalize(self, key_row: TRow, state: Counter[tp.Any]) -> TRowsGenerator:
+        cnt_words = sum(state.values())
+        for key, val in state.items():
+            yield {**key_row, self.words_column: key, self.result_column: val / cnt_words}
+
+
+class Sum(AlgebraicReducer):
     """
     Sum values aggregated by key
     Example for key=('a',) and column='b'
@@ -158,21 +394,30 @@ class Sum(Reducer):
         """
         self.column = column
 
-    def __call__(self, group_key: tp.Tuple[str, ...],
-                 rows: TRowsIterable) -> TRowsGenerator:
-        sum_ = 0
-        res_row: TRow = {}
-        for row in rows:
-            if not res_row:
-                res_row = {col: row[col] for col in group_key}
-            sum_ += row[self.column]
-        res_row[self.column] = sum_
-        yield res_row
+    def reads(self) -> tp.Collection[str]:
+        return (self.column,)
 
+    def init(self) -> tp.Any:
+        return 0
 
-class Speed(Reducer):
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        return state + row[self.column]
+
+    def update_batch(self, state: tp.Any, rows: list[TRow]) -> tp.Any:
+        return state + sum(map(itemgetter(self.column), rows))
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return state_a + state_b
+
+    def finalize(self, key_row: TRow, state: tp.Any) -> TRowsGenerator:
+        key_row[self.column] = state
+        yield key_row
+
+
+class Speed(AlgebraicReducer):
     """
     Calculate avarage speed for specific weekday and hour
+    State of a group is the pair (total distance, total time in hours)
     """
     A_MICROSECOND_IN_SECONDS = 10**(-6)
     AN_HOUR_IN_SECONDS = 3600
@@ -192,28 +437,36 @@ class Speed(Reducer):
         self.time_format = time_format
         self.result = result
 
-    def __call__(self, group_key: tp.Tuple[str, ...],
-                 rows: TRowsIterable) -> TRowsGenerator:
-        all_distance: float = 0
-        all_time: float = 0
-        res_row: TRow = {}
+    def reads(self) -> tp.Collection[str]:
+        return self.distance, self.start, self.end
 
-        def get_dt(str_to_datetime: str) -> datetime:
-            try:
-                dt = datetime.strptime(str_to_datetime, self.time_format)
-            except ValueError:
-                dt = datetime.strptime(str_to_datetime, '%Y%m%dT%H%M%S')
-            return dt
+    def _get_dt(self, str_to_datetime: str) -> datetime:
+        try:
+            dt = datetime.strptime(str_to_datetime, self.time_format)
+        except ValueError:
+            dt = datetime.strptime(str_to_datetime, '%Y%m%dT%H%M%S')
+        return dt
 
-        for row in rows:
-            if not res_row:
-                res_row = {col: row[col] for col in group_key}
-            dt_1 = get_dt(row[self.start])
-            dt_2 = get_dt(row[self.end])
+    def init(self) -> tuple[float, float]:
+        return 0, 0
 
-            td = dt_2 - dt_1
-            all_time += (td.seconds + td.microseconds * self.A_MICROSECOND_IN_SECONDS) / self.AN_HOUR_IN_SECONDS
-            all_distance += row[self.distance]
+    def update(self, state: tuple[float, float], row: TRow) -> tuple[float, float]:
+        td = self._get_dt(row[self.end]) - self._get_dt(row[self.start])
+        hours = (td.seconds + td.microseconds * self.A_MICROSECOND_IN_SECONDS) / self.AN_HOUR_IN_SECONDS
+        return state[0] + row[self.distance], state[1] + hours
 
-        res_row[self.result] = all_distance / all_time
-        yield res_row
+    def update_batch(self, state: tuple[float, float], rows: list[TRow]) -> tuple[float, float]:
+        distance, hours = state
+        for row in rows:
+            td = self._get_dt(row[self.end]) - self._get_dt(row[self.start])
+            hours += (td.seconds + td.microseconds * self.A_MICROSECOND_IN_SECONDS) / self.AN_HOUR_IN_SECONDS
+            distance += row[self.distance]
+        return distance, hours
+
+    def merge(self, state_a: tuple[float, float], state_b: tuple[float, float]) -> tuple[float, float]:
+        return state_a[0] + state_b[0], state_a[1] + state_b[1]
+
+    def finalize(self, key_row: TRow, state: tuple[float, float]) -> TRowsGenerator:
+        all_distance, all_time = state
+        key_row[self.result] = all_distance / all_time
+        yield key_row
@@ -0,0 +1,189 @@
+import typing as tp
+from abc import abstractmethod
+from collections.abc import MutableMapping
+from operator import attrgetter, itemgetter
+
+
+class CompactRow(MutableMapping[str, tp.Any]):
+    """
+    Row of a fixed schema keeping its values in slots, unlike a dict which stores a hash table of column
+    names in every row. Columns out of the schema are kept in a dict created for the first of them.
+    Rows pickle as a tuple of values with the tuple of schema columns, which pickle writes once per dump.
+    Create rows with compact_row_type; they are mappings but not dicts, convert them with dict() for json
+    """
+    __slots__ = ('_extra',)
+    columns: tuple[str, ...] = ()
+    _index: dict[str, int] = {}
+    _slots: tuple[tp.Any, ...] = ()
+    _getters: tuple[tp.Callable[['CompactRow'], tp.Any], ...] = ()
+    # Tuples of values of all schema columns of a mapping and of a compact row
+    _values_of: tp.Callable[[tp.Mapping[str, tp.Any]], tuple[tp.Any, ...]]
+    _slot_values: tp.Callable[['CompactRow'], tuple[tp.Any, ...]]
+
+    @abstractmethod
+    def __init__(self, values: tp.Iterable[tp.Any]) -> None:
+        """
+        Generated for every schema by compact_row_type, CompactRow itself can not be instantiated
+        :param values: values of all columns of the schema
+        """
+
+    @classmethod
+    def from_row(cls, row: tp.Mapping[str, tp.Any]) -> 'CompactRow':
+        """Compact row of the columns of a row"""
+        if len(row) == len(cls.columns):
+            try:
+                return cls(cls._values_of(row))
+            except KeyError:
+                pass
+        compact = cls.__new__(cls)
+        compact._extra = None
+        index, slots = cls._index, cls._slots
+        for column, value in row.items():
+            position = index.get(column)
+            if position is not None:
+                slots[position].__set__(compact, value)
+            else:
+                if compact._extra is None:
+                    compact._extra = {}
+                compact._extra[column] = value
+        return compact
+
+    def __getitem__(self, key: str) -> tp.Any:
+        position = self._index.get(key)
+        if position is not None:
+            try:
+                return self._getters[position](self)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key: str, value: tp.Any) -> None:
+        position = self._index.get(key)
+        if position is not None:
+            self._slots[position].__set__(self, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        position = self._index.get(key)
+        if position is not None:
+            try:
+                self._slots[position].__delete__(self)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key: object) -> bool:
+        position = self._index.get(key)  # type: ignore
+        if position is not None:
+            return hasattr(self, self._slots[position].__name__)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self) -> tp.Iterator[str]:
+        try:
+            self._slot_values(self)
+        except AttributeError:
+            for column, getter in zip(self.columns, self._getters):
+                try:
+                    getter(self)
+                except AttributeError:
+                    continue
+                yield column
+        else:
+            yield from self.columns
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def _values(self) -> tuple[tuple[tp.Any, ...], tuple[int, ...]]:
+        """Values of schema columns, None for missing ones, and positions of missing ones"""
+        try:
+            return self._slot_values(self), ()
+        except AttributeError:
+            pass
+        values = []
+        missing = []
+        for position, getter in enumerate(self._getters):
+            try:
+                values.append(getter(self))
+            except AttributeError:
+                values.append(None)
+                missing.append(position)
+        return tuple(values), tuple(missing)
+
+    def copy(self) -> 'CompactRow':
+        values, missing = self._values()
+        return _restore(self.columns, values, self._extra, missing)
+
+    def retain(self, columns: tp.Iterable[str]) -> 'CompactRow':
+        """Compact row of the listed columns this row has"""
+        present = tuple(col for col in columns if col in self)
+        return compact_row_type(present)(self[col] for col in present)
+
+    def __reduce__(self) -> tuple[tp.Any, ...]:
+        values, missing = self._values()
+        if self._extra is None and not missing:
+            return _restore, (self.columns, values)
+        return _restore, (self.columns, values, self._extra, missing)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+# Row types by their schemas, equal schemas share one type
+_ROW_TYPES: dict[tuple[str, ...], type[CompactRow]] = {}
+
+
+def compact_row_type(columns: tp.Iterable[str]) -> type[CompactRow]:
+    """Type of compact rows with the given schema columns"""
+    columns = tuple(columns)
+    row_type = _ROW_TYPES.get(columns)
+    if row_type is None:
+        assert len(set(columns)) == len(columns), 'schema columns must be unique'
+        names = tuple(f'_{position}' for position in range(len(columns)))
+        # Unpacking into slots is much faster than setting them one by one through their descriptors
+        namespace: dict[str, tp.Any] = {}
+        targets = ''.join(f'self.{name}, ' for name in names) or '()'
+        exec(f'def __init__(self, values):\n    self._extra = None\n    {targets} = values\n', namespace)
+        row_type = tp.cast(type[CompactRow], type('CompactRow', (CompactRow,), {
+            '__slots__': names,
+            '__init__': namespace['__init__'],
+            'columns': columns,
+            '_index': {column: position for position, column in enumerate(columns)},
+        }))
+        row_type._slots = tuple(row_type.__dict__[name] for name in names)
+        row_type._getters = tuple(attrgetter(name) for name in names)
+        row_type._values_of = staticmethod(_tuple_getter(itemgetter, columns))
+        row_type._slot_values = staticmethod(_tuple_getter(attrgetter, names))
+        _ROW_TYPES[columns] = row_type
+    return row_type
+
+
+def _tuple_getter(getter: tp.Callable[..., tp.Callable[[tp.Any], tp.Any]],
+                  items: tuple[str, ...]) -> tp.Callable[[tp.Any], tuple[tp.Any, ...]]:
+    """itemgetter or attrgetter of several items, returning a tuple for any number of them"""
+    if not items:
+        return lambda obj: ()
+    if len(items) == 1:
+        get = getter(items[0])
+        return lambda obj: (get(obj),)
+    return getter(*items)
+
+
+def _restore(columns: tuple[str, ...], values: tuple[tp.Any, ...], extra: dict[str, tp.Any] | None = None,
+             missing: tuple[int, ...] = ()) -> CompactRow:
+    row = compact_row_type(columns)(values)
+    if extra is not None:
+        row._extra = dict(extra)
+    for position in missing:
+        row._slots[position].__delete__(row)
+    return row
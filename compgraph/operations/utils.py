@@ -1,5 +1,9 @@
 from collections.abc import Callable
+import numbers
+import pickle
+import tempfile
 import typing as tp
+import zlib
 from itertools import groupby
 
 TRow = tp.Dict[str, tp.Any]
@@ -10,9 +14,86 @@ def keyfunc(keys: tp.Sequence[str]) -> Callable[[TRow], list[str]]:
     return lambda row: [row[i] for i in keys]
 
 
+def _normalized(value: tp.Any) -> tp.Any:
+    # Equal numbers (1, 1.0, True, numpy integers) are equal keys of dicts, so they must hash alike
+    if value.__class__ is str or value.__class__ is int:
+        return value
+    if isinstance(value, tuple):
+        return tuple(map(_normalized, value))
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        value = float(value)
+        return int(value) if value.is_integer() else value
+    return value
+
+
+def stable_hash(value: tp.Any, seed: int = 0) -> int:
+    """Hash which, unlike the salted built-in hash of strings, is the same in every process.
+    Equal numbers of different types hash alike, as they fall into one group of a dict.
+    Hashes of different seeds are independent, so a partition by one seed splits again by another"""
+    crc = zlib.crc32(repr(_normalized(value)).encode())
+    if not seed:
+        return crc
+    # crc32 started from another value differs by a constant for values of one length, which keeps
+    # them together modulo a power of two; multiplicative hashing mixes all bits into the high ones
+    return ((crc ^ seed * 0x9E3779B9) * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF) >> 32
+
+
 def groupby_verbose(rows: TRowsIterable, key: tp.Callable[[TRow], list[str]]) -> tp.Any:
     prev_key: tp.Any = None
     for k, group in groupby(rows, key=key):
         assert prev_key is None or prev_key <= k
         yield k, group
         prev_key = k
+
+
+class SpillFile:
+    """Temporary file holding pickled batches of rows; batches may be appended while it is being read"""
+
+    def __init__(self, directory: str | None = None) -> None:
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._end = 0
+        self.batches = 0
+
+    def write(self, rows: tp.Sequence[TRow]) -> None:
+        self._file.seek(self._end)
+        pickle.dump(list(rows), self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._end = self._file.tell()
+        self.batches += 1
+
+    def read_batches(self) -> tp.Iterator[list[TRow]]:
+        position = 0
+        while position < self._end:
+            self._file.seek(position)
+            batch = pickle.load(self._file)
+            position = self._file.tell()
+            yield batch
+
+    def __iter__(self) -> tp.Iterator[TRow]:
+        for batch in self.read_batches():
+            yield from batch
+
+    def clear(self) -> None:
+        self._file.seek(0)
+        self._file.truncate()
+        self._end = 0
+        self.batches = 0
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def write_partitioned(items: tp.Iterable[tp.Any], partition: tp.Callable[[tp.Any], int],
+                      spills: tp.Sequence[SpillFile], batch_size: int = 1024) -> None:
+    """Write every item to spills[partition(item)], batching writes per partition"""
+    batches: list[list[tp.Any]] = [[] for _ in spills]
+    for item in items:
+        index = partition(item)
+        batches[index].append(item)
+        if len(batches[index]) == batch_size:
+            spills[index].write(batches[index])
+            batches[index] = []
+    for spill, batch in zip(spills, batches):
+        if batch:
+            spill.write(batch)
@@ -0,0 +1,383 @@
+import typing as tp
+from itertools import takewhile
+
+from . import operations as ops
+from .external_sort import ExternalSort, GroupSort
+from .parallel import ParallelMap
+
+if tp.TYPE_CHECKING:
+    from .graph import Graph
+
+# Columns the rows of a node are sorted by, outermost first; empty if nothing is known
+TOrdering = tuple[str, ...]
+# Set of columns, None for all (or unknown) columns
+TColumns = frozenset[str] | None
+
+# Operations whose inputs are projected to the columns used later, as they copy, pickle or merge whole rows
+PROJECTED_INPUTS = (ExternalSort, ops.Join, ops.HashJoin)
+
+
+def mapper_ordering(mapper: ops.Mapper, ordering: TOrdering) -> TOrdering:
+    """Part of the input ordering still valid after a mapper: the columns before the first one it changes"""
+    if isinstance(mapper, (ops.Project, ops.Retain)):
+        return tuple(takewhile(lambda col: col in mapper.columns, ordering))
+    written = mapper.writes()
+    if written is None:
+        return ()
+    return tuple(takewhile(lambda col: col not in written, ordering))
+
+
+def mapper_input_columns(mapper: ops.Mapper, needed: TColumns) -> TColumns:
+    """Columns a mapper needs in its input rows to produce the needed columns of its output"""
+    if isinstance(mapper, ops.Project):
+        # Project fails on rows without its columns
+        return frozenset(mapper.columns)
+    read, written = mapper.reads(), mapper.writes()
+    if needed is None or read is None or written is None:
+        return None
+    return needed.difference(written).union(read)
+
+
+def mapper_output_columns(mapper: ops.Mapper, columns: TColumns) -> TColumns:
+    """Columns rows may have after a mapper given columns they may have before it"""
+    if isinstance(mapper, ops.Project):
+        return frozenset(mapper.columns)
+    if isinstance(mapper, ops.Retain):
+        return frozenset(mapper.columns) if columns is None else columns.intersection(mapper.columns)
+    written = mapper.writes()
+    if columns is None or written is None:
+        return None
+    return columns.union(written)
+
+
+def input_columns(operation: ops.Operation, needed: TColumns) -> TColumns:
+    """Columns an operation needs in rows of every input to produce the needed columns of its output"""
+    if isinstance(operation, (ops.Map, ParallelMap)):
+        return mapper_input_columns(operation.mapper, needed)
+    if isinstance(operation, ops.FusedMap):
+        for mapper in reversed(operation.mappers):
+            needed = mapper_input_columns(mapper, needed)
+        return needed
+    if isinstance(operation, (ExternalSort, GroupSort)):
+        return None if needed is None else needed.union(operation.keys)
+    if isinstance(operation, (ops.Reduce, ops.HashReduce, ops.Combine)):
+        read = operation.reducer.reads()
+        # Rows coming from Combine carry partial states of the groups
+        return None if read is None else frozenset((*operation.keys, *read, ops.PARTIAL_STATE))
+    if isinstance(operation, (ops.Join, ops.HashJoin)) and needed is not None:
+        # Columns colliding between the inputs are renamed with suffixes; both inputs keep every column
+        # some suffixed output column comes from, so collisions stay the same
+        suffixes = operation.joiner._a_suffix, operation.joiner._b_suffix
+        renamed = {col[:-len(suffix)] for col in needed for suffix in suffixes if suffix and col.endswith(suffix)}
+        return needed.union(operation.keys, renamed)
+    return None
+
+
+def output_columns(operation: ops.Operation, inputs: list[TColumns]) -> TColumns:
+    """Columns rows an operation emits may have given columns rows of its inputs may have, None if unknown"""
+    if isinstance(operation, (ops.Map, ParallelMap)):
+        return mapper_output_columns(operation.mapper, inputs[0])
+    if isinstance(operation, ops.FusedMap):
+        columns = inputs[0]
+        for mapper in operation.mappers:
+            columns = mapper_output_columns(mapper, columns)
+        return columns
+    if isinstance(operation, (ExternalSort, GroupSort)):
+        return inputs[0]
+    if isinstance(operation, ops.Combine):
+        return frozenset((*operation.keys, ops.PARTIAL_STATE))
+    if isinstance(operation, (ops.Join, ops.HashJoin)):
+        columns_a, columns_b = inputs
+        if columns_a is None or columns_b is None or (columns_a & columns_b).difference(operation.keys):
+            return None
+        return columns_a | columns_b
+    return None
+
+
+def filter_commutes(condition_columns: tp.AbstractSet[str], operation: ops.Operation) -> list[int]:
+    """Inputs of an operation a filter using condition_columns can be moved to without changing the result"""
+    if isinstance(operation, (ExternalSort, GroupSort)):
+        return [0]
+    if isinstance(operation, (ops.Map, ParallelMap)):
+        mapper = operation.mapper
+        if isinstance(mapper, (ops.Project, ops.Retain)):
+            return [0] if condition_columns <= set(mapper.columns) else []
+        written = mapper.writes()
+        return [0] if written is not None and condition_columns.isdisjoint(written) else []
+    if not getattr(operation, 'keys', None) or not condition_columns <= set(operation.keys):
+        return []
+    if isinstance(operation, (ops.Reduce, ops.HashReduce, ops.Combine)):
+        return [0]
+    if isinstance(operation, (ops.Join, ops.HashJoin)):
+        # Rows of both inputs are matched on equal keys, rows with keys the filter drops never match others
+        return [0, 1]
+    return []
+
+
+def _common_prefix(a: TOrdering, b: TOrdering) -> TOrdering:
+    length = 0
+    while length < min(len(a), len(b)) and a[length] == b[length]:
+        length += 1
+    return a[:length]
+
+
+def output_ordering(operation: ops.Operation, inputs: list[TOrdering]) -> TOrdering:
+    """Ordering of the rows an operation emits given orderings of its inputs"""
+    if isinstance(operation, ops.Map):
+        return mapper_ordering(operation.mapper, inputs[0])
+    if isinstance(operation, ParallelMap):
+        return mapper_ordering(operation.mapper, inputs[0]) if operation.ordered else ()
+    if isinstance(operation, ops.FusedMap):
+        ordering = inputs[0]
+        for mapper in operation.mappers:
+            ordering = mapper_ordering(mapper, ordering)
+        return ordering
+    if isinstance(operation, ExternalSort):
+        # The sort is stable, rows equal on its keys keep their input order
+        keys = tuple(operation.keys)
+        return inputs[0] if inputs[0][:len(keys)] == keys else keys
+    if isinstance(operation, (GroupSort, ops.Reduce, ops.Join)):
+        return tuple(operation.keys)
+    if isinstance(operation, ops.Combine):
+        # Groups are emitted in order of their first rows and only key columns are left
+        return tuple(takewhile(lambda col: col in operation.keys, inputs[0]))
+    return ()
+
+
+def describe(operation: ops.Operation | None) -> str:
+    """Short name of an operation for plans"""
+    if operation is None:
+        return 'Empty'
+    name = type(operation).__name__
+    if isinstance(operation, ops.Read):
+        return f'{name}({operation.filename!r})'
+    if isinstance(operation, ops.ReadIterFactory):
+        return f'{name}({operation.name!r})'
+    if isinstance(operation, ops.FusedMap):
+        return f'{name}({", ".join(type(mapper).__name__ for mapper in operation.mappers)})'
+    for attribute in ('mapper', 'reducer', 'joiner'):
+        if hasattr(operation, attribute):
+            name = f'{name}({type(getattr(operation, attribute)).__name__})'
+    keys = getattr(operation, 'keys', None)
+    if keys:
+        name = f'{name} by {", ".join(keys)}'
+    return name
+
+
+class Plan:
+    """
+    Logical plan of a graph, rewritten without changing the result of the graph:
+    filters declaring their columns are moved towards the sources past operations they commute with,
+    Split with FilterPunctuation and LowerCase of the same column right before it becomes one Tokenize,
+    sorts of rows already ordered by their keys are dropped and sorts of rows ordered by a prefix of their keys
+    only sort groups equal on the prefix (GroupSort); inputs of sorts and joins are projected to the columns
+    used later (Retain) when they have columns known to be unused or come right from a source
+    """
+
+    def __init__(self, graph: 'Graph') -> None:
+        """
+        :param graph: graph to plan
+        """
+        self.logical = self._tokenized(self._push_filters(graph))
+        self.orderings: dict['Graph', TOrdering] = {}
+        # Sort nodes of the logical graph -> ordering of their input they rely on
+        self.dropped: dict['Graph', TOrdering] = {}
+        self.weakened: dict['Graph', TOrdering] = {}
+        self.required = self._required_columns(self.logical)
+        self.available: dict['Graph', TColumns] = {}
+        # (node, index of its input) -> columns the input is projected to
+        self.projections: dict[tuple['Graph', int], frozenset[str]] = {}
+        self.graph = self._rewrite(self.logical, {})
+
+    @staticmethod
+    def _push_filters(graph: 'Graph') -> 'Graph':
+        consumers: dict['Graph', int] = {}
+        graph._count_consumers(consumers)
+        # Node of the new graph -> number of its consumers
+        counts: dict['Graph', int] = {}
+        rewritten: dict['Graph', 'Graph'] = {}
+
+        def filtered(operation: ops.Map, graph: 'Graph') -> 'Graph':
+            read = operation.mapper.reads()
+            assert read is not None
+            inputs = filter_commutes(set(read), graph.operation) if graph.operation is not None else []
+            if not inputs or any(counts[graph._parents[i]] > 1 for i in inputs):
+                return graph._graph_maker(operation, [graph])
+            parents = list(graph._parents)
+            for i in inputs:
+                parents[i] = filtered(operation, parents[i])
+                counts[parents[i]] = 1
+            return graph._graph_maker(graph.operation, parents)
+
+        def visit(graph: 'Graph') -> 'Graph':
+            if graph in rewritten:
+                return rewritten[graph]
+            parents = [visit(parent) for parent in graph._parents]
+            operation = graph.operation
+            if (isinstance(operation, ops.Map) and isinstance(operation.mapper, ops.Filter)
+                    and operation.mapper.reads() is not None and counts[parents[0]] == 1):
+                result = filtered(operation, parents[0])
+            else:
+                result = graph._graph_maker(operation, parents)
+            counts[result] = consumers.get(graph, 1)
+            rewritten[graph] = result
+            return result
+
+        return visit(graph)
+
+    @staticmethod
+    def _tokenized(graph: 'Graph') -> 'Graph':
+        consumers: dict['Graph', int] = {}
+        graph._count_consumers(consumers)
+        rewritten: dict['Graph', 'Graph'] = {}
+        normalizers = (ops.FilterPunctuation, ops.LowerCase)
+
+        def visit(graph: 'Graph') -> 'Graph':
+            if graph in rewritten:
+                return rewritten[graph]
+            operation = graph.operation
+            if isinstance(operation, ops.Map) and type(operation.mapper) is ops.Split:
+                column = operation.mapper.column
+                # Maps normalizing the column which nothing else reads, from the last one applied
+                found: list[type] = []
+                source = graph._parents[0]
+                while consumers[source] == 1 and isinstance(source.operation, ops.Map):
+                    kind = type(source.operation.mapper)
+                    if kind not in normalizers or kind in found or source.operation.mapper.column != column:
+                        break
+                    found.append(kind)
+                    source = source._parents[0]
+                tokenize = ops.Tokenize(column, operation.mapper.separator,
+                                        filter_punctuation=ops.FilterPunctuation in found,
+                                        lower_case=ops.LowerCase in found,
+                                        lower_case_first=found == [ops.FilterPunctuation, ops.LowerCase])
+                result = graph._graph_maker(ops.Map(tokenize), [visit(source)])
+            else:
+                result = graph._graph_maker(operation, [visit(parent) for parent in graph._parents])
+            rewritten[graph] = result
+            return result
+
+        return visit(graph)
+
+    @staticmethod
+    def _required_columns(graph: 'Graph') -> dict['Graph', TColumns]:
+        # Nodes in topological order, every node after its consumers
+        order: list['Graph'] = []
+        visited: set['Graph'] = set()
+
+        def visit(graph: 'Graph') -> None:
+            visited.add(graph)
+            for parent in graph._parents:
+                if parent not in visited:
+                    visit(parent)
+            order.append(graph)
+
+        visit(graph)
+        required: dict['Graph', TColumns] = {graph: None}
+        for node in reversed(order):
+            if node.operation is None:
+                continue
+            needed = input_columns(node.operation, required[node])
+            for parent in node._parents:
+                if parent not in required:
+                    required[parent] = needed
+                else:
+                    columns = required[parent]
+                    required[parent] = None if columns is None or needed is None else columns | needed
+        return required
+
+    def _rewrite(self, graph: 'Graph', rewritten: dict['Graph', 'Graph']) -> 'Graph':
+        if graph in rewritten:
+            return rewritten[graph]
+        parents = [self._rewrite(parent, rewritten) for parent in graph._parents]
+        inputs = [self.orderings[parent] for parent in graph._parents]
+        available = [self.available[parent] for parent in graph._parents]
+        operation = graph.operation
+        for i, parent in enumerate(graph._parents):
+            needed = input_columns(operation, self.required[graph]) if operation is not None else None
+            if needed is None:
+                continue
+            # Projections only pay off before operations keeping or spilling whole rows, and only when they drop
+            # columns: known to be unused, or possibly unused columns of sources, which are not known
+            if not isinstance(operation, PROJECTED_INPUTS):
+                continue
+            if available[i] is None:
+                if parent._parents or parent.operation is None:
+                    continue
+            elif not available[i] - needed:
+                continue
+            retain = ops.Retain(sorted(needed))
+            self.projections[graph, i] = needed
+            parents[i] = graph._graph_maker(ops.Map(retain), [parents[i]])
+            inputs[i] = mapper_ordering(retain, inputs[i])
+            available[i] = mapper_output_columns(retain, available[i])
+
+        result = None
+        if isinstance(operation, ExternalSort):
+            keys = tuple(operation.keys)
+            common = _common_prefix(inputs[0], keys)
+            if common == keys:
+                self.dropped[graph] = inputs[0]
+                result = parents[0]
+            elif common:
+                self.weakened[graph] = common
+                result = graph._graph_maker(GroupSort(operation, common), parents)
+        if result is None:
+            result = graph._graph_maker(operation, parents) if operation is not None else type(graph)()
+        if operation is not None:
+            self.orderings[graph] = output_ordering(operation, inputs)
+            self.available[graph] = output_columns(operation, available)
+        else:
+            self.orderings[graph] = ()
+            self.available[graph] = frozenset()
+        rewritten[graph] = result
+        return result
+
+    def explain(self) -> str:
+        """Text tree of the plan from the last node to the sources with orderings, rewritten sorts and
+        inserted projections; nodes shared by several consumers are expanded once and referred to by number later"""
+        lines: list[str] = []
+        numbers: dict['Graph', int] = {}
+        shared = self._shared()
+
+        def visit(graph: 'Graph', depth: int) -> None:
+            indent = '  ' * depth
+            if graph in numbers:
+                lines.append(f'{indent}#{numbers[graph]} {describe(graph.operation)} (see above)')
+                return
+            label = describe(graph.operation)
+            if graph in shared:
+                numbers[graph] = len(numbers) + 1
+                label = f'#{numbers[graph]} {label}'
+            lines.append(f'{indent}{label}  [{self._annotation(graph)}]')
+            for i, parent in enumerate(graph._parents):
+                if (graph, i) in self.projections:
+                    lines.append(f'{indent}  Retain({", ".join(sorted(self.projections[graph, i]))})')
+                    visit(parent, depth + 2)
+                else:
+                    visit(parent, depth + 1)
+
+        visit(self.logical, 0)
+        return '\n'.join(lines)
+
+    def _annotation(self, graph: 'Graph') -> str:
+        if graph in self.dropped:
+            return f'dropped, input ordered by {", ".join(self.dropped[graph])}'
+        if graph in self.weakened:
+            return f'sorts groups of rows equal on {", ".join(self.weakened[graph])}'
+        ordering = self.orderings[graph]
+        return f'ordered by {", ".join(ordering)}' if ordering else 'unordered'
+
+    def _shared(self) -> set['Graph']:
+        seen: set['Graph'] = set()
+        shared: set['Graph'] = set()
+        stack = [self.logical]
+        while stack:
+            graph = stack.pop()
+            for parent in graph._parents:
+                if parent in seen:
+                    shared.add(parent)
+                else:
+                    seen.add(parent)
+                    stack.append(parent)
+        return shared
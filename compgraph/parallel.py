@@ -0,0 +1,232 @@
+import contextlib
+import heapq
+import pickle
+import typing as tp
+from collections import deque
+from itertools import islice
+from multiprocessing import connection
+from operator import itemgetter
+
+from . import operations as ops
+from .external_sort import PIPE_BATCH_SIZE, _recv_batches, _send_batches
+from .operations.utils import SpillFile, groupby_verbose, stable_hash
+from .pool import WorkerPool, default_pool, recv_message
+
+MAP_CHUNK_SIZE = 1024
+PARTITIONABLE = (ops.Reduce, ops.HashReduce, ops.Join, ops.HashJoin)
+# Joiners whose every output row has the key columns, which outputs of ordered workers are merged by
+KEY_KEEPING_JOINERS = (ops.InnerJoiner, ops.OuterJoiner, ops.LeftJoiner, ops.RightJoiner)
+
+
+def _apply_mappers(rows: ops.TRowsIterable, mappers: tp.Sequence[ops.Mapper]) -> ops.TRowsIterable:
+    if len(mappers) > 1:
+        return ops.FusedMap(mappers)(rows)
+    if mappers:
+        return ops.Map(mappers[0])(rows)
+    return rows
+
+
+def _keyed(operation: ops.Operation, keys: tp.Sequence[str], inputs: tp.Sequence[ops.TRowsIterable],
+           mappers: tp.Sequence[ops.Mapper]) -> tp.Iterator[tuple[tp.Any, ops.TRow]]:
+    # Reducers and mappers may drop the key columns, so every output row is tagged with the key
+    # of the input group it came from
+    key = itemgetter(*keys)
+    keyed: tp.Iterable[tuple[tp.Any, ops.TRow]]
+    if isinstance(operation, ops.Reduce):
+        keyed = ((group_key, row) for group_key, group in groupby_verbose(inputs[0], key=key)
+                 for row in operation.reducer(tuple(keys), group))
+    else:
+        keyed = ((key(row), row) for row in operation(*inputs))
+    mapper = ops.FusedMap(mappers)
+    for row_key, row in keyed:
+        for mapped in mapper([row]):
+            yield row_key, mapped
+
+
+def do_partition(endpoint: connection.Connection, operation: ops.Operation, mappers: list[ops.Mapper],
+                 keys: tuple[str, ...], ordered: bool, inputs: int, directory: str | None,
+                 batch_size: int) -> None:
+    spills = [SpillFile(directory) for _ in range(inputs)]
+    try:
+        for index, batch in _recv_tagged(endpoint):
+            spills[index].write(batch)
+        inputs = [iter(spill) for spill in spills]
+        if ordered:
+            _send_batches(endpoint, _keyed(operation, keys, inputs, mappers), batch_size)
+        else:
+            _send_batches(endpoint, _apply_mappers(operation(*inputs), mappers), batch_size)
+    finally:
+        for spill in spills:
+            spill.close()
+
+
+def _recv_tagged(endpoint: connection.Connection) -> tp.Iterator[tuple[int, list[ops.TRow]]]:
+    while True:
+        message = pickle.loads(endpoint.recv_bytes())
+        if message is None:
+            break
+        yield message
+
+
+def _send_partitioned(endpoints: list[connection.Connection], index: int, rows: ops.TRowsIterable,
+                      keys: tp.Sequence[str], batch_size: int) -> None:
+    key = itemgetter(*keys)
+    batches: list[list[ops.TRow]] = [[] for _ in endpoints]
+    for row in rows:
+        partition = stable_hash(key(row)) % len(endpoints)
+        batches[partition].append(row)
+        if len(batches[partition]) == batch_size:
+            endpoints[partition].send_bytes(pickle.dumps((index, batches[partition]),
+                                                         protocol=pickle.HIGHEST_PROTOCOL))
+            batches[partition] = []
+    for endpoint, batch in zip(endpoints, batches):
+        if batch:
+            endpoint.send_bytes(pickle.dumps((index, batch), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class Partitioned(ops.Operation):
+    """
+    Runs a keyed operation (reduce or join) over hash partitions of its inputs in worker processes.
+    Rows are routed by a hash of their keys which is stable across processes, so every group lands
+    in one worker; each worker stores its partitions on disk, runs the operation over them and applies
+    mappers that follow it.
+    Streams of ordered operations (sort-based reduce and join) are subsequences of sorted inputs,
+    so outputs of workers are merged by keys and the result keeps the order of a sequential run;
+    outputs of hash-based operations are concatenated.
+    Operations which do not pickle, and sort-based joins with joiners which may drop the keys,
+    are run in the main process.
+    """
+
+    def __init__(self, operation: ops.Operation, keys: tp.Sequence[str], workers: int,
+                 mappers: tp.Sequence[ops.Mapper] = (), tmp_dir: str | None = None,
+                 batch_size: int = PIPE_BATCH_SIZE, pool: WorkerPool | None = None) -> None:
+        """
+        :param operation: keyed operation to run per partition
+        :param keys: keys to partition rows by
+        :param workers: number of partitions, each handled by its own worker
+        :param mappers: mappers applied to operation output inside workers
+        :param tmp_dir: directory for partitions stored by workers, system default if None
+        :param batch_size: number of rows sent through the pipe in one message
+        :param pool: worker pool to use, process-wide default pool if None
+        """
+        assert workers >= 1 and keys
+        self.operation = operation
+        self.keys = tuple(keys)
+        self.workers = workers
+        self.mappers = list(mappers)
+        self.tmp_dir = tmp_dir
+        self.batch_size = batch_size
+        self.pool = pool
+        self.ordered = isinstance(operation, (ops.Reduce, ops.Join))
+
+    def then(self, mapper: ops.Mapper) -> 'Partitioned':
+        """Same partitioned operation followed by one more mapper"""
+        return Partitioned(self.operation, self.keys, self.workers, self.mappers + [mapper],
+                           self.tmp_dir, self.batch_size, self.pool)
+
+    def _mergeable(self) -> bool:
+        return not isinstance(self.operation, ops.Join) or type(self.operation.joiner) in KEY_KEEPING_JOINERS
+
+    def _picklable(self) -> bool:
+        try:
+            pickle.dumps((self.operation, self.mappers))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return False
+        return True
+
+    def __call__(self, *inputs: ops.TRowsIterable, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        if self.workers == 1 or not self._mergeable() or not self._picklable():
+            yield from _apply_mappers(self.operation(*inputs), self.mappers)
+            return
+
+        pool = self.pool if self.pool is not None else default_pool()
+        with contextlib.ExitStack() as stack:
+            endpoints = [stack.enter_context(pool.task(do_partition, self.operation, self.mappers, self.keys,
+                                                       self.ordered, len(inputs), self.tmp_dir,
+                                                       self.batch_size))
+                         for _ in range(self.workers)]
+            for index, rows in enumerate(inputs):
+                _send_partitioned(endpoints, index, rows, self.keys, self.batch_size)
+            for endpoint in endpoints:
+                endpoint.send_bytes(pickle.dumps(None))
+
+            outputs = [self._receive(endpoint) for endpoint in endpoints]
+            if self.ordered:
+                for _, row in heapq.merge(*outputs, key=itemgetter(0)):
+                    yield row
+            else:
+                for output in outputs:
+                    yield from output
+
+    @staticmethod
+    def _receive(endpoint: connection.Connection) -> tp.Iterator[tp.Any]:
+        for batch, _ in _recv_batches(endpoint):
+            yield from batch
+
+
+def do_map(endpoint: connection.Connection, mapper: ops.Mapper) -> None:
+    while True:
+        chunk = pickle.loads(endpoint.recv_bytes())
+        if chunk is None:
+            break
+        result = list(mapper.map_batch(chunk))
+        endpoint.send_bytes(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class ParallelMap(ops.Operation):
+    """
+    Map which ships chunks of chunk_size rows to worker processes and streams mapped chunks back.
+    Every worker has at most one chunk in flight, so neither side blocks on a full pipe.
+    Ordered output keeps the input order; unordered output yields chunks as soon as any worker
+    finishes one. Mappers which do not pickle are run in the main process.
+    """
+
+    def __init__(self, mapper: ops.Mapper, workers: int, chunk_size: int = MAP_CHUNK_SIZE,
+                 ordered: bool = True, pool: WorkerPool | None = None) -> None:
+        """
+        :param mapper: mapper to use
+        :param workers: number of worker processes
+        :param chunk_size: number of rows sent to a worker at once
+        :param ordered: keep the input order of rows
+        :param pool: worker pool to use, process-wide default pool if None
+        """
+        assert workers >= 1 and chunk_size >= 1
+        self.mapper = mapper
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.pool = pool
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        try:
+            pickle.dumps(self.mapper)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            yield from ops.Map(self.mapper)(rows)
+            return
+
+        rows = iter(rows)
+        chunks = iter(lambda: list(islice(rows, self.chunk_size)), [])
+        pool = self.pool if self.pool is not None else default_pool()
+        with contextlib.ExitStack() as stack:
+            endpoints = [stack.enter_context(pool.task(do_map, self.mapper)) for _ in range(self.workers)]
+            busy = deque(endpoint for endpoint in endpoints if self._send(endpoint, chunks))
+            while busy:
+                if self.ordered:
+                    endpoint = busy.popleft()
+                else:
+                    endpoint = connection.wait(busy)[0]
+                    busy.remove(endpoint)
+                result, _ = recv_message(endpoint)
+                if self._send(endpoint, chunks):
+                    busy.append(endpoint)
+                yield from result
+            for endpoint in endpoints:
+                endpoint.send_bytes(pickle.dumps(None))
+
+    @staticmethod
+    def _send(endpoint: connection.Connection, chunks: tp.Iterator[list[ops.TRow]]) -> bool:
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        endpoint.send_bytes(pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL))
+        return True
@@ -0,0 +1,133 @@
+import dataclasses
+import queue
+import threading
+import typing as tp
+
+from . import operations as ops
+
+PIPELINE_QUEUE_SIZE = 8
+PIPELINE_BATCH_SIZE = 1024
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+@dataclasses.dataclass
+class StageStats:
+    """Counters of the queue a stage puts its output batches to"""
+    name: str
+    batches: int = 0
+    depth_sum: int = 0
+    blocked_puts: int = 0
+    starved_gets: int = 0
+
+    @property
+    def mean_depth(self) -> float:
+        """Mean number of batches waiting in the queue when the stage put a new one"""
+        return self.depth_sum / self.batches if self.batches else 0.0
+
+
+class Stage:
+    """
+    Operation output pulled by a dedicated thread and handed to the consumer through a bounded queue
+    of row batches; the thread blocks when the queue is full.
+    Often full queue (blocked puts) means the consumer is slower than the stage, often empty one
+    (starved gets) means the stage is the slower side
+    """
+
+    def __init__(self, name: str, rows: ops.TRowsIterable, queue_size: int = PIPELINE_QUEUE_SIZE,
+                 batch_size: int = PIPELINE_BATCH_SIZE) -> None:
+        """
+        :param name: name of the stage in stats
+        :param rows: stream to pull in the thread
+        :param queue_size: maximum number of batches waiting for the consumer
+        :param batch_size: number of rows in a batch
+        """
+        self.stats = StageStats(name)
+        self._rows = rows
+        self._batch_size = batch_size
+        self._queue: queue.Queue[tp.Any] = queue.Queue(maxsize=queue_size)
+        self._stopped = threading.Event()
+
+    def _put(self, item: tp.Any) -> bool:
+        depth = self._queue.qsize()
+        self.stats.batches += 1
+        self.stats.depth_sum += depth
+        if self._queue.full():
+            self.stats.blocked_puts += 1
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self) -> None:
+        rows = iter(self._rows)
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == self._batch_size:
+                    if not self._put(batch):
+                        return
+                    batch = []
+            if batch and not self._put(batch):
+                return
+            self._put(_END)
+        except BaseException as error:
+            self._put(_Failure(error))
+        finally:
+            close = getattr(rows, 'close', None)
+            if close is not None:
+                close()
+
+    def rows(self) -> ops.TRowsGenerator:
+        """Stream of the stage output; the thread starts with the first row requested"""
+        thread = threading.Thread(target=self._produce, name=self.stats.name, daemon=True)
+        thread.start()
+        try:
+            while True:
+                if self._queue.empty():
+                    self.stats.starved_gets += 1
+                item = self._queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield from item
+        finally:
+            self._stopped.set()
+            thread.join()
+
+
+class Pipeline:
+    """
+    Execution mode running every operation of a graph in its own thread, connected to consumers
+    by bounded queues; reading, parsing and work done in worker processes (such as sorts) overlap.
+    Stats of all stages of the last run are kept in stats
+    """
+
+    def __init__(self, queue_size: int = PIPELINE_QUEUE_SIZE, batch_size: int = PIPELINE_BATCH_SIZE) -> None:
+        """
+        :param queue_size: maximum number of batches waiting between two stages
+        :param batch_size: number of rows in a batch
+        """
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stats: list[StageStats] = []
+
+    def stage(self, operation: ops.Operation, rows: ops.TRowsIterable) -> ops.TRowsGenerator:
+        """Run stream of the operation in a new stage"""
+        name = type(operation).__name__
+        mapper = getattr(operation, 'mapper', None)
+        if mapper is not None:
+            name = f'{name}({type(mapper).__name__})'
+        stage = Stage(f'{len(self.stats)}:{name}', rows, self.queue_size, self.batch_size)
+        self.stats.append(stage.stats)
+        return stage.rows()
@@ -0,0 +1,128 @@
+import atexit
+import contextlib
+import pickle
+import threading
+import traceback
+import typing as tp
+from multiprocessing import Pipe, Process, connection
+
+MAX_IDLE_WORKERS = 8
+
+
+class WorkerError(Exception):
+    """Exception of a task in a worker process, with the traceback of the worker"""
+
+
+def _serve(endpoint: connection.Connection) -> None:
+    while True:
+        task = endpoint.recv()
+        if task is None:
+            break
+        target, args = task
+        try:
+            target(endpoint, *args)
+        except Exception:
+            # The main process reads the error instead of a closed pipe; the worker is not reused
+            with contextlib.suppress(OSError):
+                endpoint.send_bytes(pickle.dumps(WorkerError(traceback.format_exc())))
+            break
+
+
+def recv_message(endpoint: connection.Connection) -> tuple[tp.Any, int]:
+    """Unpickled message of a worker and its size in bytes, raises WorkerError if its task failed"""
+    data = endpoint.recv_bytes()
+    message = pickle.loads(data)
+    if isinstance(message, WorkerError):
+        raise message
+    return message, len(data)
+
+
+class _Worker:
+    def __init__(self) -> None:
+        self.endpoint, remote_endpoint = Pipe()
+        self.process = Process(target=_serve, args=(remote_endpoint,), daemon=True)
+        self.process.start()
+        remote_endpoint.close()
+
+    def stop(self) -> None:
+        try:
+            self.endpoint.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.endpoint.close()
+
+    def kill(self) -> None:
+        self.process.terminate()
+        self.process.join()
+        self.endpoint.close()
+
+
+class WorkerPool:
+    """
+    Persistent worker processes shared by operations which offload work (such as ExternalSort).
+    Workers are started lazily when all existing ones are busy and are kept for reuse after a task
+    finishes, so a graph with many sorts does not pay for a fresh process per sort.
+    """
+
+    def __init__(self, max_idle: int = MAX_IDLE_WORKERS) -> None:
+        """
+        :param max_idle: number of finished workers kept alive for next tasks
+        """
+        self.max_idle = max_idle
+        self._idle: list[_Worker] = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def task(self, target: tp.Callable[..., None], *args: tp.Any) -> tp.Iterator[connection.Connection]:
+        """Run target(endpoint, *args) in a worker, yield the other end of its connection.
+        Target must be a picklable module-level function which reads everything it was sent and
+        finishes its replies; a worker left in the middle of a task is killed instead of being reused
+        :param target: function to run in the worker
+        :param args: additional picklable arguments for target
+        """
+        with self._lock:
+            worker = self._idle.pop() if self._idle else None
+        if worker is None:
+            worker = _Worker()
+        worker.endpoint.send((target, args))
+        finished = False
+        try:
+            yield worker.endpoint
+            finished = True
+        finally:
+            if finished:
+                self._release(worker)
+            else:
+                worker.kill()
+
+    def _release(self, worker: _Worker) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(worker)
+                return
+        worker.stop()
+
+    def shutdown(self) -> None:
+        """Stop all idle workers"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+
+_default_pool: WorkerPool | None = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool() -> WorkerPool:
+    """Process-wide pool used when an operation is not given its own"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = WorkerPool()
+            atexit.register(_default_pool.shutdown)
+        return _default_pool
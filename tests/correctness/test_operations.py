@@ -1,11 +1,15 @@
 import copy
 import dataclasses
+import heapq
+import pickle
 import typing as tp
+from operator import itemgetter
 
 import pytest
 from pytest import approx
 
 from compgraph import operations as ops
+from compgraph.operations.utils import SpillFile
 
 
 class _Key:
@@ -94,6 +98,28 @@ MAP_CASES = [
         cmp_keys=('test_id', 'text'),
         mapper_ground_truth_items=(0, 1, 2)
     ),
+    MapCase(
+        mapper=ops.Tokenize(column='text'),
+        data=[
+            {'test_id': 1, 'text': 'One, two\tTHREE!'},
+            {'test_id': 2, 'text': ' Padded\u00A0test '},
+            {'test_id': 3, 'text': ''}
+        ],
+        ground_truth=[
+            {'test_id': 1, 'text': 'one'},
+            {'test_id': 1, 'text': 'three'},
+            {'test_id': 1, 'text': 'two'},
+
+            {'test_id': 2, 'text': ''},
+            {'test_id': 2, 'text': ''},
+            {'test_id': 2, 'text': 'padded'},
+            {'test_id': 2, 'text': 'test'},
+
+            {'test_id': 3, 'text': ''}
+        ],
+        cmp_keys=('test_id', 'text'),
+        mapper_ground_truth_items=(0, 1, 2)
+    ),
     MapCase(
         mapper=ops.Product(columns=['speed', 'time'], result_column='distance'),
         data=[
@@ -127,6 +153,33 @@ MAP_CASES = [
         cmp_keys=('test_id', 'f', 'g'),
         mapper_ground_truth_items=tuple()
     ),
+    MapCase(
+        mapper=ops.Filter(ops.col('f') != ops.col('g')),
+        data=[
+            {'test_id': 1, 'f': 0, 'g': 0},
+            {'test_id': 2, 'f': 0, 'g': 1},
+            {'test_id': 3, 'f': 1, 'g': 0},
+            {'test_id': 4, 'f': 1, 'g': 1}
+        ],
+        ground_truth=[
+            {'test_id': 2, 'f': 0, 'g': 1},
+            {'test_id': 3, 'f': 1, 'g': 0}
+        ],
+        cmp_keys=('test_id', 'f', 'g'),
+        mapper_ground_truth_items=tuple()
+    ),
+    MapCase(
+        mapper=ops.Compute('distance', ops.col('speed') * ops.col('time')),
+        data=[
+            {'test_id': 1, 'speed': 5, 'time': 10},
+            {'test_id': 2, 'speed': 60, 'time': 0.5},
+        ],
+        ground_truth=[
+            {'test_id': 1, 'speed': 5, 'time': 10, 'distance': 50},
+            {'test_id': 2, 'speed': 60, 'time': 0.5, 'distance': 30},
+        ],
+        cmp_keys=('test_id', 'speed', 'time', 'distance')
+    ),
     MapCase(
         mapper=ops.Project(columns=['value']),
         data=[
@@ -156,10 +209,13 @@ def test_mapper(case: MapCase) -> None:
     assert isinstance(mapper_result, tp.Iterator)
     assert sorted(mapper_ground_truth_rows, key=key_func) == sorted(mapper_result, key=key_func)
 
-    result = ops.Map(case.mapper)(iter(case.data))
+    result = ops.Map(case.mapper)(iter(copy.deepcopy(case.data)))
     assert isinstance(result, tp.Iterator)
     assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
 
+    batch_result = case.mapper.map_batch(copy.deepcopy(case.data))
+    assert sorted(case.ground_truth, key=key_func) == sorted(batch_result, key=key_func)
+
 
 @dataclasses.dataclass
 class ReduceCase:
@@ -331,6 +387,88 @@ def test_reducer(case: ReduceCase) -> None:
     assert isinstance(result, tp.Iterator)
     assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
 
+    result = ops.HashReduce(case.reducer, case.reducer_keys)(iter(case.data))
+    assert isinstance(result, tp.Iterator)
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('reducer', [ops.Count(column='count'), ops.FirstReducer()])
+def test_hash_reduce_spills_partitions(reducer: ops.Reducer) -> None:
+    data = [{'word': str(i * 7919 % 100), 'count': 10} for i in range(1000)]
+    expected = [{'word': str(i), 'count': 10} for i in range(100)]
+
+    result = ops.HashReduce(reducer, ('word',), memory_limit=50, partitions=4)(iter(data))
+    assert sorted(expected, key=_Key('word')) == sorted(result, key=_Key('word'))
+
+
+def test_top_n_keeps_earlier_rows_of_equal_values() -> None:
+    rows = [{'key': 'a', 'value': i % 4, 'order': i} for i in range(40)]
+    expected = heapq.nlargest(7, rows, key=itemgetter('value'))
+    reducer = ops.TopN('value', 7)
+    assert expected == list(reducer(('key',), iter(rows)))
+
+    state = reducer.merge(reducer.update_batch(reducer.init(), rows[:15]),
+                          reducer.fold_batch(reducer.init(), rows[15:]))
+    assert expected == list(reducer.finalize({'key': 'a'}, state))
+
+
+def test_hash_reduce_partitions_equal_numbers_together() -> None:
+    # 1, 1.0 and True are one key of a dict, spilled partitions must not split them
+    data = [{'key': [i % 100, float(i % 100), True][i % 3] if i % 100 == 1 else i % 100 + 0.5, 'value': 1}
+            for i in range(3000)]
+    expected = list(ops.HashReduce(ops.Sum('value'), ('key',))(iter(data)))
+    result = list(ops.HashReduce(ops.Sum('value'), ('key',), memory_limit=20, partitions=4)(iter(data)))
+    assert 100 == len(result)
+    assert sorted(expected, key=_Key('key')) == sorted(result, key=_Key('key'))
+
+
+def test_hash_reduce_partitions_spilled_states_again(monkeypatch: pytest.MonkeyPatch) -> None:
+    data = [{'key': f'k{i % 1000:03d}', 'value': 1} for i in range(3000)]
+    spills: list[SpillFile] = []
+
+    def spill_file() -> SpillFile:
+        spills.append(SpillFile())
+        return spills[-1]
+
+    monkeypatch.setattr(ops.reduce, 'SpillFile', spill_file)
+    result = list(ops.HashReduce(ops.Sum('value'), ('key',), memory_limit=100, partitions=4)(iter(data)))
+    # Every partition of about 250 groups is split again
+    assert 4 + 4 * 4 == len(spills)
+    assert [{'key': f'k{i:03d}', 'value': 3} for i in range(1000)] == sorted(result, key=_Key('key'))
+
+
+@pytest.mark.parametrize('case', [case for case in REDUCE_CASES if isinstance(case.reducer, ops.AlgebraicReducer)])
+def test_algebraic_reducer_merge(case: ReduceCase) -> None:
+    reducer = case.reducer
+    assert isinstance(reducer, ops.AlgebraicReducer)
+    rows = [copy.deepcopy(case.data[i]) for i in case.reduce_data_items]
+    middle = len(rows) // 2
+
+    state_a, state_b = reducer.init(), reducer.init()
+    for row in rows[:middle]:
+        state_a = reducer.update(state_a, row)
+    state_b = reducer.update_batch(state_b, rows[middle:])
+    key_row = {col: rows[0][col] for col in case.reducer_keys}
+
+    key_func = _Key(*case.cmp_keys)
+    expected = [copy.deepcopy(case.ground_truth[i]) for i in case.reduce_ground_truth_items]
+    result = reducer.finalize(key_row, reducer.merge(state_a, state_b))
+    assert sorted(expected, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('case', [case for case in REDUCE_CASES if isinstance(case.reducer, ops.AlgebraicReducer)])
+def test_combine_then_reduce(case: ReduceCase) -> None:
+    reducer = case.reducer
+    assert isinstance(reducer, ops.AlgebraicReducer)
+    key_func = _Key(*case.cmp_keys)
+
+    combined = list(ops.Combine(reducer, case.reducer_keys, max_groups=1)(copy.deepcopy(case.data)))
+    assert all(ops.PARTIAL_STATE in row for row in combined)
+    assert len(combined) <= len(case.data)
+
+    result = ops.Reduce(reducer, case.reducer_keys)(iter(combined))
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
 
 @dataclasses.dataclass
 class JoinCase:
@@ -557,3 +695,232 @@ def test_joiner(case: JoinCase) -> None:
     result = ops.Join(case.joiner, case.join_keys)(iter(case.data_left), iter(case.data_right))
     assert isinstance(result, tp.Iterator)
     assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+    result = ops.HashJoin(case.joiner, case.join_keys)(iter(case.data_left), iter(case.data_right))
+    assert isinstance(result, tp.Iterator)
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+    result = ops.BroadcastJoin(case.joiner, case.join_keys)(iter(case.data_left), iter(case.data_right))
+    assert isinstance(result, tp.Iterator)
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+
+def test_joiner_rows_with_different_schemas() -> None:
+    rows_a = [{'id': 1, 'name': 'a'}, {'id': 1, 'score': 5}, {'id': 1, 'name': 'b'}]
+    rows_b = [{'id': 1, 'score': 1}, {'id': 1, 'name': 'c', 'score': 2}]
+    expected = [
+        {'id': 1, 'name': 'a', 'score': 1},
+        {'id': 1, 'name_1': 'a', 'name_2': 'c', 'score': 2},
+        {'id': 1, 'score_1': 5, 'score_2': 1},
+        {'id': 1, 'score_1': 5, 'name': 'c', 'score_2': 2},
+        {'id': 1, 'name': 'b', 'score': 1},
+        {'id': 1, 'name_1': 'b', 'name_2': 'c', 'score': 2},
+    ]
+    assert expected == list(ops.InnerJoiner()(['id'], iter(rows_a), iter(rows_b)))
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.OuterJoiner(), ops.LeftJoiner(), ops.RightJoiner()])
+def test_hash_join_spills_partitions(joiner: ops.Joiner) -> None:
+    left = [{'id': i % 150, 'left': i} for i in range(300)]
+    right = [{'id': i % 200 + 50, 'right': i} for i in range(400)]
+    key_func = _Key('id', 'left', 'right')
+
+    expected = ops.Join(joiner, ['id'])(sorted(left, key=itemgetter('id')), sorted(right, key=itemgetter('id')))
+    result = ops.HashJoin(joiner, ['id'], memory_limit=50, partitions=4)(iter(left), iter(right))
+    assert sorted(expected, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('joiner_class', [ops.InnerJoiner, ops.OuterJoiner, ops.LeftJoiner, ops.RightJoiner])
+def test_joiner_spills_large_groups(joiner_class: tp.Type[ops.Joiner]) -> None:
+    left = [{'id': i % 3, 'left': i} for i in range(20)] + [{'id': 5, 'left': 20}]
+    right = [{'id': i % 4, 'right': i} for i in range(20)] + [{'id': 6, 'right': 20}]
+    key_func = _Key('id', 'left', 'right')
+    left.sort(key=itemgetter('id'))
+    right.sort(key=itemgetter('id'))
+
+    expected = list(ops.Join(joiner_class(), ['id'])(iter(left), iter(right)))
+    joiner = joiner_class(max_group_size=3)
+    result = list(ops.Join(joiner, ['id'])(iter(left), iter(right)))
+    assert sorted(expected, key=key_func) == sorted(result, key=key_func)
+    assert joiner.spilled_groups > 0
+
+
+class _CountingJoiner(ops.InnerJoiner):
+    def __init__(self, max_group_size: int) -> None:
+        super().__init__(max_group_size=max_group_size)
+        self.calls = 0
+
+    def __call__(self, keys: tp.Sequence[str], rows_a: ops.TRowsIterable,
+                 rows_b: ops.TRowsIterable) -> ops.TRowsGenerator:
+        self.calls += 1
+        return super().__call__(keys, rows_a, rows_b)
+
+
+def test_hash_join_buffers_right_groups_once() -> None:
+    left = [{'id': 1, 'left': i} for i in range(50)]
+    right = [{'id': 1, 'right': i} for i in range(20)]
+    key_func = _Key('id', 'left', 'right')
+
+    sort_joiner = ops.InnerJoiner(max_group_size=10)
+    expected = list(ops.Join(sort_joiner, ['id'])(iter(left), iter(right)))
+    joiner = _CountingJoiner(max_group_size=10)
+    result = list(ops.HashJoin(joiner, ['id'])(iter(left), iter(right)))
+    assert sorted(expected, key=key_func) == sorted(result, key=key_func)
+    assert 1 == sort_joiner.spilled_groups == joiner.spilled_groups
+    assert 1 == joiner.calls
+
+
+@pytest.mark.parametrize('joiner_type', [ops.InnerJoiner, ops.LeftJoiner, ops.OuterJoiner])
+def test_broadcast_join_spills_large_right_tables(joiner_type: tp.Type[ops.Joiner]) -> None:
+    left = [{'id': i % 3, 'left': i} for i in range(30)]
+    right = [{'id': i % 4, 'right': i} for i in range(100)]
+    key_func = _Key('id', 'left', 'right')
+
+    # With empty keys the right table is one group, spilled by the joiner as by a sort join
+    sort_joiner = joiner_type(max_group_size=50)
+    expected = list(ops.Join(sort_joiner, [])(iter(left), iter(right)))
+    joiner = joiner_type(max_group_size=50)
+    result = list(ops.BroadcastJoin(joiner, [], memory_limit=20)(iter(left), iter(right)))
+    assert expected == result
+    assert 1 == sort_joiner.spilled_groups == joiner.spilled_groups
+
+    expected = list(ops.HashJoin(joiner_type(), ['id'])(iter(left), iter(right)))
+    result = list(ops.BroadcastJoin(joiner_type(), ['id'], memory_limit=20, partitions=2)(iter(left), iter(right)))
+    assert sorted(expected, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('mapper', [
+    ops.HaversineDistance('start', 'end', 'distance'),
+    ops.Divide('a', 'b', 'ratio'),
+    ops.Log('a', 'log'),
+    ops.Product(['a', 'b'], 'product'),
+    ops.Filter(ops.ColumnPredicate('a', '>', 0.5)),
+    ops.Filter((ops.col('a') * 2 > ops.col('b')) & ~(ops.col('a') > 0.9)),
+    ops.Compute('c', -ops.col('a') / ops.col('b') + 1),
+])
+def test_mapper_columns(mapper: ops.Mapper) -> None:
+    pytest.importorskip('numpy')
+    data = [{'start': [37.0 + i / 100, 55.0], 'end': [37.5, 55.0 + i / 200], 'a': i / 100 + 0.01, 'b': 2.0}
+            for i in range(100)]
+
+    expected = list(ops.Map(mapper, batch_size=1)(copy.deepcopy(data)))
+    result = mapper.map_columns(ops.RecordBatch(copy.deepcopy(data))).to_rows()
+    assert expected == [{key: approx(value) for key, value in row.items()} for row in result]
+
+
+EXPRESSIONS = [
+    ops.col('n') + 1, ops.col('n') - ops.col('x'), ops.col('n') * 3, 7 / ops.col('x'), ops.col('n') % 3,
+    -ops.col('n'), ops.length(ops.col('text')), ops.col('text') == 'bb', ops.col('text') < 'c',
+    (ops.col('n') > 5) | ~(ops.col('x') <= 1.5), (ops.col('n') >= 2) & (ops.col('n') != 4),
+    ops.col('big') * 2, ops.col('big') > 0.5, ops.col('n') / ops.col('zero'), ops.col('n') + ops.lit(float('inf')),
+]
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS, ids=repr)
+def test_expression(expression: ops.Expression) -> None:
+    np = pytest.importorskip('numpy')
+    data = [{'n': i, 'x': i / 4 + 1, 'text': 'abc'[:i % 4] * 2, 'big': 2 ** 62 + i, 'zero': i % 2}
+            for i in range(100)]
+
+    try:
+        expected: tp.Any = [expression(row) for row in data]
+    except ZeroDivisionError:
+        expected = ZeroDivisionError
+    values = expression.evaluate(ops.RecordBatch(data))
+    if values is not None:
+        # Batches are only vectorized where they give the same values as rows
+        assert expected == approx(np.asarray(values).tolist())
+        assert all(type(value) is type(result) for value, result in zip(np.asarray(values).tolist(), expected))
+
+    restored = pickle.loads(pickle.dumps(expression))
+    assert restored.columns == expression.columns <= set(data[0])
+    if expected is not ZeroDivisionError:
+        assert expected == [restored(row) for row in data]
+    with pytest.raises(TypeError):
+        bool(expression)
+
+
+class _Duplicate(ops.Mapper):
+    def __call__(self, row: ops.TRow) -> ops.TRowsGenerator:
+        # An emitted row belongs to the consumer, so the copy is emitted first
+        yield dict(row)
+        yield row
+
+
+@pytest.mark.parametrize('case', MAP_CASES)
+def test_fused_map(case: MapCase) -> None:
+    mappers = [_Duplicate(), case.mapper, ops.DummyMapper()]
+    expected = copy.deepcopy(case.data)
+    for mapper in mappers:
+        expected = list(ops.Map(mapper)(expected))
+
+    assert expected == list(ops.FusedMap(mappers)(copy.deepcopy(case.data)))
+
+
+@pytest.mark.parametrize('separator', [None, ' ', r'(,)\s*'])
+def test_tokenize_matches_normalized_split(separator: str | None) -> None:
+    texts = ['', ' ', 'a', ' a', 'a ', '  Hello,  World!\n', 'x\u2003Y\u00A0z', '...', 'a,b, c ,', 'ŞİMDİ ünicode',
+             'ΟΔΟΣ,ΑΒ ΟΔΟΣ']
+    data = [{'id': i, 'text': text} for i, text in enumerate(texts)]
+    for normalizers in ([], [ops.LowerCase('text')], [ops.FilterPunctuation('text'), ops.LowerCase('text')],
+                        [ops.LowerCase('text'), ops.FilterPunctuation('text')]):
+        expected = copy.deepcopy(data)
+        for mapper in [*normalizers, ops.Split('text', separator)]:
+            expected = list(ops.Map(mapper)(expected))
+
+        tokenize = ops.Tokenize('text', separator, filter_punctuation=len(normalizers) == 2,
+                                lower_case=bool(normalizers),
+                                lower_case_first=bool(normalizers) and isinstance(normalizers[0], ops.LowerCase))
+        assert expected == list(ops.Map(tokenize)(copy.deepcopy(data)))
+        assert expected == list(ops.Map(pickle.loads(pickle.dumps(tokenize)))(copy.deepcopy(data)))
+
+
+def test_fused_map_chain() -> None:
+    data = [{'text': f'Hello, {i} World! {i % 7}', 'a': i + 1.0, 'b': i % 5 + 1.0} for i in range(300)]
+    mappers = [ops.FilterPunctuation('text'), ops.LowerCase('text'), ops.Split('text'),
+               ops.Filter(lambda row: len(row['text']) > 1), ops.Divide('a', 'b', 'ratio'),
+               ops.Filter(ops.ColumnPredicate('ratio', '>', 2)), ops.Log('ratio', 'log'), ops.Project(['text', 'log'])]
+    expected = copy.deepcopy(data)
+    for mapper in mappers:
+        expected = list(ops.Map(mapper)(expected))
+
+    result = list(ops.FusedMap(mappers)(copy.deepcopy(data)))
+    assert [{**row, 'log': approx(row['log'])} for row in expected] == result
+
+
+def test_compact_row() -> None:
+    row_type = ops.compact_row_type(['a', 'b'])
+    assert row_type is ops.compact_row_type(('a', 'b'))
+    row = row_type.from_row({'b': 2, 'c': 3})
+    assert {'b': 2, 'c': 3} == row
+    assert 'a' not in row and 'c' in row and 2 == len(row)
+    row['a'] = 1
+    assert ['a', 'b', 'c'] == list(row)
+    with pytest.raises(KeyError):
+        row['d']
+
+    restored = pickle.loads(pickle.dumps(row))
+    assert isinstance(restored, row_type) and {'a': 1, 'b': 2, 'c': 3} == restored
+    copied = row.copy()
+    del copied['a'], copied['c']
+    assert {'b': 2} == copied and {'a': 1, 'b': 2, 'c': 3} == row
+    assert {'b': 2} == pickle.loads(pickle.dumps(copied))
+
+    retained = row.retain(['c', 'a', 'd'])
+    assert isinstance(retained, ops.CompactRow) and ('c', 'a') == retained.columns
+    assert [{'c': 3, 'a': 1}] == list(ops.FusedMap([ops.Retain(['c', 'a', 'd'])])([row]))
+
+    # Rows are created through types of their schemas only
+    with pytest.raises(TypeError):
+        ops.CompactRow([1, 2])
+
+
+def test_mappers_on_compact_rows() -> None:
+    data = [{'doc_id': i, 'text': f'Hello, {i} World!', 'a': i + 1.0, 'b': 2} for i in range(20)]
+    mappers = [ops.Product(['a', 'b'], 'product'), ops.Tokenize('text'), ops.Split('text', 'l'),
+               ops.Compute('ratio', ops.col('a') / ops.col('b')), ops.Retain(['text', 'product', 'ratio'])]
+    row_type = ops.compact_row_type(['doc_id', 'text', 'a', 'b'])
+    expected = copy.deepcopy(data)
+    for mapper in mappers:
+        expected = list(ops.Map(mapper)(expected))
+    assert expected == list(ops.FusedMap(mappers)(map(row_type.from_row, data)))
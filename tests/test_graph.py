@@ -1,5 +1,20 @@
+import copy
+import json
+import tempfile
+import threading
+import time
+import typing as tp
+from collections import Counter
+from operator import itemgetter
+
+import pytest
+
 from compgraph import operations as ops
+from compgraph.external_sort import ExternalSort
+from compgraph.fanout import FanOut
 from compgraph.graph import Graph
+from compgraph.pipeline import Pipeline
+from compgraph.pool import WorkerError, WorkerPool
 
 
 def test_graph_map() -> None:
@@ -50,6 +65,26 @@ def test_graph_join() -> None:
     assert expected == list(graph.run(first_input=lambda: iter(Customers), second_input=lambda: iter(Orders)))
 
 
+def test_graph_join_broadcasts_empty_keys() -> None:
+    words = [{'word': 'b', 'count': 2}, {'word': 'a', 'count': 1}, {'word': 'c', 'count': 3}]
+    total = [{'count': 6}]
+    expected = [
+        {'word': 'b', 'count_1': 2, 'count_2': 6},
+        {'word': 'a', 'count_1': 1, 'count_2': 6},
+        {'word': 'c', 'count_1': 3, 'count_2': 6},
+    ]
+
+    graph = Graph().graph_from_iter('words').join(ops.InnerJoiner(), Graph().graph_from_iter('total'), [])
+    assert expected == list(graph.run(words=lambda: iter(words), total=lambda: iter(total)))
+
+    # An explicit strategy is kept for empty keys too
+    for strategy, operation in (('sort', ops.Join), ('hash', ops.HashJoin)):
+        graph = Graph().graph_from_iter('words').join(ops.InnerJoiner(), Graph().graph_from_iter('total'), [],
+                                                      strategy=strategy)
+        assert type(graph.operation) is operation
+        assert expected == list(graph.run(words=lambda: iter(words), total=lambda: iter(total)))
+
+
 def test_graph_sort() -> None:
     data = [
         {'first_name': 'John', 'amount': 300},
@@ -64,3 +99,336 @@ def test_graph_sort() -> None:
 
     graph = Graph().graph_from_iter('input').sort(['amount'])
     assert expected == list(graph.run(input=lambda: iter(data)))
+
+
+def test_graph_shared_node_runs_once() -> None:
+    data = [
+        {'doc_id': 1, 'text': 'hello world'},
+        {'doc_id': 2, 'text': 'hello'},
+    ]
+    calls = []
+
+    def source() -> tp.Iterator[ops.TRow]:
+        calls.append(1)
+        return iter(data)
+
+    words = Graph().graph_from_iter('input').map(ops.Split('text'))
+    counts = words.sort(['text']).reduce(ops.Count('count'), ['text'])
+    graph = words.sort(['text']).join(ops.InnerJoiner(), counts, ['text'])
+
+    expected = [
+        {'doc_id': 1, 'text': 'hello', 'count': 2},
+        {'doc_id': 2, 'text': 'hello', 'count': 2},
+        {'doc_id': 1, 'text': 'world', 'count': 1},
+    ]
+    assert expected == list(graph.run(input=source))
+    assert len(calls) == 1
+
+
+def test_graph_reduce_with_combiner() -> None:
+    data = [{'word': word} for word in 'b a b c a b'.split()]
+    expected = [{'word': 'a', 'count': 2}, {'word': 'b', 'count': 3}, {'word': 'c', 'count': 1}]
+
+    graph = Graph().graph_from_iter('input') \
+        .sort(['word']) \
+        .reduce(ops.Count('count'), ['word'], combine=True)
+    assert expected == list(graph.run(input=lambda: iter(data)))
+
+
+def test_fan_out_spills_lagging_consumer() -> None:
+    data = [{'x': i} for i in range(10)]
+    fanout = FanOut(iter(data), consumers=2, buffer_size=3)
+    first, second = fanout.consumer(), fanout.consumer()
+
+    first_rows = list(first)
+    first_rows[0]['x'] = -1
+    assert [{'x': -1}] + data[1:] == first_rows
+    assert [{'x': i} for i in range(10)] == list(second)
+
+
+def test_fan_out_copies_rows_on_write() -> None:
+    data = [{'x': i} for i in range(10)]
+    fanout = FanOut(iter(data), consumers=3, buffer_size=4)
+    first, second, third = fanout.consumer(), fanout.consumer(), fanout.consumer()
+
+    first_rows = list(first)
+    second_rows = list(second)
+    third_rows = list(third)
+    assert first_rows[0] is data[0]
+    for rows in (first_rows, second_rows):
+        for row in rows:
+            row['x'] = -1
+    assert [{'x': i} for i in range(10)] == third_rows
+    assert len({id(row) for rows in (first_rows, second_rows, third_rows) for row in rows}) == 30
+
+
+def test_graph_leaves_input_rows_unchanged() -> None:
+    data = [{'text': 'a b', 'x': 2, 'y': 3}, {'text': 'c', 'x': 1, 'y': 1}]
+    expected = copy.deepcopy(data)
+    graph = Graph.graph_from_iter('input') \
+        .map(ops.Product(['x', 'y'], 'product')) \
+        .map(ops.Split('text'))
+    assert [{'text': 'a', 'x': 2, 'y': 3, 'product': 6}, {'text': 'b', 'x': 2, 'y': 3, 'product': 6},
+            {'text': 'c', 'x': 1, 'y': 1, 'product': 1}] == list(graph.run(input=lambda: iter(data)))
+    assert expected == data
+
+
+def test_graph_sort_spills_runs() -> None:
+    data = [{'key': i % 7, 'order': i} for i in range(1000)]
+    expected = sorted(data, key=lambda row: row['key'])
+
+    graph = Graph().graph_from_iter('input').sort(['key'], memory_limit=256, in_process_rows=0)
+    assert expected == list(graph.run(input=lambda: iter(data)))
+
+    result = ExternalSort(['key'], memory_limit=256, max_fan_in=2, in_process_rows=0)(iter(data))
+    assert expected == list(result)
+
+
+def test_sort_workers_are_reused() -> None:
+    data = [{'key': i % 5} for i in range(100)]
+    expected = sorted(data, key=lambda row: row['key'])
+    pool = WorkerPool()
+    sort = ExternalSort(['key'], in_process_rows=10, pool=pool)
+    try:
+        assert expected == list(sort(iter(data)))
+        worker = pool._idle[0]
+        assert expected == list(sort(iter(data)))
+        assert [worker] == pool._idle
+
+        abandoned = sort(iter(data))
+        next(abandoned)
+        abandoned.close()
+        assert [] == pool._idle
+    finally:
+        pool.shutdown()
+    assert not worker.process.is_alive()
+
+
+def test_graph_run_partitioned() -> None:
+    docs = [{'doc_id': i % 7, 'text': f'w{i % 13}'} for i in range(500)]
+    counts = Graph.graph_from_iter('docs') \
+        .sort(['text', 'doc_id']) \
+        .reduce(ops.Count('count'), ['text', 'doc_id']) \
+        .map(ops.Project(['text', 'doc_id', 'count']))
+    totals = Graph.graph_from_iter('docs').reduce(ops.Count('total'), ['doc_id'], strategy='hash') \
+        .sort(['doc_id'])
+    graph = counts.sort(['doc_id']).join(ops.InnerJoiner(), totals, ['doc_id']) \
+        .map(ops.Divide('count', 'total', 'share'))
+
+    expected = list(graph.run(docs=lambda: iter(docs)))
+    assert expected == list(graph.run(docs=lambda: iter(docs), workers=3))
+
+
+class _GroupSize(ops.Reducer):
+    """Size of a group without its keys"""
+
+    def __call__(self, group_key: tp.Tuple[str, ...], rows: ops.TRowsIterable) -> ops.TRowsGenerator:
+        yield {'n': sum(1 for _ in rows)}
+
+
+class _PairCount(ops.Joiner):
+    """Number of pairs of rows of a key without the key"""
+
+    def __call__(self, keys: tp.Sequence[str], rows_a: ops.TRowsIterable,
+                 rows_b: ops.TRowsIterable) -> ops.TRowsGenerator:
+        yield {'pairs': len(list(rows_a)) * len(list(rows_b))}
+
+
+class _Failing(ops.Reducer):
+    def __call__(self, group_key: tp.Tuple[str, ...], rows: ops.TRowsIterable) -> ops.TRowsGenerator:
+        raise ValueError('bad group')
+        yield {}
+
+
+def test_graph_run_partitioned_outputs_without_keys() -> None:
+    docs = [{'doc_id': i % 7, 'text': f'w{(i * 5) % 13}'} for i in range(500)]
+    words = Graph.graph_from_iter('docs').sort(['text'])
+    for graph in [words.reduce(_GroupSize(), ['text']),
+                  words.reduce(ops.Count('count'), ['text']).map(ops.Project(['count'])),
+                  words.join(_PairCount(), words.reduce(ops.FirstReducer(), ['text']), ['text'])]:
+        expected = list(graph.run(docs=lambda: iter(docs)))
+        assert expected == list(graph.run(docs=lambda: iter(docs), workers=2))
+
+
+def test_graph_run_partitioned_raises_worker_errors() -> None:
+    graph = Graph.graph_from_iter('docs').reduce(_Failing(), ['key'], strategy='hash')
+    with pytest.raises(WorkerError, match='ValueError: bad group'):
+        list(graph.run(docs=lambda: iter([{'key': i} for i in range(10)]), workers=2))
+
+
+def test_graph_parallel_map() -> None:
+    data = [{'text': f'a b {i}'} for i in range(3000)]
+    mapper = ops.Split('text')
+    expected = list(Graph.graph_from_iter('input').map(mapper).run(input=lambda: iter(data)))
+
+    graph = Graph.graph_from_iter('input').map(mapper, parallel=2, chunk_size=100)
+    assert expected == list(graph.run(input=lambda: iter(data)))
+    unordered = Graph.graph_from_iter('input').map(mapper, parallel=2, chunk_size=100, ordered=False)
+    key = itemgetter('text')
+    assert sorted(expected, key=key) == sorted(unordered.run(input=lambda: iter(data)), key=key)
+
+    # Unlike lambdas, expressions pickle, so the filter runs in the workers
+    condition = ops.length(ops.col('text')) > 7
+    filtered = Graph.graph_from_iter('input').map(ops.Filter(condition), parallel=2, chunk_size=100)
+    assert [row for row in data if len(row['text']) > 7] == list(filtered.run(input=lambda: iter(data)))
+
+
+def test_graph_from_file_with_schema() -> None:
+    docs = [{'doc_id': i % 7, 'text': f'w{i % 13} W{i % 5}'} for i in range(3000)] + [{'doc_id': 7, 'extra': 1}]
+    with tempfile.NamedTemporaryFile('w') as f:
+        f.writelines(json.dumps(doc) + '\n' for doc in docs)
+        f.flush()
+
+        def make_graph(schema: tp.Sequence[str] | None) -> Graph:
+            source = Graph.graph_from_file(f.name, json.loads, schema)
+            words = source.map(ops.Filter(lambda row: 'text' in row)).map(ops.Split('text'))
+            totals = source.reduce(ops.Count('docs'), ['doc_id'], strategy='hash').sort(['doc_id'])
+            return words.sort(['doc_id', 'text'], memory_limit=1000, in_process_rows=0) \
+                .join(ops.InnerJoiner(), totals, ['doc_id'])
+
+        assert isinstance(next(iter(Graph.graph_from_file(f.name, json.loads, ['doc_id', 'text']).run())),
+                          ops.CompactRow)
+        expected = list(make_graph(None).run())
+        assert expected == list(make_graph(['doc_id', 'text']).run())
+        assert expected == list(make_graph(['doc_id', 'text']).run(workers=2))
+
+
+def test_graph_sort_parallel() -> None:
+    data = [{'key': (i * 7919) % 101, 'order': i} for i in range(3000)]
+    expected = sorted(data, key=itemgetter('key'))
+    graph = Graph.graph_from_iter('input').sort(['key'], in_process_rows=0, workers=3)
+    assert expected == list(graph.run(input=lambda: iter(data)))
+
+
+def test_graph_run_pipeline() -> None:
+    docs = [{'doc_id': i % 7, 'text': f'w{i % 13} W{i % 5}'} for i in range(3000)]
+    source = Graph.graph_from_iter('docs')
+    words = source.map(ops.Split('text')).map(ops.LowerCase('text'))
+    counts = words.sort(['text']).reduce(ops.Count('count'), ['text'])
+    graph = counts.join(ops.InnerJoiner(), source.reduce(ops.Count('docs'), [], strategy='hash'), [])
+
+    pipeline = Pipeline(queue_size=2, batch_size=100)
+    assert list(graph.run(docs=lambda: iter(docs))) == list(graph.run(docs=lambda: iter(docs), pipeline=pipeline))
+    assert len(pipeline.stats) == 6
+    assert all(stats.batches > 0 for stats in pipeline.stats)
+
+
+def test_graph_run_concurrent_join_inputs() -> None:
+    data = [{'key': (i * 7919) % 1009, 'value': i} for i in range(5000)]
+    left = Graph.graph_from_iter('input').sort(['key'])
+    right = Graph.graph_from_iter('input').map(ops.Project(['key'])).sort(['key']) \
+        .reduce(ops.Count('count'), ['key'])
+    graph = left.join(ops.LeftJoiner(), right, ['key'])
+
+    expected = list(graph.run(input=lambda: iter(data)))
+    assert expected == list(graph.run(input=lambda: iter(data), concurrent=True))
+
+    # Operations of one input read it in the thread of their consumer
+    threads = threading.active_count()
+    chain = Graph.graph_from_iter('input').map(ops.Project(['key'])).sort(['key']).reduce(ops.Count('count'), ['key'])
+    rows = chain.run(input=lambda: iter(data), concurrent=True)
+    next(rows)
+    assert threads == threading.active_count()
+    assert list(chain.run(input=lambda: iter(data)))[1:] == list(rows)
+
+
+def test_graph_run_concurrent_join_inputs_overlap() -> None:
+    def slow_rows(delay: float) -> tp.Iterator[ops.TRow]:
+        time.sleep(delay)
+        yield from ({'key': i % 10, 'value': i} for i in range(100))
+
+    left = Graph.graph_from_iter('left').sort(['key'])
+    right = Graph.graph_from_iter('right').sort(['key']).reduce(ops.Count('count'), ['key'])
+    graph = left.join(ops.InnerJoiner(), right, ['key'])
+
+    start = time.perf_counter()
+    result = list(graph.run(left=lambda: slow_rows(0.5), right=lambda: slow_rows(0.5), concurrent=True))
+    assert time.perf_counter() - start < 0.9
+    assert 100 == len(result)
+
+
+def test_graph_drops_redundant_sorts() -> None:
+    data = [{'doc_id': i % 5, 'text': f'w{i % 11}', 'n': i} for i in range(2000)]
+    words = Graph.graph_from_iter('input').sort(['doc_id', 'text'])
+    counts = words.sort(['doc_id', 'text']).reduce(ops.Count('count'), ['doc_id', 'text']) \
+        .map(ops.Divide('count', 'doc_id', 'ratio')).sort(['doc_id'])
+    graph = counts.sort(['doc_id', 'text', 'ratio'])
+
+    plan = graph.explain()
+    assert plan.count('dropped') == 2
+    assert 'sorts groups of rows equal on doc_id, text' in plan
+
+    data = [row for row in data if row['doc_id']]
+    expected = sorted(({'doc_id': doc_id, 'text': text, 'count': count, 'ratio': count / doc_id}
+                       for (doc_id, text), count in
+                       Counter((row['doc_id'], row['text']) for row in data).items()),
+                      key=itemgetter('doc_id', 'text', 'ratio'))
+    assert expected == list(graph.run(input=lambda: iter(data)))
+
+
+def test_graph_keeps_sorts_after_unordered_operations() -> None:
+    graph = Graph.graph_from_iter('input').sort(['a']).map(ops.LowerCase('a')).sort(['a']) \
+        .reduce(ops.Count('count'), ['a'], strategy='hash').sort(['a'])
+    assert 'dropped' not in graph.explain()
+    assert 'sorts groups' not in graph.explain()
+
+
+def test_graph_pushes_filters_down() -> None:
+    data = [{'key': i % 10, 'text': f'a b {i}'} for i in range(300)]
+    source = Graph.graph_from_iter('input')
+    graph = source.sort(['key']).map(ops.Split('text')) \
+        .map(ops.Filter(ops.ColumnPredicate('key', '>=', 7))) \
+        .join(ops.InnerJoiner(), source.map(ops.Project(['key'])).sort(['key']), ['key']) \
+        .map(ops.Filter(lambda row: row['key'] != 8, columns=['key']))
+
+    # Filters stop above the shared source, whose other consumer needs all of its rows
+    plan = [line.split()[0] for line in graph.explain().splitlines()]
+    assert plan == ['Join(InnerJoiner)', 'Map(Tokenize)', 'Map(Filter)', 'Map(Filter)', 'ExternalSort', '#1',
+                    'ExternalSort', 'Map(Filter)', 'Map(Project)', '#1']
+
+    keys = Counter(row['key'] for row in data)
+    expected = sorted(({'key': row['key'], 'text': piece} for row in data for piece in row['text'].split()
+                       for _ in range(keys[row['key']]) if row['key'] in (7, 9)), key=itemgetter('key'))
+    assert expected == list(graph.run(input=lambda: iter(data)))
+
+
+def test_graph_projects_unused_columns() -> None:
+    data = [{'key': i % 4, 'value': i, 'payload': 'x' * 100} for i in range(100)]
+    right = [{'key': i, 'value': -i, 'payload': None} for i in range(4)]
+    graph = Graph.graph_from_iter('input').sort(['key']) \
+        .join(ops.InnerJoiner(), Graph.graph_from_iter('right').sort(['key']), ['key']) \
+        .map(ops.Project(['key', 'value_2']))
+
+    # Both inputs keep value, so it is still renamed on the collision
+    assert graph.explain().count('Retain(key, value, value_2)') == 2
+    expected = [{'key': row['key'], 'value_2': -row['key']} for row in sorted(data, key=itemgetter('key'))]
+    assert expected == list(graph.run(input=lambda: iter(data), right=lambda: iter(right)))
+
+    # Sources read by mappers are not projected, nor are inputs of sorts keeping all known columns
+    graph = Graph.graph_from_iter('input').map(ops.Project(['key', 'value'])).sort(['key'])
+    assert 'Retain' not in graph.explain()
+    assert [{'key': row['key'], 'value': row['value']} for row in sorted(data, key=itemgetter('key'))] \
+        == list(graph.run(input=lambda: iter(data)))
+
+
+def test_graph_tokenizes_normalized_splits() -> None:
+    data = [{'id': i, 'text': f' Hello, {i} WORLD!\t{i % 3}'} for i in range(200)]
+    source = Graph.graph_from_iter('input')
+    graph = source.map(ops.LowerCase('text')).map(ops.FilterPunctuation('text')).map(ops.Split('text'))
+    assert 'Map(Tokenize)' in graph.explain()
+    assert 'LowerCase' not in graph.explain() and 'FilterPunctuation' not in graph.explain()
+
+    expected = [{'id': row['id'], 'text': token} for row in data
+                for token in ['', 'hello', str(row['id']), 'world', str(row['id'] % 3)]]
+    assert expected == list(graph.run(input=lambda: iter(copy.deepcopy(data))))
+
+    # Lower cased rows are read by another consumer as well, so only punctuation is filtered in Tokenize
+    lower = source.map(ops.LowerCase('text'))
+    graph = lower.map(ops.FilterPunctuation('text')).map(ops.Split('text')) \
+        .join(ops.InnerJoiner(), lower.map(ops.Project(['id'])), ['id'], strategy='hash')
+    assert 'Map(LowerCase)' in graph.explain()
+    assert expected == list(graph.run(input=lambda: iter(copy.deepcopy(data))))
+
+    # Text is lower cased before punctuation is removed, as the final sigma depends on the comma
+    graph = source.map(ops.LowerCase('text')).map(ops.FilterPunctuation('text')).map(ops.Split('text'))
+    assert [{'text': 'οδοςαβ'}] == list(graph.run(input=lambda: iter([{'text': 'ΟΔΟΣ,ΑΒ'}])))